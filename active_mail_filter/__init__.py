@@ -35,7 +35,39 @@ def read_configuration_file(refresh=False):
                                          'cipher_key': '1234567890123456'},
                         'http_server': {'listen_address': '0.0.0.0',
                                         'cert_file': '',
-                                        'pkey_file': ''}
+                                        'pkey_file': ''},
+                        'filter_daemon': {'filter_mode': 'poll',
+                                          'poll_interval': '60',
+                                          'idle_timeout': '600',
+                                          'idle_sweep_interval': '900',
+                                          'pool_max_per_server': '10',
+                                          'pool_idle_timeout': '300',
+                                          'pool_max_per_user': '4',
+                                          'idle_max_per_server': '50',
+                                          'idle_max_per_user': '4',
+                                          'max_workers': '16',
+                                          'max_workers_per_server': '8',
+                                          'engine': 'threads',
+                                          'green_concurrency': '500',
+                                          'operation_timeout': '60',
+                                          'user_timeout': '900',
+                                          'search_strategy': 'auto',
+                                          'full_sweep_interval': '3600',
+                                          'user_parallelism': '1',
+                                          'forward_rate': '0',
+                                          'forward_stream_size': '1048576',
+                                          'retry_backoff': '60',
+                                          'retry_backoff_max': '3600',
+                                          'scheduler': 'adaptive',
+                                          'min_interval': '30',
+                                          'max_interval': '900',
+                                          'schedule_jitter': '0.1',
+                                          'provider_rate': '5',
+                                          'cluster_mode': 'False',
+                                          'node_id': '',
+                                          'cluster_heartbeat': '5',
+                                          'cluster_node_timeout': '15',
+                                          'worker_processes': '0'}
                         }
 
         for section in sorted(default_conf.keys()):
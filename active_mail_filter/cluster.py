@@ -0,0 +1,178 @@
+# Copyright (c) 2016, Kevin Rodgers
+# Released subject to the New BSD License
+# Please see http://en.wikipedia.org/wiki/BSD_licenses
+
+import os
+import time
+import bisect
+import socket
+import hashlib
+import threading
+from uuid import uuid4
+import redis
+from redis import WatchError
+from active_mail_filter import get_logger, trace
+from active_mail_filter.simple_db import SimpleRedisDb
+
+logger = get_logger()
+
+DEF_HEARTBEAT = 5
+DEF_NODE_TIMEOUT = 15
+# points per node on the hash ring, more points spread users more evenly
+VIRTUAL_NODES = 64
+
+
+def default_node_id():
+    return '%s:%d:%s' % (socket.gethostname(), os.getpid(), uuid4().hex[:8])
+
+
+def _hash(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return int(hashlib.md5(value).hexdigest()[:15], 16)
+
+
+class HashRing(object):
+    def __init__(self, nodes, virtual_nodes=VIRTUAL_NODES):
+        """
+        Consistent hash of users onto nodes, a node joining or leaving only moves the
+        users on its own share of the ring
+
+        :param nodes: node ids
+        :param virtual_nodes: points per node
+        """
+        self.nodes = tuple(sorted(nodes))
+        points = sorted((_hash('%s#%d' % (node, i)), node) for node in self.nodes for i in range(0, virtual_nodes))
+        self.hashes = [p[0] for p in points]
+        self.owners = [p[1] for p in points]
+
+    def __str__(self):
+        return 'HashRing [nodes=%s]' % str(self.nodes)
+
+    def owner(self, user):
+        if len(self.hashes) == 0:
+            return None
+        return self.owners[bisect.bisect(self.hashes, _hash(user)) % len(self.hashes)]
+
+
+class ClusterMembership(SimpleRedisDb):
+    def __init__(self, host, key, port=6379, node_id=None, heartbeat=DEF_HEARTBEAT, node_timeout=DEF_NODE_TIMEOUT,
+                 connection_class=redis.Connection):
+        """
+        Daemons sharing one redis register with a heartbeat and split the users between
+        the live nodes by consistent hashing. A user is also leased to the node running it
+        so two nodes never filter the same account while the ring is changing
+
+        :param host: database host
+        :param port: database port default 6397
+        :param key: prefix for the cluster keys, normally the redis_key from the configuration
+        :param node_id: unique name of this daemon, default is host:pid:random
+        :param heartbeat: seconds between heartbeats
+        :param node_timeout: seconds without a heartbeat after which a node is considered dead
+        :param connection_class: redis connection class, e.g. GreenRedisConnection under gevent
+        """
+        SimpleRedisDb.__init__(self, host=host, key=key, port=port, connection_class=connection_class)
+        self.node_id = node_id or default_node_id()
+        self.heartbeat_interval = heartbeat
+        self.node_timeout = node_timeout
+        self.last_heartbeat = 0
+        self.ring = HashRing([])
+        # bumped whenever the ring changes, lets callers notice a rebalance
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return 'ClusterMembership [host=%s, port=%d, key=%s, node_id=%s, nodes=%d]' % \
+               (self.host, self.port, self.key, self.node_id, len(self.ring.nodes))
+
+    def _nodes_key(self):
+        return '%s:cluster:nodes' % self.key
+
+    def _lease_key(self, user):
+        return '%s:cluster:lease:%s' % (self.key, user)
+
+    def live_nodes(self):
+        """
+        :return:
+        sorted list of the node ids that sent a heartbeat within node_timeout
+        """
+        self._open_db()
+        return sorted(self.redis.zrangebyscore(self._nodes_key(), time.time() - self.node_timeout, '+inf'))
+
+    def heartbeat(self):
+        """
+        Record this node as alive, forget dead nodes and rebuild the ring from the live ones
+        :return:
+        True if the live nodes changed since the last heartbeat
+        """
+        self._open_db()
+        now = time.time()
+        pipe = self.redis.pipeline()
+        pipe.zadd(self._nodes_key(), {self.node_id: now})
+        pipe.zremrangebyscore(self._nodes_key(), '-inf', now - self.node_timeout)
+        pipe.zrangebyscore(self._nodes_key(), now - self.node_timeout, '+inf')
+        nodes = pipe.execute()[-1]
+        with self.lock:
+            self.last_heartbeat = now
+            if tuple(sorted(nodes)) == self.ring.nodes:
+                return False
+            logger.info('cluster nodes %s => %s', ','.join(self.ring.nodes) or 'none', ','.join(sorted(nodes)))
+            self.ring = HashRing(nodes)
+            self.generation += 1
+            return True
+
+    def leave(self):
+        # the other nodes take over this node's users on their next heartbeat
+        self._open_db()
+        self.redis.zrem(self._nodes_key(), self.node_id)
+        with self.lock:
+            self.ring = HashRing([])
+            self.generation += 1
+            self.last_heartbeat = 0
+        logger.info('%s: left the cluster', self.node_id)
+
+    def owns(self, user):
+        with self.lock:
+            return self.ring.owner(user) == self.node_id
+
+    def owned_records(self, records, user_field='user'):
+        """
+        :param records: user records
+        :param user_field: record field holding the user
+        :return:
+        the records whose user hashes to this node
+        """
+        with self.lock:
+            ring = self.ring
+        return [rec for rec in records if ring.owner(rec[user_field]) == self.node_id]
+
+    def acquire(self, user, ttl):
+        """
+        Lease a user to this node, the lease ends with release() or after ttl seconds
+        :param user: user about to be filtered
+        :param ttl: seconds the lease lasts if this node dies
+        :return:
+        True if this node holds the lease
+        """
+        self._open_db()
+        if self.redis.set(self._lease_key(user), self.node_id, nx=True, px=int(ttl * 1000)):
+            return True
+        # a lease left by this node, e.g. a job that was killed, is renewed
+        holder = self.redis.get(self._lease_key(user))
+        if holder == self.node_id:
+            self.redis.pexpire(self._lease_key(user), int(ttl * 1000))
+            return True
+        trace('%s: leased to %s', user, str(holder))
+        return False
+
+    def release(self, user):
+        self._open_db()
+        with self.redis.pipeline() as pipe:
+            try:
+                pipe.watch(self._lease_key(user))
+                if pipe.get(self._lease_key(user)) == self.node_id:
+                    pipe.multi()
+                    pipe.delete(self._lease_key(user))
+                    pipe.execute()
+            except WatchError:
+                trace('%s: lease changed hands during release', user)
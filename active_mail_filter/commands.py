@@ -206,8 +206,9 @@ def list_folders():
         sys.exit(status)
 
     for folder in sorted(data['data'], reverse=True):
-        if data['data'][folder]:
-            print_to_out('%s\n' % folder)
+        counts = data['data'][folder]
+        if counts.get('messages', 0) > 0:
+            print_to_out('%s (%d messages, %d unseen)\n' % (folder, counts['messages'], counts.get('unseen', 0)))
         else:
             print_to_out('%s (empty)\n' % folder)
 
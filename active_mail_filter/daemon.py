@@ -8,16 +8,39 @@ import logging
 import time
 
 from active_mail_filter import get_logger, read_configuration_file, trace
-from active_mail_filter.imapuser import ImapUser
-from active_mail_filter.mboxfolder import MboxFolder
+from active_mail_filter.cluster import ClusterMembership
+from active_mail_filter.folder_checkpoints import FolderCheckpoints
+from active_mail_filter.green_engine import GreenEngine, GreenMboxFolder, GreenRedisConnection
+from active_mail_filter.idle_watcher import sync_idle_watchers
+from active_mail_filter.mbox_pool import MboxPool
+from active_mail_filter.mboxfolder import OperationTimeout
+from active_mail_filter.process_pool import ProcessPool
+from active_mail_filter.metrics import Counter, Gauge, counter, histogram, register_collector
+from active_mail_filter.sender_address import address_cache_stats
+from active_mail_filter.sender_index import SenderIndex
 from active_mail_filter.user_records import UserRecords
+from active_mail_filter.rule_cache import RuleCache
+from active_mail_filter.rule_compiler import filter_user_rules, compile_rules, USER_SECONDS, USER_LAST_SECONDS
+from active_mail_filter.scheduler import UserScheduler
 from active_mail_filter.stoppable_thread import StoppableThread
-from active_mail_filter.user_records import UUID, USER, PASSWORD, MAILSERVER, EMAIL, SOURCE, TARGET
+from active_mail_filter.tracing import span, SLOW_RULES, CYCLE_PROFILER
+from active_mail_filter.worker_pool import WorkerPool, WorkerJob, run_parallel
+from active_mail_filter.user_records import UUID, USER, PASSWORD, MAILSERVER, EMAIL, SOURCE
 
 _CONF_ = read_configuration_file()
 
 logger = get_logger()
 
+# bounds on how long the scheduler sleeps, rule changes are picked up within MAX_TICK
+MIN_TICK = 0.05
+MAX_TICK = 1.0
+
+# worker_thread's result for a user another node is filtering, the user's interval is left alone
+LEASE_HELD = 'lease_held'
+
+CYCLE_SECONDS = histogram('cycle_seconds', 'Time to filter every user once')
+USER_TIMEOUTS = counter('user_timeouts_total', 'Users cut off by operation_timeout or user_timeout')
+
 
 def _get_userdb():
     if not hasattr(_get_userdb, 'userdb'):
@@ -28,24 +51,198 @@ def _get_userdb():
     return _get_userdb.userdb
 
 
-def worker_thread(rule_records):
+def _get_rule_cache():
+    if not hasattr(_get_rule_cache, 'rule_cache'):
+        _get_rule_cache.rule_cache = RuleCache(_get_userdb())
+    return _get_rule_cache.rule_cache
+
+
+def _get_sender_index():
+    if not hasattr(_get_sender_index, 'sender_index'):
+        host = os.getenv('AMF_REDIS_SERVER', _CONF_['redis_server']['redis_server_address'])
+        _get_sender_index.sender_index = SenderIndex(host=host, key=_CONF_['redis_server']['redis_key'])
+    return _get_sender_index.sender_index
+
+
+def _get_checkpoints():
+    if not hasattr(_get_checkpoints, 'checkpoints'):
+        host = os.getenv('AMF_REDIS_SERVER', _CONF_['redis_server']['redis_server_address'])
+        _get_checkpoints.checkpoints = FolderCheckpoints(host=host, key=_CONF_['redis_server']['redis_key'],
+                                                         full_sweep_interval=_CONF_.getint('filter_daemon',
+                                                                                           'full_sweep_interval'))
+    return _get_checkpoints.checkpoints
+
+
+def _get_mbox_pool():
+    if not hasattr(_get_mbox_pool, 'mbox_pool'):
+        _get_mbox_pool.mbox_pool = MboxPool(max_per_server=_CONF_.getint('filter_daemon', 'pool_max_per_server'),
+                                            idle_timeout=_CONF_.getint('filter_daemon', 'pool_idle_timeout'),
+                                            max_per_user=_CONF_.getint('filter_daemon', 'pool_max_per_user'),
+                                            op_timeout=_CONF_.getint('filter_daemon', 'operation_timeout'),
+                                            max_watchers_per_server=_CONF_.getint('filter_daemon',
+                                                                                  'idle_max_per_server'),
+                                            max_watchers_per_user=_CONF_.getint('filter_daemon', 'idle_max_per_user'))
+    return _get_mbox_pool.mbox_pool
+
+
+def _get_worker_pool():
+    if not hasattr(_get_worker_pool, 'worker_pool'):
+        kwargs = {'max_workers': _CONF_.getint('filter_daemon', 'max_workers'),
+                  'max_per_server': _CONF_.getint('filter_daemon', 'max_workers_per_server'),
+                  'backoff': _CONF_.getint('filter_daemon', 'retry_backoff'),
+                  'max_backoff': _CONF_.getint('filter_daemon', 'retry_backoff_max')}
+        processes = _CONF_.getint('filter_daemon', 'worker_processes')
+        if processes > 0:
+            _get_worker_pool.worker_pool = ProcessPool(worker_thread, processes=processes,
+                                                       hung_timeout=_hung_timeout(),
+                                                       initializer=_init_worker_process,
+                                                       report=_worker_process_report, **kwargs)
+        else:
+            _get_worker_pool.worker_pool = WorkerPool(worker_thread, **kwargs)
+    return _get_worker_pool.worker_pool
+
+
+def _get_scheduler():
+    if not hasattr(_get_scheduler, 'scheduler'):
+        stale_timeout = 2 * (_CONF_.getint('filter_daemon', 'user_timeout') +
+                             2 * _CONF_.getint('filter_daemon', 'operation_timeout'))
+        _get_scheduler.scheduler = UserScheduler(interval=_CONF_.getfloat('filter_daemon', 'poll_interval'),
+                                                 min_interval=_CONF_.getfloat('filter_daemon', 'min_interval'),
+                                                 max_interval=_CONF_.getfloat('filter_daemon', 'max_interval'),
+                                                 jitter=_CONF_.getfloat('filter_daemon', 'schedule_jitter'),
+                                                 provider_rate=_CONF_.getfloat('filter_daemon', 'provider_rate'),
+                                                 stale_timeout=stale_timeout)
+    return _get_scheduler.scheduler
+
+
+def _get_cluster():
+    # None unless cluster_mode is on
+    if not hasattr(_get_cluster, 'cluster'):
+        _get_cluster.cluster = None
+        if _CONF_.getboolean('filter_daemon', 'cluster_mode'):
+            host = os.getenv('AMF_REDIS_SERVER', _CONF_['redis_server']['redis_server_address'])
+            _get_cluster.cluster = ClusterMembership(host=host, key=_CONF_['redis_server']['redis_key'],
+                                                     node_id=os.getenv('AMF_NODE_ID',
+                                                                       _CONF_['filter_daemon']['node_id']) or None,
+                                                     heartbeat=_CONF_.getfloat('filter_daemon', 'cluster_heartbeat'),
+                                                     node_timeout=_CONF_.getfloat('filter_daemon',
+                                                                                  'cluster_node_timeout'))
+    return _get_cluster.cluster
+
+
+def _get_green_engine():
+    # the engine's redis and imap connections are its own, on gevent sockets, so waiting
+    # on either yields to the other greenlets instead of blocking the whole loop
+    if not hasattr(_get_green_engine, 'green_engine'):
+        host = os.getenv('AMF_REDIS_SERVER', _CONF_['redis_server']['redis_server_address'])
+        key = _CONF_['redis_server']['redis_key']
+        max_per_server = _CONF_.getint('filter_daemon', 'pool_max_per_server')
+        mbox_pool = MboxPool(max_per_server=max_per_server,
+                             idle_timeout=_CONF_.getint('filter_daemon', 'pool_idle_timeout'),
+                             max_per_user=_CONF_.getint('filter_daemon', 'pool_max_per_user'),
+                             op_timeout=_CONF_.getint('filter_daemon', 'operation_timeout'),
+                             mailbox_class=GreenMboxFolder)
+        lease = None
+        if _get_cluster() is not None:
+            lease = ClusterMembership(host=host, key=key, node_id=_get_cluster().node_id,
+                                      connection_class=GreenRedisConnection)
+        _get_green_engine.green_engine = GreenEngine(
+            sender_index=SenderIndex(host=host, key=key, connection_class=GreenRedisConnection),
+            checkpoints=FolderCheckpoints(host=host, key=key,
+                                          full_sweep_interval=_CONF_.getint('filter_daemon', 'full_sweep_interval'),
+                                          connection_class=GreenRedisConnection),
+            concurrency=_CONF_.getint('filter_daemon', 'green_concurrency'),
+            max_per_server=max_per_server,
+            user_timeout=_CONF_.getint('filter_daemon', 'user_timeout'),
+            mbox_pool=mbox_pool,
+            lease=lease,
+            backoff=_CONF_.getint('filter_daemon', 'retry_backoff'),
+            max_backoff=_CONF_.getint('filter_daemon', 'retry_backoff_max'))
+    return _get_green_engine.green_engine
+
+
+def _api_deadline():
+    # an API request waits for a pooled connection no longer than one IMAP operation
+    return time.time() + _CONF_.getint('filter_daemon', 'operation_timeout')
+
+
+def _check_login(mail_server, user, password):
+    # borrowing logs in unless a pooled session with the same password exists
+    with _get_mbox_pool().connection(mail_server, user, password, deadline=_api_deadline()):
+        pass
+
+
+def _filter_rule_group(rule_records, is_stopped=None, deadline=None):
+    # a connection already SELECTed on the group's source folder is preferred, a timed out
+    # connection leaves the with block by exception and is dropped rather than pooled
+    rule = rule_records[0]
+    with _get_mbox_pool().connection(rule[MAILSERVER], rule[USER], rule[PASSWORD], folder=rule[SOURCE],
+                                     deadline=deadline) as mailbox:
+        return filter_user_rules(mailbox, rule_records, sender_index=_get_sender_index(),
+                                 checkpoints=_get_checkpoints(), is_stopped=is_stopped)
+
+
+def _filter_user(rule_records, deadline=None):
     my_thread = StoppableThread.current_thread()
-    mailbox = None if len(rule_records) == 0 else MboxFolder(rule_records[0][MAILSERVER],
-                                                             rule_records[0][USER],
-                                                             rule_records[0][PASSWORD])
-    for rule in rule_records:
-        if my_thread.is_stopped():
-            break
+    logger.debug('%s: running %d rules on %s', rule_records[0][USER], len(rule_records), rule_records[0][MAILSERVER])
+    parallelism = _CONF_.getint('filter_daemon', 'user_parallelism')
+    groups = [compiled.rules for compiled in compile_rules(rule_records)]
+    if parallelism <= 1 or len(groups) <= 1:
+        return _filter_rule_group(rule_records, is_stopped=my_thread.is_stopped, deadline=deadline)
+
+    # one connection per source folder group, the pool caps the account at pool_max_per_user
+    moved = []
+    errors = run_parallel(lambda group: moved.append(_filter_rule_group(group, is_stopped=my_thread.is_stopped,
+                                                                        deadline=deadline)),
+                          groups, parallelism, name=my_thread.getName(), is_stopped=my_thread.is_stopped)
+    for group, e in errors:
+        logger.error('%s: filtering %s failed, %s', group[0][USER], group[0][SOURCE], str(e))
+    # a timeout means the account is too slow for its budget, any failure backs the user off as
+    # it would on the serial path
+    timeouts = [e for group, e in errors if isinstance(e, OperationTimeout)]
+    if len(timeouts) > 0:
+        raise timeouts[0]
+    if len(errors) > 0:
+        raise errors[0][1]
+    return sum(moved)
 
-        logger.debug('%s: moving %s to %s on %s', rule[USER], rule[SOURCE], rule[TARGET], rule[MAILSERVER])
-        imap = ImapUser(mailbox, to_folder=rule[TARGET], from_folder=rule[SOURCE])
-        cnt, moved_uids = imap.filter_mail()
-        if cnt > 0:
-            logger.info('%s: moved %d messages %s', my_thread.getName(), cnt, str(moved_uids))
-        del imap
 
-    if mailbox is not None:
-        mailbox.disconnect()
+def worker_thread(rule_records):
+    if len(rule_records) == 0:
+        return 0
+
+    # while the ring is changing two nodes may both think they own a user, the lease decides
+    cluster = _get_cluster()
+    if cluster is not None and not cluster.acquire(rule_records[0][USER], _hung_timeout()):
+        logger.debug('%s: being filtered by another node', rule_records[0][USER])
+        return LEASE_HELD
+
+    start = time.time()
+    user_timeout = _CONF_.getint('filter_daemon', 'user_timeout')
+    try:
+        with span('user', user=rule_records[0][USER]):
+            return CYCLE_PROFILER.profile_call(_filter_user, rule_records, deadline=start + user_timeout)
+    except OperationTimeout as e:
+        logger.warning('%s: cut off after %.1fs of its %ds budget, %s', rule_records[0][USER], time.time() - start,
+                       user_timeout, str(e))
+        USER_TIMEOUTS.inc()
+        raise
+    finally:
+        USER_SECONDS.observe(time.time() - start)
+        USER_LAST_SECONDS.set(time.time() - start, user=rule_records[0][USER])
+        if cluster is not None:
+            cluster.release(rule_records[0][USER])
+
+
+def _init_worker_process():
+    # connections the supervisor opened, e.g. to check a login, stay with it
+    if hasattr(_get_mbox_pool, 'mbox_pool'):
+        del _get_mbox_pool.mbox_pool
+
+
+def _worker_process_report():
+    # what _collect_metrics() reads from the pools and caches of a worker process
+    return {'pool': _get_mbox_pool().stats(), 'address_cache': address_cache_stats()}
 
 
 def sort_by_user(records):
@@ -60,43 +257,231 @@ def sort_by_user(records):
     return sorted_users
 
 
+def _get_all_users():
+    # in cluster mode only the users hashed to this node
+    users = _get_rule_cache().get_all_users()
+    cluster = _get_cluster()
+    return users if cluster is None else cluster.owned_records(users, user_field=USER)
+
+
+def cluster_heartbeat():
+    my_thread = StoppableThread.current_thread()
+    cluster = _get_cluster()
+    while not my_thread.is_stopped():
+        my_thread.wait(cluster.heartbeat_interval)
+        try:
+            cluster.heartbeat()
+        except Exception as e:
+            logger.error('cluster heartbeat failed, %s', str(e))
+    try:
+        cluster.leave()
+    except Exception as e:
+        logger.error('leaving the cluster failed, %s', str(e))
+
+
+def _start_cluster():
+    # the first heartbeat builds the ring before any user is filtered
+    cluster = _get_cluster()
+    if cluster is None:
+        return
+    cluster.heartbeat()
+    logger.info('%s: joined cluster of %d nodes', cluster.node_id, len(cluster.ring.nodes))
+    th = StoppableThread(name='cluster_heartbeat', target=cluster_heartbeat)
+    th.setDaemon(True)
+    th.start()
+
+
+def _hung_timeout():
+    # jobs end at their deadline, a worker is only killed if one is stuck well past it
+    return _CONF_.getint('filter_daemon', 'user_timeout') + 2 * _CONF_.getint('filter_daemon', 'operation_timeout')
+
+
 def run_all_workers(users_jobs):
-    mail_threads = []
-    for u in users_jobs.keys():
-        th = StoppableThread(name=u, target=worker_thread, args=(users_jobs[u],))
-        mail_threads.append(th)
-        th.start()
-
-    is_alive = True
-    while is_alive:
-        for th in mail_threads:
-            th.join(5)
-            if th.is_alive():
-                trace('%s: is still alive' % th.getName())
-                if th.elapsed_time() > 900:
-                    th.kill()
-                    logger.error('%s: Thread appears hung, killing', th.getName())
-                    mail_threads.remove(th)
-                break
-        else:
-            is_alive = False
+    my_thread = StoppableThread.current_thread()
+    jobs = [WorkerJob(u, users_jobs[u][0][MAILSERVER], users_jobs[u]) for u in users_jobs.keys()]
+    worker_pool = _get_worker_pool()
+    worker_pool.submit(jobs)
+    worker_pool.wait(hung_timeout=_hung_timeout(), is_stopped=my_thread.is_stopped)
+
+    stats = worker_pool.stats()
+    logger.debug('worker pool: %d workers, queue depth %d, max wait %.3fs, avg wait %.3fs',
+                 stats['workers'], stats['queue_depth'], stats['max_wait'], stats['avg_wait'])
+
+
+def _job_completed(job):
+    if job.cancelled:
+        _get_scheduler().cancelled(job.name)
+        return
+    moved = None if job.result == LEASE_HELD else job.result or 0
+    _get_scheduler().completed(job.name, moved=moved, retry_at=job.retry_at if job.failed else None)
+
+
+def _sync_schedule(use_idle, sweep_interval):
+    users = _get_all_users()
+    min_intervals = {}
+    if use_idle and len(users) > 0:
+        # users whose every source folder has an idle watcher only need an occasional sweep
+        polled = set(rec[USER] for rec in sync_idle_watchers(users, sender_index=_get_sender_index(),
+                                                             mbox_pool=_get_mbox_pool()))
+        min_intervals = dict((rec[USER], sweep_interval) for rec in users if rec[USER] not in polled)
+    _get_scheduler().sync(sort_by_user(users), min_intervals=min_intervals)
+
+
+def run_scheduled_workers(use_idle, poll_interval, sweep_interval):
+    """
+    Start each user when its own next run time comes instead of all users at once, rules
+    are reloaded when they change and at least every poll_interval
+    :param use_idle: filter_mode is idle
+    :param poll_interval: seconds between rule reloads, also the first interval of a new user
+    :param sweep_interval: shortest interval of a user covered by idle watchers
+    :return:
+    """
+    my_thread = StoppableThread.current_thread()
+    scheduler = _get_scheduler()
+    worker_pool = _get_worker_pool()
+    cluster = _get_cluster()
+    generation = None
+    last_sync = 0
+    profile_until = None
+    while not my_thread.is_stopped():
+        # a node joining or leaving the cluster changes which users this node runs
+        rebalanced = cluster is not None and cluster.generation != generation
+        if rebalanced or _get_rule_cache().refresh() or time.time() - last_sync >= poll_interval:
+            generation = cluster.generation if cluster is not None else None
+            last_sync = time.time()
+            _sync_schedule(use_idle, sweep_interval)
+            worker_pool.kill_hung_workers(_hung_timeout())
+            _get_mbox_pool().evict_idle()
+
+        # without cycles a profile covers the users started during one poll_interval
+        if profile_until is None:
+            CYCLE_PROFILER.begin_cycle()
+            if CYCLE_PROFILER.active:
+                profile_until = time.time() + poll_interval
+        elif time.time() >= profile_until:
+            CYCLE_PROFILER.end_cycle()
+            profile_until = None
+
+        due = scheduler.due()
+        if len(due) > 0:
+            worker_pool.submit([WorkerJob(u.name, u.server, u.records, on_done=_job_completed) for u in due])
+        wakeup = scheduler.next_wakeup()
+        my_thread.wait(min(max(wakeup if wakeup is not None else poll_interval, MIN_TICK), MAX_TICK))
+    if profile_until is not None:
+        CYCLE_PROFILER.end_cycle()
 
 
 def run_mail_daemon():
     my_thread = StoppableThread.current_thread()
+    use_idle = _CONF_['filter_daemon']['filter_mode'].lower() == 'idle'
+    poll_interval = _CONF_.getfloat('filter_daemon', 'poll_interval')
+    sweep_interval = _CONF_.getfloat('filter_daemon', 'idle_sweep_interval')
+    use_green = _CONF_['filter_daemon']['engine'].lower() == 'gevent'
+    _start_cluster()
+    if use_green and _CONF_['filter_daemon']['scheduler'].lower() == 'adaptive':
+        logger.info('engine = gevent runs every user each cycle, scheduler = adaptive is not used')
+    if not use_green and _CONF_['filter_daemon']['scheduler'].lower() == 'adaptive':
+        # returns once the thread is stopped, the cycle loop below is then skipped
+        run_scheduled_workers(use_idle, poll_interval, sweep_interval)
+    last_sweep = 0
     while not my_thread.is_stopped():
-        users = _get_userdb().get_all_users()
+        users = _get_all_users()
+        if use_idle and len(users) > 0:
+            # rules with an idle watcher only need an occasional sweep for manually filed mail
+            poll_users = sync_idle_watchers(users, sender_index=_get_sender_index(), mbox_pool=_get_mbox_pool())
+            if time.time() - last_sweep >= sweep_interval:
+                last_sweep = time.time()
+            else:
+                users = poll_users
+
         if len(users) > 0:
             mail_users = sort_by_user(users)
             start = time.time()
-            run_all_workers(mail_users)
+            CYCLE_PROFILER.begin_cycle()
+            try:
+                if use_green:
+                    # greenlets share this thread, the whole cycle is profiled at once
+                    CYCLE_PROFILER.profile_call(_get_green_engine().run, mail_users, is_stopped=my_thread.is_stopped)
+                else:
+                    run_all_workers(mail_users)
+            finally:
+                CYCLE_PROFILER.end_cycle()
+            CYCLE_SECONDS.observe(time.time() - start)
             logger.debug('run_all_workers elaspsed time = %f', time.time() - start)
         else:
             logger.debug('No user records found')
-        my_thread.wait(60.0)
+        _get_mbox_pool().evict_idle()
+        if use_green:
+            _get_green_engine().mbox_pool.evict_idle()
+        my_thread.wait(poll_interval)
+    _get_worker_pool().stop()
+    _get_mbox_pool().close_all()
+    if use_green:
+        _get_green_engine().close_all()
     logger.info('filter_daemon: exiting')
 
 
+def _process_stats():
+    # with worker processes each one has its own connections and address cache
+    pools = [_get_mbox_pool().stats()]
+    if hasattr(_get_green_engine, 'green_engine'):
+        pools.append(_get_green_engine().mbox_pool.stats())
+    cache = address_cache_stats()
+    worker_pool = _get_worker_pool()
+    if isinstance(worker_pool, ProcessPool):
+        for report in worker_pool.reports():
+            pools.append(report['pool'])
+            for key in cache.keys():
+                cache[key] += report['address_cache'][key]
+
+    pool = {}
+    for stats in pools:
+        for host, counts in stats.items():
+            total = pool.setdefault(host, {'open': 0, 'idle': 0, 'watching': 0})
+            for state in total.keys():
+                total[state] += counts.get(state, 0)
+    return pool, cache
+
+
+def _collect_metrics():
+    # values read at scrape time from the pools and caches that already keep them
+    pool_stats, cache_stats = _process_stats()
+    pool = Gauge('pool_connections', 'Pooled IMAP connections', labels=('server', 'state'))
+    for host, stats in pool_stats.items():
+        pool.set(stats['open'] - stats['idle'], server=host, state='borrowed')
+        pool.set(stats['idle'], server=host, state='idle')
+        pool.set(stats['watching'], server=host, state='watching')
+
+    stats = _get_worker_pool().stats()
+    workers = Gauge('worker_threads', 'Worker pool threads alive')
+    workers.set(stats['workers'])
+    queue = Gauge('worker_queue_depth', 'Users waiting for a worker thread')
+    queue.set(stats['queue_depth'])
+    running = Gauge('worker_jobs_running', 'Users being filtered', labels=('server',))
+    for host, count in stats['running'].items():
+        running.set(count, server=host)
+    backing_off = Gauge('worker_users_backing_off', 'Users left out of the queue after a failure')
+    backing_off.set(stats['backing_off'])
+
+    stats = _get_scheduler().stats()
+    scheduled = Gauge('scheduled_users', 'Users on the adaptive schedule', labels=('state',))
+    scheduled.set(stats['running'], state='running')
+    scheduled.set(stats['users'] - stats['running'], state='waiting')
+    interval = Gauge('schedule_interval_seconds', 'Interval between runs of scheduled users', labels=('stat',))
+    for stat in ('min', 'avg', 'max'):
+        interval.set(stats['%s_interval' % stat], stat=stat)
+
+    cache_size = Gauge('address_cache_entries', 'From headers held in the parsed address cache')
+    cache_size.set(cache_stats['size'])
+    cache = Counter('address_cache_lookups_total', 'Parsed address cache lookups', labels=('result',))
+    cache.inc(cache_stats['hits'], result='hit')
+    cache.inc(cache_stats['misses'], result='miss')
+    return [pool, workers, queue, running, backing_off, scheduled, interval, cache_size, cache]
+
+
+register_collector('daemon', _collect_metrics)
+
+
 def start_daemon_thread():
     try:
         StoppableThread.find_by_name('filter_daemon')
@@ -162,7 +547,12 @@ class DaemonAlreadyStopped(Exception):
 
 
 def get_server_status():
-    return {'data': list_all_threads()}
+    status = {'data': list_all_threads(), 'workers': _get_worker_pool().stats()}
+    cluster = _get_cluster()
+    if cluster is not None:
+        status['cluster'] = {'node_id': cluster.node_id, 'nodes': list(cluster.ring.nodes),
+                             'last_heartbeat': cluster.last_heartbeat}
+    return status
 
 
 def server_status_update(debug='false'):
@@ -188,7 +578,8 @@ def server_start():
 def server_stop():
     try:
         th = stop_daemon_thread()
-        th.join()
+        # a filter in progress notices the stop between commands, each bounded by operation_timeout
+        th.join(_CONF_.getint('filter_daemon', 'operation_timeout'))
     except DaemonAlreadyStopped:
         return 'server already stopped', 400
 
@@ -196,7 +587,7 @@ def server_stop():
 
 
 def user_records_list():
-    users = _get_userdb().get_all_users()
+    users = _get_rule_cache().get_all_users()
     email_info = {}
     for u in users:
         email = u[EMAIL]
@@ -209,7 +600,7 @@ def user_records_list():
 
 def user_record_get_by_uuid(uuid):
     try:
-        user_record = _get_userdb().get_user_by_uuid(uuid)
+        user_record = _get_rule_cache().get_user_by_uuid(uuid)
         del user_record[PASSWORD]
     except Exception as e:
         logger.error('get failed, %s', e.message)
@@ -220,8 +611,7 @@ def user_record_get_by_uuid(uuid):
 
 def user_record_add(user, email, password, mail_server, source, target):
     try:
-        mbox = MboxFolder(mail_server, user, password)
-        mbox.disconnect()
+        _check_login(mail_server, user, password)
 
         uuid = _get_userdb().add_user(user=user, email=email, password=password,
                                       mail_server=mail_server, source=source, target=target)
@@ -237,8 +627,7 @@ def user_record_add(user, email, password, mail_server, source, target):
 def user_record_delete(uuid, password):
     try:
         user_record = _get_userdb().get_user_by_uuid(uuid)
-        mbox = MboxFolder(user_record[MAILSERVER], user_record[USER], password)
-        mbox.disconnect()
+        _check_login(user_record[MAILSERVER], user_record[USER], password)
         logger.debug('delete %s/%s', user_record[USER], user_record[UUID])
         _get_userdb().del_record(uuid)
     except Exception as e:
@@ -254,8 +643,7 @@ def user_record_update(uuid, **kwargs):
         for key in kwargs.keys():
             user_record[key] = kwargs[key]
 
-        mbox = MboxFolder(user_record[MAILSERVER], user_record[USER], user_record[PASSWORD])
-        mbox.disconnect()
+        _check_login(user_record[MAILSERVER], user_record[USER], user_record[PASSWORD])
 
         _get_userdb().update_user(record_uuid=uuid, user_record=user_record)
         del user_record[PASSWORD]
@@ -269,9 +657,9 @@ def user_record_update(uuid, **kwargs):
 def folder_list_by_uuid(uuid):
     try:
         user_record = _get_userdb().get_user_by_uuid(uuid)
-        mbox = MboxFolder(user_record[MAILSERVER], user_record[USER], user_record[PASSWORD])
-        folder_dict = mbox.list_folder_counts()
-        mbox.disconnect()
+        with _get_mbox_pool().connection(user_record[MAILSERVER], user_record[USER], user_record[PASSWORD],
+                                         deadline=_api_deadline()) as mbox:
+            folder_dict = mbox.list_folder_counts()
     except Exception as e:
         logger.error('get folders failed, %s', e.message)
         return 'get folders failed, {}'.format(e.message), 404
@@ -281,11 +669,35 @@ def folder_list_by_uuid(uuid):
 
 def folder_list_by_user(user, password, mail_server):
     try:
-        mbox = MboxFolder(mail_server, user, password)
-        folder_dict = mbox.list_folder_counts()
-        mbox.disconnect()
+        with _get_mbox_pool().connection(mail_server, user, password, deadline=_api_deadline()) as mbox:
+            folder_dict = mbox.list_folder_counts()
     except Exception as e:
         logger.error('list folders failed, %s', str(e.message))
         return 'list folders failed, {}'.format(str(e.message)), 404
 
     return {'data': folder_dict}
+
+
+def get_slow_rules(count=None):
+    return {'data': SLOW_RULES.top(count)}
+
+
+def profile_start():
+    CYCLE_PROFILER.arm()
+    return {'data': 'the next filter cycle will be profiled'}, 201
+
+
+def profile_get(sort='cumulative', output='text'):
+    if output == 'pstats':
+        data = CYCLE_PROFILER.dump()
+        content_type = 'application/octet-stream'
+    else:
+        try:
+            data = CYCLE_PROFILER.report(sort=sort)
+        except KeyError:
+            return 'unknown sort key %s' % sort, 400
+        content_type = 'text/plain'
+
+    if data is None:
+        return 'no profiled cycle, start one with POST /api/profile', 404
+    return data, 200, {'Content-Type': content_type}
@@ -0,0 +1,121 @@
+# Copyright (c) 2016, Kevin Rodgers
+# Released subject to the New BSD License
+# Please see http://en.wikipedia.org/wiki/BSD_licenses
+
+import time
+import redis
+from active_mail_filter import get_logger
+from active_mail_filter.simple_db import SimpleRedisDb
+
+logger = get_logger()
+
+UIDVALIDITY = 'uidvalidity'
+UIDNEXT = 'uidnext'
+HIGHESTMODSEQ = 'highestmodseq'
+TARGETS = 'targets'
+LAST_FULL = 'last_full'
+
+DEF_FULL_SWEEP_INTERVAL = 3600
+
+
+class FolderCheckpoints(SimpleRedisDb):
+    def __init__(self, host, key, port=6379, full_sweep_interval=DEF_FULL_SWEEP_INTERVAL,
+                 connection_class=redis.Connection):
+        """
+        Where the last filter pass of each (user, source folder) stopped, so the next pass
+        only looks at UIDs that arrived since
+
+        :param host: database host
+        :param port: database port default 6397
+        :param key: prefix for the checkpoint keys, normally the redis_key from the configuration
+        :param full_sweep_interval: seconds between passes over the whole folder, 0 always sweeps
+        :param connection_class: redis connection class, e.g. GreenRedisConnection under gevent
+        """
+        SimpleRedisDb.__init__(self, host=host, key=key, port=port, connection_class=connection_class)
+        self.full_sweep_interval = full_sweep_interval
+
+    def __str__(self):
+        return 'FolderCheckpoints [host=%s, port=%d, key=%s, full_sweep_interval=%d]' % \
+               (self.host, self.port, self.key, self.full_sweep_interval)
+
+    def _checkpoint_key(self, user, folder_name):
+        if folder_name.lower() == 'inbox':
+            folder_name = folder_name.lower()
+        return '%s:checkpoint:%s:%s' % (self.key, user, folder_name)
+
+    @staticmethod
+    def status_items(mailbox):
+        return 'UIDNEXT UIDVALIDITY HIGHESTMODSEQ' if mailbox.has_capability('CONDSTORE') else 'UIDNEXT UIDVALIDITY'
+
+    def get_checkpoint(self, user, folder_name):
+        """
+        :param user: imap login name
+        :param folder_name: source folder
+        :return:
+        dictionary of the saved checkpoint, empty if the folder has never been filtered
+        """
+        self._open_db()
+        saved = self.redis.hgetall(self._checkpoint_key(user, folder_name))
+        checkpoint = dict((k, int(saved[k])) for k in (UIDVALIDITY, UIDNEXT, HIGHESTMODSEQ, LAST_FULL) if k in saved)
+        if TARGETS in saved:
+            checkpoint[TARGETS] = saved[TARGETS]
+        return checkpoint
+
+    def save_checkpoint(self, user, folder_name, status, targets, full_sweep=False):
+        """
+        Record the folder STATUS read before a successful filter pass
+        :param user: imap login name
+        :param folder_name: source folder
+        :param status: dictionary from MboxFolder.folder_status
+        :param targets: list of target folders the pass filtered into
+        :param full_sweep: the pass covered every message in the folder
+        :return:
+        """
+        self._open_db()
+        checkpoint = {UIDVALIDITY: status.get('UIDVALIDITY', 0),
+                      UIDNEXT: status.get('UIDNEXT', 0),
+                      HIGHESTMODSEQ: status.get('HIGHESTMODSEQ', 0),
+                      TARGETS: ','.join(targets)}
+        if full_sweep:
+            checkpoint[LAST_FULL] = int(time.time())
+        self.redis.hmset(self._checkpoint_key(user, folder_name), checkpoint)
+
+    def clear(self, user, folder_name):
+        self._open_db()
+        self.redis.delete(self._checkpoint_key(user, folder_name))
+
+    def needs_full_sweep(self, checkpoint, status, targets):
+        """
+        A folder is swept in full when it has no checkpoint, its UIDVALIDITY changed, its
+        rules changed or the full sweep interval has passed
+        :param checkpoint: dictionary from get_checkpoint
+        :param status: dictionary from MboxFolder.folder_status
+        :param targets: list of target folders for the coming pass
+        :return:
+        reason for the full sweep or None
+        """
+        if UIDNEXT not in checkpoint or 'UIDNEXT' not in status:
+            return 'no checkpoint'
+        if checkpoint.get(UIDVALIDITY) != status.get('UIDVALIDITY', 0):
+            return 'uidvalidity changed'
+        if checkpoint.get(TARGETS) != ','.join(targets):
+            return 'rules changed'
+        if time.time() - checkpoint.get(LAST_FULL, 0) >= self.full_sweep_interval:
+            return 'full sweep interval'
+        return None
+
+    @staticmethod
+    def new_uid_range(checkpoint, status):
+        """
+        UIDs that arrived since the checkpoint, flag changes and expunges raise HIGHESTMODSEQ
+        without adding messages so UIDNEXT decides when it moved
+        :param checkpoint: dictionary from get_checkpoint
+        :param status: dictionary from MboxFolder.folder_status
+        :return:
+        UID set string or None when no message has arrived
+        """
+        if 'HIGHESTMODSEQ' in status and checkpoint.get(HIGHESTMODSEQ) == status['HIGHESTMODSEQ']:
+            return None
+        if status['UIDNEXT'] <= checkpoint[UIDNEXT]:
+            return None
+        return '%d:%d' % (checkpoint[UIDNEXT], status['UIDNEXT'] - 1)
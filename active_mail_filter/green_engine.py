@@ -0,0 +1,228 @@
+# Copyright (c) 2016, Kevin Rodgers
+# Released subject to the New BSD License
+# Please see http://en.wikipedia.org/wiki/BSD_licenses
+
+import time
+import socket
+import imaplib
+import redis
+import gevent
+import gevent.pool
+import gevent.lock
+from gevent import socket as green_socket
+from gevent import ssl as green_ssl
+from active_mail_filter import get_logger, trace
+from active_mail_filter.mbox_pool import MboxPool
+from active_mail_filter.mboxfolder import MboxFolder, TimeoutIMAP4, TimeoutIMAP4_SSL, SocketReader, OperationTimeout, \
+    parse_server, DEF_OPERATION_TIMEOUT
+from active_mail_filter.rule_compiler import filter_user_rules, USER_SECONDS, USER_LAST_SECONDS
+from active_mail_filter.user_records import USER, PASSWORD, MAILSERVER, SOURCE
+
+logger = get_logger()
+
+DEF_CONCURRENCY = 500
+DEF_MAX_PER_SERVER = 10
+DEF_USER_TIMEOUT = 900
+DEF_BACKOFF = 60
+DEF_MAX_BACKOFF = 3600
+STOP_POLL = 1.0
+
+
+class GreenRedisConnection(redis.Connection):
+    """
+    redis connection on a gevent socket, a command waiting on redis yields to the other
+    greenlets and can be cut off by gevent.Timeout, pass it as connection_class
+    """
+    def _connect(self):
+        sock = green_socket.create_connection((self.host, self.port), self.socket_connect_timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(self.socket_timeout)
+        return sock
+
+
+def _interruptible(imap, func, *args):
+    # a greenlet killed or timed out part way through a reply leaves the rest on the socket,
+    # the connection is closed as one whose read timed out and later calls fail at once
+    try:
+        return func(imap, *args)
+    except (gevent.GreenletExit, gevent.Timeout, OperationTimeout):
+        if imap.timed_out is None:
+            imap.timed_out = '%s: interrupted' % imap.host
+            try:
+                imap.sock.close()
+            except Exception as e:
+                trace('%s: close failed, %s', imap.host, str(e))
+        raise
+
+
+class GreenIMAP4(TimeoutIMAP4):
+    """
+    TimeoutIMAP4 on a gevent socket, a command waiting on the server yields to other greenlets
+    """
+    def open(self, host='', port=imaplib.IMAP4_PORT):
+        self.host = host
+        self.port = port
+        self.sock = green_socket.create_connection((host, port), self.timeout)
+        self.file = SocketReader(self.sock)
+
+    def read(self, size):
+        return _interruptible(self, TimeoutIMAP4.read, size)
+
+    def readline(self):
+        return _interruptible(self, TimeoutIMAP4.readline)
+
+    def send(self, data):
+        return _interruptible(self, TimeoutIMAP4.send, data)
+
+
+class GreenIMAP4_SSL(TimeoutIMAP4_SSL):
+    """
+    TimeoutIMAP4_SSL on a gevent socket
+    """
+    def open(self, host='', port=imaplib.IMAP4_SSL_PORT):
+        self.host = host
+        self.port = port
+        self.sock = green_socket.create_connection((host, port), self.timeout)
+        self.sslobj = green_ssl.wrap_socket(self.sock, self.keyfile, self.certfile)
+        self.file = SocketReader(self.sslobj)
+
+    def read(self, size):
+        return _interruptible(self, TimeoutIMAP4_SSL.read, size)
+
+    def readline(self):
+        return _interruptible(self, TimeoutIMAP4_SSL.readline)
+
+    def send(self, data):
+        return _interruptible(self, TimeoutIMAP4_SSL.send, data)
+
+
+class GreenMboxFolder(MboxFolder):
+    """
+    MboxFolder whose connection yields to other greenlets instead of blocking the thread
+    """
+    def __str__(self):
+        return 'GreenMboxFolder [host=' + self.host + ', username=' + self.username + \
+               ', imap=' + str(self.imap) + ']'
+
+    def _open_imap(self):
+        host, port, use_ssl = parse_server(self.host)
+        if use_ssl:
+            return GreenIMAP4_SSL(host, port, timeout=self.operation_timeout())
+        return GreenIMAP4(host, port, timeout=self.operation_timeout())
+
+
+class GreenEngine(object):
+    def __init__(self, sender_index=None, checkpoints=None, concurrency=DEF_CONCURRENCY,
+                 max_per_server=DEF_MAX_PER_SERVER, op_timeout=DEF_OPERATION_TIMEOUT, user_timeout=DEF_USER_TIMEOUT,
+                 mbox_pool=None, lease=None, backoff=DEF_BACKOFF, max_backoff=DEF_MAX_BACKOFF):
+        """
+        Runs every user's rules as greenlets on one event loop, connections are kept
+        between cycles in an MboxPool of GreenMboxFolder
+
+        Nothing is monkey patched, only I/O on gevent sockets yields: give sender_index,
+        checkpoints and lease connection_class=GreenRedisConnection or each redis call
+        stalls every greenlet. The engine runs in the daemon's cycle loop, the adaptive
+        scheduler is not used with it.
+
+        :param sender_index: optional SenderIndex used to find each target's senders
+        :param checkpoints: optional FolderCheckpoints, only mail that arrived since the last pass is filtered
+        :param concurrency: most users being filtered at once
+        :param max_per_server: most users being filtered at once against one mail server and,
+        without mbox_pool, the pool's max_per_server
+        :param op_timeout: seconds allowed for a single IMAP command when the pool is made here
+        :param user_timeout: seconds allowed for all of one user's rules
+        :param mbox_pool: optional MboxPool whose mailbox_class is GreenMboxFolder
+        :param lease: optional ClusterMembership, a user leased by another node is skipped
+        :param backoff: seconds a user whose filter failed is skipped, doubled on each failure in a row
+        :param max_backoff: longest a failing user is skipped
+        """
+        self.sender_index = sender_index
+        self.checkpoints = checkpoints
+        self.concurrency = concurrency
+        self.max_per_server = max_per_server
+        self.user_timeout = user_timeout
+        self.mbox_pool = mbox_pool
+        if self.mbox_pool is None:
+            self.mbox_pool = MboxPool(max_per_server=max_per_server, op_timeout=op_timeout,
+                                      mailbox_class=GreenMboxFolder)
+        self.lease = lease
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.semaphores = {}
+        self.failures = {}
+
+    def __str__(self):
+        return 'GreenEngine [concurrency=%d, max_per_server=%d, pool=%s]' % \
+               (self.concurrency, self.max_per_server, str(self.mbox_pool))
+
+    def _hard_timeout(self):
+        # the deadline bounds each IMAP command, this also bounds the redis calls between them
+        return self.user_timeout + 2 * self.mbox_pool.op_timeout
+
+    def _failed(self, user):
+        count = self.failures.get(user, (0, 0))[0] + 1
+        delay = min(self.max_backoff, self.backoff * 2 ** (count - 1))
+        self.failures[user] = (count, time.time() + delay)
+        logger.warning('%s: failed %d times in a row, retrying in %ds', user, count, delay)
+
+    def _filter_user(self, rule_records, is_stopped=None):
+        rule = rule_records[0]
+        if self.lease is not None and not self.lease.acquire(rule[USER], self._hard_timeout()):
+            logger.debug('%s: being filtered by another node', rule[USER])
+            return
+        if rule[MAILSERVER] not in self.semaphores:
+            self.semaphores[rule[MAILSERVER]] = gevent.lock.BoundedSemaphore(self.max_per_server)
+
+        # with no more users on a server than the pool allows it connections, borrow() finds
+        # a free or idle slot and never waits, a wait would block the event loop
+        try:
+            with self.semaphores[rule[MAILSERVER]]:
+                start = time.time()
+                try:
+                    with gevent.Timeout(self._hard_timeout(), OperationTimeout('%s: timed out' % rule[USER])):
+                        with self.mbox_pool.connection(rule[MAILSERVER], rule[USER], rule[PASSWORD],
+                                                       folder=rule[SOURCE], deadline=start + self.user_timeout) \
+                                as mailbox:
+                            logger.debug('%s: running %d rules on %s', rule[USER], len(rule_records),
+                                         rule[MAILSERVER])
+                            filter_user_rules(mailbox, rule_records, sender_index=self.sender_index,
+                                              checkpoints=self.checkpoints, is_stopped=is_stopped)
+                    self.failures.pop(rule[USER], None)
+                except Exception as e:
+                    logger.error('%s: filter failed, %s', rule[USER], str(e))
+                    self._failed(rule[USER])
+                finally:
+                    USER_SECONDS.observe(time.time() - start)
+                    USER_LAST_SECONDS.set(time.time() - start, user=rule[USER])
+        finally:
+            if self.lease is not None:
+                self.lease.release(rule[USER])
+
+    def run(self, users_jobs, is_stopped=None):
+        """
+        Filter every user and return once all have finished or timed out, or soon after
+        is_stopped() turns True, users still running are then killed
+        :param users_jobs: dictionary of user => list of rule records
+        :param is_stopped: optional callable, checked between users and every STOP_POLL seconds
+        :return:
+        """
+        start = time.time()
+        pool = gevent.pool.Pool(self.concurrency)
+        for user in users_jobs.keys():
+            if is_stopped is not None and is_stopped():
+                break
+            if self.failures.get(user, (0, 0))[1] > time.time():
+                trace('%s: backing off after a failure', user)
+                continue
+            pool.spawn(self._filter_user, users_jobs[user], is_stopped)
+
+        while not pool.join(timeout=STOP_POLL):
+            if is_stopped is not None and is_stopped():
+                logger.info('green engine stopping, killing %d users', len(pool))
+                pool.kill(timeout=self.mbox_pool.op_timeout)
+                break
+        logger.debug('green engine filtered %d users in %.3fs, pool %s', len(users_jobs), time.time() - start,
+                     str(self.mbox_pool.stats()))
+
+    def close_all(self):
+        self.mbox_pool.close_all()
@@ -0,0 +1,151 @@
+# Copyright (c) 2016, Kevin Rodgers
+# Released subject to the New BSD License
+# Please see http://en.wikipedia.org/wiki/BSD_licenses
+
+from active_mail_filter import get_logger, read_configuration_file, trace
+from active_mail_filter.mboxfolder import MboxFolder
+from active_mail_filter.rule_compiler import filter_user_rules
+from active_mail_filter.stoppable_thread import StoppableThread
+from active_mail_filter.user_records import UUID, USER, PASSWORD, MAILSERVER, SOURCE
+
+_CONF_ = read_configuration_file()
+
+logger = get_logger()
+
+IDLE_PREFIX = 'idle'
+RECONNECT_DELAY = 30.0
+
+# mail servers that do not advertise IDLE, their rules stay on the polling loop
+idle_unsupported = set()
+
+
+def _watcher_name(rule):
+    return '%s:%s:%s' % (IDLE_PREFIX, rule[USER], rule[SOURCE])
+
+
+def _disconnect(mailbox):
+    try:
+        mailbox.disconnect()
+    except Exception as e:
+        trace('disconnect failed, %s', str(e))
+
+
+def idle_worker(rule_records, sender_index=None, mbox_pool=None):
+    """
+    Holds an IDLE connection on one user's source folder, when the server reports new
+    mail only the rules for that folder are run and only against the new UIDs
+    :param rule_records: rules of one user that share a source folder
+    :param sender_index: optional SenderIndex used to find each target's senders
+    :param mbox_pool: optional MboxPool holding the watcher slot sync_idle_watchers reserved,
+    the slot is given back when the worker exits
+    :return:
+    """
+    my_thread = StoppableThread.current_thread()
+    rule = rule_records[0]
+    try:
+        _idle_loop(my_thread, rule_records, sender_index, mbox_pool)
+    finally:
+        if mbox_pool is not None:
+            mbox_pool.release_watcher(rule[MAILSERVER], rule[USER])
+    logger.debug('%s: exiting', my_thread.getName())
+
+
+def _idle_loop(my_thread, rule_records, sender_index, mbox_pool):
+    rule = rule_records[0]
+    idle_timeout = _CONF_.getfloat('filter_daemon', 'idle_timeout')
+
+    while not my_thread.is_stopped():
+        mailbox = None
+        try:
+            if mbox_pool is not None:
+                mailbox = mbox_pool.open_watcher(rule[MAILSERVER], rule[USER], rule[PASSWORD])
+            else:
+                mailbox = MboxFolder(rule[MAILSERVER], rule[USER], rule[PASSWORD])
+            if not mailbox.has_capability('IDLE'):
+                logger.info('%s: IDLE not supported, using polling', rule[MAILSERVER])
+                idle_unsupported.add(rule[MAILSERVER])
+                break
+
+            last_uid = mailbox.select_folder(rule[SOURCE])['UIDNEXT'] - 1
+            while not my_thread.is_stopped():
+                events = mailbox.idle(timeout=idle_timeout, is_stopped=my_thread.is_stopped)
+                if not any(e.endswith('EXISTS') or e.endswith('RECENT') for e in events):
+                    continue
+
+                # mail delivered during a pass raises no EXISTS once IDLE is entered again,
+                # so the folder is checked again after each pass until nothing new arrived
+                next_uid = mailbox.select_folder(rule[SOURCE])['UIDNEXT']
+                while next_uid - 1 > last_uid and not my_thread.is_stopped():
+                    logger.debug('%s: new mail in %s, uids %d:%d', rule[USER], rule[SOURCE], last_uid + 1,
+                                 next_uid - 1)
+                    filter_user_rules(mailbox, rule_records, sender_index=sender_index,
+                                      uid_range='%d:%d' % (last_uid + 1, next_uid - 1))
+                    last_uid = next_uid - 1
+                    next_uid = mailbox.select_folder(rule[SOURCE])['UIDNEXT']
+        except Exception as e:
+            logger.error('%s: idle on %s failed, %s', rule[USER], rule[SOURCE], str(e))
+            my_thread.wait(RECONNECT_DELAY)
+        finally:
+            if mailbox is not None:
+                _disconnect(mailbox)
+
+
+def group_by_source(records):
+    grouped = {}
+    for rec in records:
+        name = _watcher_name(rec)
+        if name not in grouped:
+            grouped[name] = [rec]
+        else:
+            grouped[name].append(rec)
+    return grouped
+
+
+def sync_idle_watchers(records, sender_index=None, mbox_pool=None):
+    """
+    Starts an idle_worker thread for every (user, source folder) and restarts those
+    whose rules have changed
+    :param records: all user records
+    :param sender_index: optional SenderIndex passed to the workers
+    :param mbox_pool: optional MboxPool whose watcher limits bound the number of watchers,
+    a folder without a free slot stays on polling until one is given back
+    :return:
+    list of records not covered by a running watcher and that still need polling
+    """
+    poll_records = []
+    grouped = group_by_source(records)
+
+    for th in StoppableThread.enumerate():
+        if th.getName().startswith(IDLE_PREFIX + ':') and \
+                (th.getName() not in grouped or th.rule_uuids != sorted(r[UUID] for r in grouped[th.getName()])):
+            logger.debug('%s: rules changed, stopping watcher', th.getName())
+            th.stop()
+
+    for name in sorted(grouped.keys()):
+        rule_records = grouped[name]
+        if rule_records[0][MAILSERVER] in idle_unsupported:
+            poll_records.extend(rule_records)
+            continue
+
+        try:
+            th = StoppableThread.find_by_name(name)
+            if th.is_alive() and not th.is_stopped():
+                continue
+            # old watcher still shutting down, poll until it is gone
+            poll_records.extend(rule_records)
+            continue
+        except LookupError:
+            pass
+
+        if mbox_pool is not None and not mbox_pool.reserve_watcher(rule_records[0][MAILSERVER],
+                                                                   rule_records[0][USER]):
+            poll_records.extend(rule_records)
+            continue
+
+        logger.debug('%s: starting watcher', name)
+        th = StoppableThread(name=name, target=idle_worker, args=(rule_records, sender_index, mbox_pool))
+        th.rule_uuids = sorted(r[UUID] for r in rule_records)
+        th.setDaemon(True)
+        th.start()
+
+    return poll_records
@@ -0,0 +1,93 @@
+# Copyright (c) 2016, Kevin Rodgers
+# Released subject to the New BSD License
+# Please see http://en.wikipedia.org/wiki/BSD_licenses
+
+from active_mail_filter import get_logger, trace
+
+logger = get_logger()
+
+# untagged response holding the data each command returns
+UNTAGGED_DATA = {'FETCH': 'FETCH',
+                 'STORE': 'FETCH',
+                 'SEARCH': 'SEARCH',
+                 'STATUS': 'STATUS',
+                 'SELECT': 'EXISTS',
+                 'EXAMINE': 'EXISTS',
+                 'LIST': 'LIST',
+                 'COPY': 'COPYUID',
+                 'MOVE': 'COPYUID',
+                 'EXPUNGE': 'EXPUNGE'}
+
+
+class ImapPipeline(object):
+    def __init__(self, imap):
+        """
+        Sends several tagged commands before reading any reply, the replies are collected
+        by execute() in the order the commands were queued
+
+        :param imap: logged in imaplib.IMAP4
+        """
+        self.imap = imap
+        self.pending = []
+
+    def __str__(self):
+        return 'ImapPipeline [pending=%d]' % len(self.pending)
+
+    def __len__(self):
+        return len(self.pending)
+
+    def command(self, name, *args):
+        """
+        Send a command now, its reply is read by execute()
+        :param name: imaplib command name, e.g. STATUS
+        :param args: arguments as imaplib would pass them
+        :return:
+        index of the command's result in the list returned by execute()
+        """
+        name = name.upper()
+        tag = self.imap._command(name, *args)
+        self.pending.append((name, UNTAGGED_DATA.get(name), tag))
+        return len(self.pending) - 1
+
+    def uid(self, command, *args):
+        command = command.upper()
+        tag = self.imap._command('UID', command, *args)
+        self.pending.append(('UID', UNTAGGED_DATA.get(command), tag))
+        return len(self.pending) - 1
+
+    def status(self, folder_name, items):
+        return self.command('STATUS', folder_name, '(%s)' % items)
+
+    def select(self, folder_name):
+        # like imaplib select(), later commands in the pipeline run against this folder
+        self.imap.untagged_responses = {}
+        self.imap.is_readonly = False
+        index = self.command('SELECT', folder_name)
+        self.imap.state = 'SELECTED'
+        return index
+
+    def execute(self):
+        """
+        Read the reply of every queued command
+        :return:
+        list of (result, data) like imaplib returns, data holds the command's untagged
+        responses when it succeeded and the tagged text otherwise
+        """
+        results = []
+        pending, self.pending = self.pending, []
+        for name, untagged, tag in pending:
+            try:
+                result, data = self.imap._command_complete(name, tag)
+            except self.imap.abort:
+                raise
+            except self.imap.error as e:
+                result, data = 'BAD', [str(e)]
+
+            items = self.imap.untagged_responses.pop(untagged, []) if untagged is not None else []
+            if result == 'OK' and untagged is not None:
+                data = items
+            elif result != 'OK' and name == 'SELECT':
+                self.imap.state = 'AUTH'
+            results.append((result, data))
+        trace('pipeline of %d commands complete', len(pending))
+        return results
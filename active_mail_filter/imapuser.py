@@ -2,7 +2,10 @@
 # Released subject to the New BSD License
 # Please see http://en.wikipedia.org/wiki/BSD_licenses
 
-from active_mail_filter import get_logger
+from active_mail_filter import get_logger, read_configuration_file
+from active_mail_filter.smtp_forwarder import SmtpForwarder
+
+_CONF_ = read_configuration_file()
 
 logger = get_logger()
 
@@ -10,10 +13,11 @@ DEF_BATCH_SIZE = 80
 
 
 class ImapUser(object):
-    def __init__(self, mailbox, to_folder, from_folder='inbox'):
+    def __init__(self, mailbox, to_folder, from_folder='inbox', sender_index=None):
         self.to_folder = to_folder
         self.from_folder = from_folder
         self.mailbox = mailbox
+        self.sender_index = sender_index
 
     def __str__(self):
         return '{m}: {f}'.format(m=self.mailbox, f=self.to_folder)
@@ -23,14 +27,17 @@ class ImapUser(object):
         folders = self.mailbox.list_folders()
         return folders
 
-    def filter_mail(self, batch_size=DEF_BATCH_SIZE):
+    def filter_mail(self, batch_size=DEF_BATCH_SIZE, uid_range=None):
         moved_uids = []
         self.mailbox.connect()
         try:
-            from_list = self.mailbox.list_from_addresses(folder_name=self.to_folder)
+            if self.sender_index is not None:
+                from_list = self.sender_index.get_from_addresses(self.mailbox, self.to_folder)
+            else:
+                from_list = self.mailbox.list_from_addresses(folder_name=self.to_folder)
             for i in range(0, len(from_list), batch_size):
-                uids = self.mailbox.move_emails_from_users(from_list[i:i+batch_size],
-                                                           self.to_folder, from_folder=self.from_folder)
+                uids = self.mailbox.move_emails_from_users(from_list[i:i+batch_size], self.to_folder,
+                                                           from_folder=self.from_folder, uid_range=uid_range)
                 moved_uids.extend(uids)
         except Exception as e:
             logger.error(e.message)
@@ -38,19 +45,51 @@ class ImapUser(object):
 
         return len(moved_uids), moved_uids
 
-    def forward_mail(self, smtp_to, smtp_host, smtp_login=None, smtp_passwd=None, smtp_port=587):
+    def forward_mail(self, smtp_to, smtp_host, smtp_login=None, smtp_passwd=None, smtp_port=587, rate=None,
+                     stream_size=None):
+        """
+        Forward every unseen message in from_folder and flag it read
+        :param smtp_to: recipient
+        :param smtp_host: smtp server
+        :param smtp_login: optional smtp login name
+        :param smtp_passwd: smtp password
+        :param smtp_port: smtp port
+        :param rate: most messages sent per second, default is filter_daemon forward_rate
+        :param stream_size: messages of this many bytes or more are streamed in pieces instead of
+        being read whole, 0 never streams, default is filter_daemon forward_stream_size
+        :return:
+        tuple of (number forwarded, list of From of the forwarded messages)
+        """
+        if stream_size is None:
+            stream_size = int(_CONF_['filter_daemon']['forward_stream_size'])
         from_list = []
         self.mailbox.connect()
         try:
             uids = self.mailbox.list_email_uids(folder_name=self.from_folder, pattern='(UNSEEN)')
-            for uid in uids:
-                logger.debug('Forwarding uid == %s', uid)
-                from_user = self.mailbox.forward_message(uid, smtp_to, smtp_host,
-                                                         smtp_login=smtp_login, smtp_passwd=smtp_passwd,
-                                                         smtp_port=smtp_port)
-                if from_user is not None:
-                    self.mailbox.mark_uid_read(uid)
-                    from_list.append(from_user)
+            sizes = self.mailbox.fetch_sizes(uids) if stream_size > 0 else {}
+            large = set(uid for uid in uids if sizes.get(uid, 0) >= stream_size > 0)
+            forwarded = []
+            # one FETCH for every unseen message, one SMTP session and one STORE for the batch
+            with SmtpForwarder(smtp_host, port=smtp_port, login=smtp_login, password=smtp_passwd,
+                               rate=rate) as smtp:
+                messages = self.mailbox.iter_messages([uid for uid in uids if uid not in large])
+                try:
+                    for uid, message in messages:
+                        logger.debug('Forwarding uid == %s', uid)
+                        from_user = self.mailbox.send_message(message, smtp_to, smtp=smtp)
+                        if from_user is not None:
+                            forwarded.append(uid)
+                            from_list.append(from_user)
+
+                    large_from = dict(self.mailbox.iter_from_addresses([uid for uid in uids if uid in large]))
+                    for uid in [uid for uid in uids if large_from.get(uid) is not None]:
+                        logger.debug('Streaming uid == %s, %d bytes', uid, sizes[uid])
+                        from_list.append(self.mailbox.stream_message(uid, sizes[uid], large_from[uid], smtp_to, smtp))
+                        forwarded.append(uid)
+                finally:
+                    # the FETCH is drained first, whatever was sent is flagged even if a later message failed
+                    messages.close()
+                    self.mailbox.mark_uids_read(forwarded)
         except Exception as e:
             logger.error(e.message)
             raise RuntimeError(e.message)
@@ -0,0 +1,288 @@
+# Copyright (c) 2016, Kevin Rodgers
+# Released subject to the New BSD License
+# Please see http://en.wikipedia.org/wiki/BSD_licenses
+
+import time
+import threading
+from contextlib import contextmanager
+from active_mail_filter import get_logger, trace
+from active_mail_filter.mboxfolder import MboxFolder, DeadlineExceeded, DEF_OPERATION_TIMEOUT
+
+logger = get_logger()
+
+DEF_MAX_PER_SERVER = 10
+DEF_MAX_PER_USER = 4
+DEF_IDLE_TIMEOUT = 300
+DEF_WATCHERS_PER_SERVER = 50
+DEF_WATCHERS_PER_USER = 4
+
+
+class MboxPool(object):
+    def __init__(self, max_per_server=DEF_MAX_PER_SERVER, idle_timeout=DEF_IDLE_TIMEOUT,
+                 max_per_user=DEF_MAX_PER_USER, op_timeout=DEF_OPERATION_TIMEOUT,
+                 max_watchers_per_server=DEF_WATCHERS_PER_SERVER, max_watchers_per_user=DEF_WATCHERS_PER_USER,
+                 mailbox_class=MboxFolder):
+        """
+        Pool of logged in MboxFolder connections keyed by (mail_server, user)
+
+        IDLE watchers hold a connection for as long as they run, they are counted against
+        their own limits so they can never take every slot the sweeps and the API need
+
+        :param max_per_server: most connections, idle or borrowed, open to one mail server
+        :param idle_timeout: seconds an unused connection is kept before it is logged out
+        :param max_per_user: most connections open to one account, providers refuse logins past their own limit
+        :param op_timeout: seconds allowed for connecting and for each socket read or write
+        :param max_watchers_per_server: most IDLE watcher connections to one mail server
+        :param max_watchers_per_user: most IDLE watcher connections to one account
+        :param mailbox_class: MboxFolder or a subclass taking the same arguments, opened for new connections
+        """
+        self.max_per_server = max_per_server
+        self.max_per_user = max_per_user
+        self.op_timeout = op_timeout
+        self.idle_timeout = idle_timeout
+        self.max_watchers_per_server = max_watchers_per_server
+        self.max_watchers_per_user = max_watchers_per_user
+        self.mailbox_class = mailbox_class
+        self.condition = threading.Condition()
+        self.idle = {}
+        self.open_count = {}
+        self.user_count = {}
+        self.watcher_count = {}
+        self.user_watcher_count = {}
+
+    def __str__(self):
+        return 'MboxPool [max_per_server=%d, max_per_user=%d, idle_timeout=%d, open=%s, watchers=%s]' % \
+               (self.max_per_server, self.max_per_user, self.idle_timeout, str(self.open_count),
+                str(self.watcher_count))
+
+    @staticmethod
+    def _close(mailbox):
+        try:
+            mailbox.disconnect()
+        except Exception as e:
+            trace('%s: logout failed, %s', mailbox.username, str(e))
+            mailbox.imap = None
+
+    def _take_idle(self, key, password, folder=None):
+        # caller holds the condition lock, a session logged in with another password
+        # is never handed out so borrow() still validates the caller's credentials.
+        # A session already SELECTed on folder is preferred, then the most recently used
+        entries = self.idle.get(key, [])
+        matches = [i for i in range(len(entries) - 1, -1, -1) if entries[i][0].password == password]
+        for i in matches:
+            if folder is not None and entries[i][0].selected == folder:
+                return entries.pop(i)[0]
+        if len(matches) > 0:
+            return entries.pop(matches[0])[0]
+        return None
+
+    def _opened(self, key, count):
+        # caller holds the condition lock
+        self.open_count[key[0]] = self.open_count.get(key[0], 0) + count
+        self.user_count[key] = self.user_count.get(key, 0) + count
+        if self.user_count[key] <= 0:
+            del self.user_count[key]
+
+    def _at_limit(self, key):
+        return self.open_count.get(key[0], 0) >= self.max_per_server or \
+            self.user_count.get(key, 0) >= self.max_per_user
+
+    def _evict_oldest(self, key):
+        # caller holds the condition lock, frees a slot held by an idle connection, only
+        # the account's own connections free a slot when the account is at max_per_user
+        oldest = None
+        for idle_key in self.idle.keys():
+            if idle_key[0] == key[0] and len(self.idle[idle_key]) > 0 and \
+                    (idle_key == key or self.user_count.get(key, 0) < self.max_per_user):
+                if oldest is None or self.idle[idle_key][0][1] < self.idle[oldest][0][1]:
+                    oldest = idle_key
+        if oldest is None:
+            return None
+
+        mailbox, last_used = self.idle[oldest].pop(0)
+        self._opened(oldest, -1)
+        return mailbox
+
+    def borrow(self, host, user, password, folder=None, deadline=None):
+        """
+        Return a connected MboxFolder, reusing an idle connection when one exists and
+        blocking while the mail server is at max_per_server or the account at max_per_user
+        :param host: imap server
+        :param user: imap login name
+        :param password: imap password
+        :param folder: optional folder the caller will work in, a connection already on it is preferred
+        :param deadline: optional time.time() bounding the wait for a connection and every command
+        sent on it, DeadlineExceeded is raised once it has passed
+        :return:
+        MboxFolder, give it back with release()
+        """
+        key = (host, user)
+        evicted = None
+        self.condition.acquire()
+        try:
+            mailbox = self._take_idle(key, password, folder)
+            while mailbox is None and self._at_limit(key):
+                evicted = self._evict_oldest(key)
+                if evicted is not None:
+                    break
+                if deadline is not None and time.time() >= deadline:
+                    raise DeadlineExceeded('%s: no connection to %s before the deadline' % (user, host))
+                trace('%s: waiting for a connection to %s', user, host)
+                self.condition.wait(1.0)
+                mailbox = self._take_idle(key, password, folder)
+            if mailbox is None:
+                self._opened(key, 1)
+        finally:
+            self.condition.release()
+
+        if evicted is not None:
+            self._close(evicted)
+
+        if mailbox is not None:
+            mailbox.set_deadline(deadline)
+            if not mailbox.noop():
+                logger.debug('%s: pooled connection to %s is dead, reconnecting', user, host)
+                try:
+                    mailbox.reconnect()
+                except Exception:
+                    self._discard(key)
+                    raise
+            return mailbox
+
+        try:
+            return self.mailbox_class(host, user, password, op_timeout=self.op_timeout, deadline=deadline)
+        except Exception:
+            self._discard(key)
+            raise
+
+    def _discard(self, key):
+        self.condition.acquire()
+        try:
+            self._opened(key, -1)
+            self.condition.notify_all()
+        finally:
+            self.condition.release()
+
+    def release(self, mailbox, discard=False):
+        """
+        Return a borrowed connection to the pool
+        :param mailbox: MboxFolder from borrow()
+        :param discard: log out instead of keeping the connection, e.g. after an error
+        :return:
+        """
+        if discard or mailbox.imap is None:
+            self._close(mailbox)
+            self._discard((mailbox.host, mailbox.username))
+            return
+
+        mailbox.set_deadline(None)
+        self.condition.acquire()
+        try:
+            key = (mailbox.host, mailbox.username)
+            if key not in self.idle:
+                self.idle[key] = []
+            self.idle[key].append((mailbox, time.time()))
+            self.condition.notify_all()
+        finally:
+            self.condition.release()
+
+    @contextmanager
+    def connection(self, host, user, password, folder=None, deadline=None):
+        mailbox = self.borrow(host, user, password, folder=folder, deadline=deadline)
+        try:
+            yield mailbox
+        except BaseException:
+            self.release(mailbox, discard=True)
+            raise
+        self.release(mailbox)
+
+    def reserve_watcher(self, host, user):
+        """
+        Take a slot for an IDLE watcher, the slot is outside max_per_server and max_per_user
+        :param host: imap server
+        :param user: imap login name
+        :return:
+        True if the slot was taken, False when the server or account has its most watchers,
+        give a taken slot back with release_watcher()
+        """
+        key = (host, user)
+        self.condition.acquire()
+        try:
+            if self.watcher_count.get(host, 0) >= self.max_watchers_per_server or \
+                    self.user_watcher_count.get(key, 0) >= self.max_watchers_per_user:
+                trace('%s: no watcher slot on %s', user, host)
+                return False
+            self.watcher_count[host] = self.watcher_count.get(host, 0) + 1
+            self.user_watcher_count[key] = self.user_watcher_count.get(key, 0) + 1
+            return True
+        finally:
+            self.condition.release()
+
+    def release_watcher(self, host, user):
+        key = (host, user)
+        self.condition.acquire()
+        try:
+            self.watcher_count[host] -= 1
+            if self.watcher_count[host] <= 0:
+                del self.watcher_count[host]
+            self.user_watcher_count[key] -= 1
+            if self.user_watcher_count[key] <= 0:
+                del self.user_watcher_count[key]
+        finally:
+            self.condition.release()
+
+    def open_watcher(self, host, user, password):
+        """
+        :return:
+        new MboxFolder for a watcher holding a slot from reserve_watcher(), the watcher logs it out
+        """
+        return self.mailbox_class(host, user, password, op_timeout=self.op_timeout)
+
+    def evict_idle(self, max_age=None):
+        """
+        Log out connections that have not been used for max_age seconds
+        :param max_age: default is the pool's idle_timeout, 0 closes every idle connection
+        :return:
+        number of connections closed
+        """
+        max_age = self.idle_timeout if max_age is None else max_age
+        expired = []
+        self.condition.acquire()
+        try:
+            now = time.time()
+            for key in list(self.idle.keys()):
+                keep = []
+                for mailbox, last_used in self.idle[key]:
+                    if now - last_used >= max_age:
+                        expired.append(mailbox)
+                        self._opened(key, -1)
+                    else:
+                        keep.append((mailbox, last_used))
+                if len(keep) > 0:
+                    self.idle[key] = keep
+                else:
+                    del self.idle[key]
+            self.condition.notify_all()
+        finally:
+            self.condition.release()
+
+        for mailbox in expired:
+            self._close(mailbox)
+        if len(expired) > 0:
+            logger.debug('closed %d idle imap connections', len(expired))
+        return len(expired)
+
+    def close_all(self):
+        return self.evict_idle(max_age=0)
+
+    def stats(self):
+        self.condition.acquire()
+        try:
+            idle = {}
+            for key in self.idle.keys():
+                idle[key[0]] = idle.get(key[0], 0) + len(self.idle[key])
+            return dict((host, {'open': self.open_count.get(host, 0), 'idle': idle.get(host, 0),
+                                'watching': self.watcher_count.get(host, 0)})
+                        for host in set(self.open_count.keys()) | set(self.watcher_count.keys()))
+        finally:
+            self.condition.release()
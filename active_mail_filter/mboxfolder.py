@@ -3,37 +3,319 @@
 # Please see http://en.wikipedia.org/wiki/BSD_licenses
 
 import re
-import smtplib
+import ssl
+import errno
+import time
+import socket
+import select
 import imaplib
 from email import message_from_string
 from active_mail_filter import get_logger, trace
+from active_mail_filter.imap_pipeline import ImapPipeline
+from active_mail_filter.metrics import counter, instrument_imap
+from active_mail_filter.sender_address import parse_from, canonical_address
+from active_mail_filter.smtp_forwarder import SmtpForwarder
+from active_mail_filter.tracing import traced, add_time
 
 logger = get_logger()
 MAX_FETCH_HEADERS = 4098
+IDLE_TIMEOUT = 600
+LIST_CACHE_TTL = 60
+FOLDER_COUNT_ITEMS = 'MESSAGES UNSEEN UIDNEXT'
+HEADERS_FETCHED = counter('headers_fetched_total', 'Message headers fetched')
+STREAM_CHUNK_SIZE = 1048576
+STREAM_READ_AHEAD = 2
+DEF_OPERATION_TIMEOUT = 60
+RECV_SIZE = 65536
+
+# RFC 6851 MOVE is not known to older versions of imaplib
+if 'MOVE' not in imaplib.Commands:
+    imaplib.Commands['MOVE'] = ('SELECTED',)
+
+
+def parse_server(mail_server):
+    """
+    Split a mail server into where to connect, imap://host:port is a plain connection
+    and imaps://host:port or a bare host name is SSL
+    :param mail_server: host name or URL, e.g. imap.mail.yahoo.com or imap://127.0.0.1:1143
+    :return:
+    tuple of (host, port, use_ssl)
+    """
+    found = re.match(r'^(imaps?)://([^:/]+)(?::(\d+))?/?$', mail_server, re.I)
+    if found is None:
+        return mail_server, imaplib.IMAP4_SSL_PORT, True
+    use_ssl = found.group(1).lower() == 'imaps'
+    default_port = imaplib.IMAP4_SSL_PORT if use_ssl else imaplib.IMAP4_PORT
+    return found.group(2), int(found.group(3) or default_port), use_ssl
+
+
+def _unquote(value):
+    # IMAP quoted string or atom to its value
+    if value.startswith('"'):
+        return re.sub('\\\\(.)', '\\1', value[1:-1])
+    return value
+
+
+class OperationTimeout(imaplib.IMAP4.abort):
+    pass
+
+
+class DeadlineExceeded(OperationTimeout):
+    pass
+
+
+class SocketReader(object):
+    """
+    Buffered reads from an imap socket or ssl socket, used in place of makefile() so
+    IDLE can tell whether a response has already been read ahead
+    """
+    def __init__(self, sock, recv_size=RECV_SIZE):
+        self.sock = sock
+        self.recv_size = recv_size
+        self.buffer = ''
+        self.pos = 0
+
+    def _recv(self, size):
+        while True:
+            try:
+                return self.sock.recv(size)
+            except socket.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+
+    def pending(self):
+        # True when a read would return without waiting on the socket
+        if self.pos < len(self.buffer):
+            return True
+        return hasattr(self.sock, 'pending') and self.sock.pending() > 0
+
+    def readline(self, limit=-1):
+        end = None
+        while end is None:
+            found = self.buffer.find('\n', self.pos)
+            if found >= 0:
+                end = found + 1
+            elif 0 <= limit <= len(self.buffer) - self.pos:
+                end = self.pos + limit
+            else:
+                data = self._recv(self.recv_size)
+                if len(data) == 0:
+                    end = len(self.buffer)
+                else:
+                    self.buffer = self.buffer[self.pos:] + data
+                    self.pos = 0
+        if limit >= 0:
+            end = min(end, self.pos + limit)
+        line = self.buffer[self.pos:end]
+        self.pos = end
+        return line
+
+    def read(self, size):
+        chunks = [self.buffer[self.pos:self.pos + size]]
+        self.pos += len(chunks[0])
+        count = len(chunks[0])
+        while count < size:
+            data = self._recv(min(self.recv_size, size - count))
+            if len(data) == 0:
+                break
+            chunks.append(data)
+            count += len(data)
+        return ''.join(chunks)
+
+    def close(self):
+        # the socket is closed by its owner
+        self.buffer = ''
+        self.pos = 0
+
+
+def _timed_io(imap, func, *args):
+    # a socket that timed out may hold half a reply, it is closed rather than reused and
+    # later reads, e.g. draining a FETCH, raise the same timeout
+    if imap.timed_out is not None:
+        raise OperationTimeout(imap.timed_out)
+    try:
+        return func(imap, *args)
+    except (socket.timeout, ssl.SSLError) as e:
+        if not isinstance(e, socket.timeout) and 'timed out' not in str(e):
+            raise
+        imap.timed_out = '%s: no reply within %.1fs' % (imap.host, imap.sock.gettimeout() or 0)
+        try:
+            imap.sock.close()
+        except Exception as close_error:
+            trace('%s: close failed, %s', imap.host, str(close_error))
+        raise OperationTimeout(imap.timed_out)
+
+
+class TimeoutIMAP4(imaplib.IMAP4):
+    """
+    IMAP4 whose connect and socket reads and writes give up after timeout seconds,
+    a timed out connection raises OperationTimeout and can not be used again
+    """
+    def __init__(self, host, port=imaplib.IMAP4_PORT, timeout=DEF_OPERATION_TIMEOUT):
+        self.timeout = timeout
+        self.timed_out = None
+        imaplib.IMAP4.__init__(self, host, port)
+
+    def open(self, host='', port=imaplib.IMAP4_PORT):
+        self.host = host
+        self.port = port
+        self.sock = socket.create_connection((host, port), self.timeout)
+        self.file = SocketReader(self.sock)
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def read(self, size):
+        return _timed_io(self, imaplib.IMAP4.read, size)
+
+    def readline(self):
+        return _timed_io(self, imaplib.IMAP4.readline)
+
+    def send(self, data):
+        return _timed_io(self, imaplib.IMAP4.send, data)
+
+
+class TimeoutIMAP4_SSL(imaplib.IMAP4_SSL):
+    """
+    TimeoutIMAP4 over SSL
+    """
+    def __init__(self, host, port=imaplib.IMAP4_SSL_PORT, timeout=DEF_OPERATION_TIMEOUT):
+        self.timeout = timeout
+        self.timed_out = None
+        imaplib.IMAP4_SSL.__init__(self, host, port)
+
+    def open(self, host='', port=imaplib.IMAP4_SSL_PORT):
+        self.host = host
+        self.port = port
+        self.sock = socket.create_connection((host, port), self.timeout)
+        self.sslobj = ssl.wrap_socket(self.sock, self.keyfile, self.certfile)
+        self.file = SocketReader(self.sslobj)
+
+    def settimeout(self, timeout):
+        # the ssl socket was created with the timeout the plain socket had at the time
+        self.sock.settimeout(timeout)
+        self.sslobj.settimeout(timeout)
+
+    def read(self, size):
+        return _timed_io(self, imaplib.IMAP4_SSL.read, size)
+
+    def readline(self):
+        return _timed_io(self, imaplib.IMAP4_SSL.readline)
+
+    def send(self, data):
+        return _timed_io(self, imaplib.IMAP4_SSL.send, data)
 
 
 class MboxFolder(object):
-    def __init__(self, host, username, password):
+    def __init__(self, host, username, password, op_timeout=DEF_OPERATION_TIMEOUT, deadline=None):
+        """
+        One logged in IMAP session
+
+        :param host: mail server, a host name for IMAP over SSL on port 993 or imap://host:port
+        for a plain connection, e.g. to a local test server
+        :param username: imap login name
+        :param password: imap password
+        :param op_timeout: seconds allowed for connecting and for each socket read or write, 0 waits forever
+        :param deadline: optional time.time() after which no command is sent, see set_deadline()
+        """
         self.host = host
         self.username = username
         self.password = password
+        self.op_timeout = op_timeout
+        self.deadline = deadline
         self.imap = None
+        self.capabilities = ()
+        self.folder_cache = None
+        # folder of the last successful SELECT, lets a pool hand out a session already on a folder
+        self.selected = None
         self.connect()
 
     def __str__(self):
         return 'MboxFolder [host=' + self.host + ', username=' + self.username + \
                ', imap=' + str(self.imap) + ']'
 
+    def set_deadline(self, deadline):
+        """
+        Bound the rest of a job's work on this session, each command gets whatever is
+        left of op_timeout or the deadline and none is sent once the deadline has passed
+        :param deadline: time.time() value or None to remove the bound
+        :return:
+        """
+        self.deadline = deadline
+
+    def operation_timeout(self):
+        """
+        :return:
+        seconds the next command may take, None for no limit
+        """
+        if self.deadline is None:
+            return self.op_timeout or None
+        remaining = self.deadline - time.time()
+        if remaining <= 0:
+            raise DeadlineExceeded('%s: deadline passed %.1fs ago' % (self.username, -remaining))
+        return min(self.op_timeout, remaining) if self.op_timeout else remaining
+
+    def _bound_reads(self):
+        # a FETCH answer is read over many responses, each one gets only what is left of the
+        # deadline, a response given up part way leaves the connection unusable
+        try:
+            timeout = self.operation_timeout()
+        except DeadlineExceeded as e:
+            self.imap.timed_out = str(e)
+            try:
+                self.imap.sock.close()
+            except Exception as close_error:
+                trace('%s: close failed, %s', self.host, str(close_error))
+            raise
+        settimeout = getattr(self.imap, 'settimeout', None)
+        if settimeout is not None:
+            settimeout(timeout)
+
+    def _bound_commands(self, imap):
+        # every command, pipelined ones included, runs within the remaining time
+        command = imap._command
+        settimeout = getattr(imap, 'settimeout', None)
+
+        def bounded_command(name, *args):
+            timeout = self.operation_timeout()
+            if settimeout is not None:
+                settimeout(timeout)
+            return command(name, *args)
+        imap._command = bounded_command
+        return imap
+
+    def _open_imap(self):
+        host, port, use_ssl = parse_server(self.host)
+        if use_ssl:
+            return TimeoutIMAP4_SSL(host, port, timeout=self.operation_timeout())
+        return TimeoutIMAP4(host, port, timeout=self.operation_timeout())
+
+    @traced('connect')
     def connect(self):
         if self.imap is None:
             logger.debug('imap connecting to host %s' % self.host)
+            self.selected = None
             try:
-                self.imap = imaplib.IMAP4_SSL(self.host)
+                self.imap = instrument_imap(self._bound_commands(self._open_imap()))
                 self.imap.login(self.username, self.password)
+                self._read_capabilities()
             except Exception as e:
                 logger.error('connection failure, %s.', str(e.message))
                 raise e
 
+    def _read_capabilities(self):
+        # servers often advertise more capabilities once authenticated
+        result, data = self.imap.capability()
+        if result == 'OK' and data[-1] is not None:
+            self.capabilities = tuple(data[-1].upper().split())
+        else:
+            self.capabilities = tuple(self.imap.capabilities)
+        trace('%s capabilities %s', self.host, str(self.capabilities))
+
+    def has_capability(self, name):
+        return name.upper() in self.capabilities
+
+    @traced('disconnect')
     def disconnect(self):
         if self.imap is not None:
             logger.debug('imap disconnecting from host %s' % self.host)
@@ -41,22 +323,147 @@ class MboxFolder(object):
             del self.imap
             self.imap = None
 
-    def list_folders(self):
+    def reconnect(self):
+        if self.imap is not None:
+            try:
+                self.imap.shutdown()
+            except Exception as e:
+                trace('shutdown failed, %s', str(e))
+            self.imap = None
+        self.connect()
+
+    def noop(self):
+        # False if the server has dropped us, imaplib turns an untagged BYE into abort
+        if self.imap is None:
+            return False
+        try:
+            result, data = self.imap.noop()
+        except Exception as e:
+            logger.debug('%s: noop failed, %s', self.username, str(e))
+            return False
+        return result == 'OK'
+
+    @staticmethod
+    def _response_lines(data):
+        # imaplib returns a response carrying a literal, e.g. a folder name sent as {11}, as a
+        # (text before the literal, literal) tuple and the rest of the line as the next entry,
+        # the literal is put back in the line as a quoted string
+        lines = []
+        joined = None
+        for entry in data:
+            if isinstance(entry, tuple):
+                quoted = '"%s"' % entry[1].replace('\\', '\\\\').replace('"', '\\"')
+                joined = (joined or '') + re.sub('\\{\\d+\\}$', '', entry[0]) + quoted
+            elif joined is not None:
+                lines.append(joined + (entry or ''))
+                joined = None
+            elif entry is not None:
+                lines.append(entry)
+        if joined is not None:
+            lines.append(joined)
+        return lines
+
+    @staticmethod
+    def _parse_list(folders):
+        # '(\\HasNoChildren) "/" "folder name"' => 'folder name', inbox in lower case
         folder_list = []
+        for line in MboxFolder._response_lines(folders):
+            found = re.search('^\\s*\\(([^()]*)\\)\\s+(?:"(?:[^"\\\\]|\\\\.)*"|NIL)\\s+'
+                              '("(?:[^"\\\\]|\\\\.)*"|\\S+)\\s*$', line, re.I)
+            if found is None:
+                logger.warning('malformed list, %s', line)
+                continue
+            if '\\noselect' not in found.group(1).lower():
+                folder = _unquote(found.group(2))
+                folder_list.append(folder.lower() if folder.lower() == 'inbox' else folder)
+        return folder_list
+
+    @staticmethod
+    def _parse_status(line):
+        # '"folder name" (MESSAGES 3 UNSEEN 1)' => ('folder name', {'MESSAGES': 3, 'UNSEEN': 1})
+        found = re.search('^\s*("(?:[^"\\\\]|\\\\.)*"|\S+)\s*\(([^()]*)\)\s*$', line or '')
+        if found is None:
+            raise LookupError('malformed status, %s' % str(line))
+
+        name = _unquote(found.group(1))
+        fields = found.group(2).split()
+        return name, dict((fields[i].upper(), int(fields[i+1])) for i in range(0, len(fields) - 1, 2))
+
+    def list_folders(self, max_age=LIST_CACHE_TTL):
+        """
+        Selectable folders, the LIST result is reused for max_age seconds
+        :param max_age: 0 always sends LIST
+        :return:
+        list of folder names, inbox in lower case
+        """
+        if self.folder_cache is not None and time.time() - self.folder_cache[0] < max_age:
+            return list(self.folder_cache[1])
+
         result, folders = self.imap.list()
+        if result != 'OK':
+            raise LookupError('folder list failed, %s' % str(folders))
+        folder_list = self._parse_list(folders)
+        self.folder_cache = (time.time(), folder_list)
+        return list(folder_list)
+
+    def _list_status(self, items):
+        # RFC 5819, one command returns every folder and its counts
+        result, data = self.imap._simple_command('LIST', '""', '*', 'RETURN', '(STATUS (%s))' % items)
+        result, folders = self.imap._untagged_response(result, data, 'LIST')
+        status_result, status_data = self.imap.response('STATUS')
+        if result != 'OK':
+            raise LookupError('folder list failed, %s' % str(folders))
+
+        folder_list = self._parse_list(folders)
+        self.folder_cache = (time.time(), folder_list)
+        return folder_list, self._response_lines(status_data)
+
+    def pipeline(self):
+        """
+        :return:
+        ImapPipeline on this connection, queue commands then call execute()
+        """
+        self.connect()
+        return ImapPipeline(self.imap)
+
+    def _status_pipelined(self, folders, items):
+        # every STATUS is sent before the first reply is read, one round trip for all folders
+        pipe = self.pipeline()
         for f in folders:
-            fields = f.split('"')
-            if '\\noselect' not in fields[0].lower():
-                folder = fields[-2] if 'inbox' != fields[-2].lower() else fields[-2].lower()
-                folder_list.append(folder)
-        return folder_list
+            pipe.status(f, items)
+        status_lines = []
+        for i, (result, data) in enumerate(pipe.execute()):
+            if result != 'OK':
+                logger.warning('%s: folder status failed, %s', folders[i], str(data))
+            if result == 'OK':
+                status_lines.extend(self._response_lines(data))
+        return status_lines
+
+    def list_folder_counts(self, items=FOLDER_COUNT_ITEMS):
+        """
+        Message counts of every selectable folder without selecting any of them
+        :param items: STATUS data items to return
+        :return:
+        dictionary of folder => dictionary of lower case item => count, e.g. {'messages': 3, 'unseen': 1}
+        """
+        if self.has_capability('LIST-STATUS'):
+            folders, status_lines = self._list_status(items)
+        else:
+            folders = self.list_folders()
+            status_lines = self._status_pipelined(folders, items)
+
+        counts = {}
+        for line in status_lines:
+            name, status = self._parse_status(line)
+            counts[name.lower() if name.lower() == 'inbox' else name] = \
+                dict((k.lower(), v) for k, v in status.items())
 
-    def list_folder_counts(self):
-        folders = self.list_folders()
         folder_dict = {}
         for f in folders:
-            uids = self.list_email_uids(folder_name=f)
-            folder_dict[f] = len(uids) > 0
+            if f in counts:
+                folder_dict[f] = counts[f]
+            else:
+                trace('%s: no status returned', f)
         return folder_dict
 
     def is_valid_folder(self, folder_name):
@@ -65,9 +472,66 @@ class MboxFolder(object):
             folder_name = folder_name.lower()
         return folder_name in folders
 
+    def select_folder(self, folder_name):
+        result, data = self.imap.select(folder_name)
+        self.selected = folder_name if result == 'OK' else None
+        if result != 'OK':
+            raise LookupError('%s: Invalid folder, %s' % (folder_name, str(data[0])))
+
+        folder_info = {'EXISTS': int(data[0])}
+        for name in ['UIDVALIDITY', 'UIDNEXT', 'HIGHESTMODSEQ']:
+            typ, value = self.imap.response(name)
+            if value[-1] is not None:
+                folder_info[name] = int(value[-1])
+        return folder_info
+
+    def idle(self, timeout=IDLE_TIMEOUT, is_stopped=None):
+        """
+        Waits in IDLE (RFC 2177) on the selected folder until the server reports a change,
+        the timeout expires or is_stopped() returns True
+        :param timeout: seconds to wait, servers drop idle clients after 30 minutes
+        :param is_stopped: optional callable polled every second
+        :return:
+        list of untagged responses received, e.g. ['12 EXISTS', '1 RECENT']
+        """
+        tag = self.imap._new_tag()
+        self.imap.send('%s IDLE\r\n' % tag)
+        line = self.imap.readline()
+        if not line.startswith('+'):
+            raise RuntimeError('IDLE rejected, %s' % line.strip())
+
+        events = []
+        deadline = time.time() + timeout
+        while len(events) == 0 and time.time() < deadline:
+            if is_stopped is not None and is_stopped():
+                break
+            if self.imap.file.pending() or len(select.select([self.imap.socket()], [], [], 1.0)[0]) > 0:
+                line = self.imap.readline()
+                if len(line) == 0:
+                    raise self.imap.abort('socket closed during IDLE')
+                if line.startswith('* BYE'):
+                    raise self.imap.abort(line.strip())
+                events.append(line[2:].strip())
+
+        self.imap.send('DONE\r\n')
+        while True:
+            line = self.imap.readline()
+            if len(line) == 0:
+                raise self.imap.abort('socket closed during IDLE')
+            if line.startswith(tag):
+                break
+            events.append(line[2:].strip())
+
+        if not line.startswith('%s OK' % tag):
+            logger.error('IDLE failed, %s', line.strip())
+        trace('%s: idle events %s', self.username, str(events))
+        return events
+
+    @traced('search')
     def list_email_uids(self, folder_name="inbox", pattern="ALL"):
         uids = []
         result, data = self.imap.select(folder_name)
+        self.selected = folder_name if result == 'OK' else None
         if result == 'OK':
             result, data = self.imap.uid("SEARCH", None, pattern)
             if result == 'OK':
@@ -79,35 +543,146 @@ class MboxFolder(object):
         logger.debug('search for %s in %s returned %d uids' % (pattern, folder_name, len(uids)))
         return uids
 
-    def list_from_addresses(self, folder_name):
+    def folder_status(self, folder_name, items='MESSAGES UIDNEXT UIDVALIDITY'):
+        result, data = self.imap.status(folder_name, '(%s)' % items)
+        if result != 'OK' or data[-1] is None:
+            raise LookupError('%s: folder status failed, %s' % (folder_name, str(data[0])))
+
+        name, status = self._parse_status(data[-1])
+        return status
+
+    @staticmethod
+    def sequence_set(uids):
+        """
+        Compact IMAP sequence set, ['1', '2', '3', '7'] => '1:3,7'
+        :param uids: list of uids as strings or numbers
+        :return:
+        sequence set string
+        """
+        numbers = sorted(set(int(u) for u in uids))
+        if len(numbers) == 0:
+            return ''
+        ranges = []
+        start = end = numbers[0]
+        for n in numbers[1:]:
+            if n != end + 1:
+                ranges.append('%d:%d' % (start, end) if end > start else '%d' % start)
+                start = n
+            end = n
+        ranges.append('%d:%d' % (start, end) if end > start else '%d' % start)
+        return ','.join(ranges)
+
+    @staticmethod
+    def _parse_header_fields(data):
+        # unfolds and splits a header block, first occurrence of a field wins like email.message
+        fields = {}
+        name = None
+        for line in data.split('\n'):
+            line = line.rstrip('\r')
+            if line[:1] in (' ', '\t'):
+                if name is not None:
+                    fields[name] += line
+            elif ':' in line:
+                name, value = line.split(':', 1)
+                name = name.strip().lower()
+                if name in fields:
+                    name = None
+                else:
+                    fields[name] = value.lstrip()
+            else:
+                name = None
+        return dict((k, v.strip()) for k, v in fields.items())
+
+    def _drain_fetch(self, tag):
+        # a caller that stops iterating early leaves responses on the wire, read them
+        # so the next command does not see stale FETCH data
+        try:
+            while getattr(self.imap, 'timed_out', None) is None and \
+                    self.imap.tagged_commands.get(tag, 'done') is None:
+                self.imap._get_response()
+            self.imap.tagged_commands.pop(tag, None)
+        finally:
+            self.imap.untagged_responses.pop('FETCH', None)
+
+    def iter_fetch(self, uids, item, batch_size=MAX_FETCH_HEADERS):
+        """
+        Yields each message's literal as its FETCH response is read instead of holding
+        the whole response, memory stays flat whatever the number of uids
+        :param uids: list of uids
+        :param item: FETCH data item returning one literal, e.g. BODY.PEEK[HEADER.FIELDS (FROM)]
+        :param batch_size: uids per FETCH command
+        :return:
+        iterator of (uid, literal)
+        """
+        for index in range(0, len(uids), batch_size):
+            uid_set = self.sequence_set(uids[index:index+batch_size])
+            trace('Fetching %s uids[%d:%d] == { %s }', item, index, index+batch_size, uid_set)
+            tag = self.imap._command('UID', 'FETCH', uid_set, '(UID %s)' % item)
+            try:
+                literal = None
+                while self.imap.tagged_commands[tag] is None:
+                    self._bound_reads()
+                    start = time.time()
+                    self.imap._get_response()
+                    add_time('fetch', time.time() - start)
+                    for dat in self.imap.untagged_responses.pop('FETCH', []):
+                        # servers may send UID before or after the literal
+                        if isinstance(dat, tuple):
+                            found = re.search('UID (\d+)', dat[0])
+                            literal = dat[1]
+                        else:
+                            found = re.search('UID (\d+)', dat)
+                        if found is not None and literal is not None:
+                            yield found.group(1), literal
+                            literal = None
+
+                result, data = self.imap._command_complete('FETCH', tag)
+                if result != 'OK':
+                    raise LookupError('%s not found' % uid_set)
+            finally:
+                self._drain_fetch(tag)
+
+    def iter_header_fields(self, uids, fields=('FROM',), batch_size=MAX_FETCH_HEADERS):
+        """
+        Fetch only the named header fields of each message
+        :param uids: list of uids
+        :param fields: header field names
+        :param batch_size: uids per FETCH command
+        :return:
+        iterator of (uid, dictionary of lower case field name => value)
+        """
+        item = 'BODY.PEEK[HEADER.FIELDS (%s)]' % ' '.join(f.upper() for f in fields)
+        for uid, literal in self.iter_fetch(uids, item, batch_size=batch_size):
+            HEADERS_FETCHED.inc()
+            yield uid, self._parse_header_fields(literal)
+
+    def iter_from_addresses(self, uids, batch_size=MAX_FETCH_HEADERS):
+        """
+        :param uids: list of uids
+        :param batch_size: uids per FETCH command
+        :return:
+        iterator of (uid, From string), the From string is None when the header is missing
+        """
+        for uid, headers in self.iter_header_fields(uids, fields=('FROM',), batch_size=batch_size):
+            yield uid, headers.get('from')
+
+    def fetch_from_addresses(self, uids):
         from_list = set()
+        for uid, from_string in self.iter_from_addresses(uids):
+            if from_string is not None:
+                from_list.add(from_string.lower())
+        return from_list
+
+    @traced('list_from_addresses')
+    def list_from_addresses(self, folder_name):
         uid_list = self.list_email_uids(folder_name=folder_name)
-        if len(uid_list) > 0:
-            msg_list = self.fetch_uid_headers(uid_list)
-            for i in range(0, len(msg_list)):
-                if 'From' in msg_list[i]:
-                    from_string = msg_list[i]['From'].lower()
-                    from_list.add(from_string)
+        from_list = self.fetch_from_addresses(uid_list)
         logger.debug('found %d from addresses' % len(from_list))
         return list(from_list)
 
     @staticmethod
     def extract_email_address(from_string):
-        if '<' in from_string and '>' in from_string:
-            regex_expr = '<(.+?)>'
-        elif '"' in from_string:
-            regex_expr = '"(.+?)"'
-        else:
-            regex_expr = None
-
-        if regex_expr is not None:
-            try:
-                found = re.search(regex_expr, from_string).group(1)
-            except AttributeError:
-                raise RuntimeError('%s: malformed email address' % from_string)
-        else:
-            found = from_string.split(' ')[0]
-        return found.translate(None, '\t\n\r').strip()
+        return parse_from(from_string)[0]
 
     @staticmethod
     def _get_email_message(data):
@@ -127,15 +702,15 @@ class MboxFolder(object):
     def fetch_uid_message(self, uid):
         return self._get_email_message(self.fetch_uid(uid))
 
-    def fetch_uid_headers(self, uids, batch_size=MAX_FETCH_HEADERS):
-        messages = []
+    def fetch_headers_by_uid(self, uids, batch_size=MAX_FETCH_HEADERS):
+        messages = {}
         for index in range(0, len(uids), batch_size):
             count = len(uids[index:index+batch_size])
-            uid_str = ",".join(uids[index:index+batch_size])
+            uid_str = self.sequence_set(uids[index:index+batch_size])
             trace('Fetching uids[%d:%d] == { %s }', index, index+batch_size, uid_str)
             result, data = self.imap.uid("FETCH", uid_str, "(BODY.PEEK[HEADER.FIELDS (SUBJECT DATE TO FROM)])")
             if result != 'OK':
-                raise LookupError('%lu not found' % uid_str)
+                raise LookupError('%s not found' % uid_str)
 
             if (2 * count) > len(data):
                 for i in range(0, len(data)):
@@ -143,10 +718,16 @@ class MboxFolder(object):
                 raise LookupError('FETCH bad count, expected %d got %d' % ((2 * count), len(data)))
 
             for i in range(0, (2 * count), 2):
-                messages.append(self._get_email_message(data[i][1]))
+                found = re.search('UID (\d+)', data[i][0])
+                uid = found.group(1) if found is not None else uids[index + i // 2]
+                messages[uid] = self._get_email_message(data[i][1])
 
         return messages
 
+    def fetch_uid_headers(self, uids, batch_size=MAX_FETCH_HEADERS):
+        messages = self.fetch_headers_by_uid(uids, batch_size=batch_size)
+        return [messages[uid] for uid in uids if uid in messages]
+
     def get_flags(self, uid):
         result, data = self.imap.uid("FETCH", uid, "(FLAGS)")
         if result != 'OK':
@@ -160,17 +741,71 @@ class MboxFolder(object):
         if result != 'OK':
             raise LookupError('%lu not found' % uid)
 
+    def mark_uids_read(self, uids):
+        if len(uids) > 0:
+            result, data = self.imap.uid("STORE", self.sequence_set(uids), '+FLAGS', '(\Seen)')
+            if result != 'OK':
+                raise LookupError('%s not found' % str(uids))
+
     def mark_uid_unread(self, uid):
         result, data = self.imap.uid("STORE", uid, '-FLAGS', '(\Seen)')
         if result != 'OK':
             raise LookupError('%lu not found' % uid)
 
-    def list_email_uids_from_users(self, from_users, from_folder='inbox'):
-        sub_pattern = 'FROM "%s"' % from_users[0]
-        for i in range(1, len(from_users)):
-            sub_pattern = 'OR %s FROM "%s"' % (sub_pattern, from_users[i])
+    @staticmethod
+    def or_pattern(terms):
+        """
+        Join search keys with a balanced tree of ORs, the nesting depth is log2(len(terms))
+        rather than len(terms) so servers that parse recursively accept large batches
+        :param terms: list of search keys, e.g. FROM "a@b.com"
+        :return:
+        search key matching any of terms
+        """
+        if len(terms) == 1:
+            return terms[0]
+        middle = len(terms) // 2
+        return 'OR %s %s' % (MboxFolder.or_pattern(terms[:middle]), MboxFolder.or_pattern(terms[middle:]))
+
+    def _from_users_pattern(self, from_users, uid_range=None):
+        sub_pattern = self.or_pattern(['FROM "%s"' % f for f in from_users])
+        if uid_range is not None:
+            sub_pattern = 'UID %s %s' % (uid_range, sub_pattern)
+        return '(%s)' % sub_pattern
+
+    @traced('search')
+    def search_uids(self, folder_name, patterns):
+        """
+        SELECT a folder and run several searches in one round trip
+        :param folder_name: folder to search
+        :param patterns: list of search patterns
+        :return:
+        sorted list of uids matching any of the patterns
+        """
+        pipe = self.pipeline()
+        pipe.select(folder_name)
+        for pattern in patterns:
+            pipe.uid('SEARCH', None, pattern)
+        results = pipe.execute()
+        self.selected = folder_name if results[0][0] == 'OK' else None
+        if results[0][0] != 'OK':
+            raise LookupError('%s: Invalid folder, %s' % (folder_name, str(results[0][1])))
 
-        pattern = '(%s)' % sub_pattern
+        uids = set()
+        for i in range(1, len(results)):
+            result, data = results[i]
+            if result != 'OK':
+                logger.warning('Failed search for pattern %s', patterns[i - 1])
+                raise LookupError('%s: search failed, %s' % (folder_name, str(data)))
+            for line in data:
+                uids.update((line or '').split())
+        logger.debug('%d searches in %s returned %d uids' % (len(patterns), folder_name, len(uids)))
+        return sorted(uids, key=int)
+
+    def list_email_uids_from_user_batches(self, batches, from_folder='inbox', uid_range=None):
+        return self.search_uids(from_folder, [self._from_users_pattern(b, uid_range) for b in batches])
+
+    def list_email_uids_from_users(self, from_users, from_folder='inbox', uid_range=None):
+        pattern = self._from_users_pattern(from_users, uid_range)
         try:
             email_uids = self.list_email_uids(folder_name=from_folder, pattern=pattern)
         except Exception as e:
@@ -179,51 +814,234 @@ class MboxFolder(object):
             raise e
         return email_uids
 
-    def move_emails_from_users(self, from_users, to_folder, from_folder='inbox'):
-        moved_uids = []
-        from_lower_users = list(set(self.extract_email_address(f) for f in from_users))
-        email_uids = self.list_email_uids_from_users(from_lower_users, from_folder=from_folder)
-        for uid in email_uids:
-            email_msg = self.fetch_uid_headers([uid])
-            email_from = email_msg[0]['From']
-            if email_from.lower() in from_users:
-                self.move_uid(uid, to_folder)
-                moved_uids.append(uid)
+    def fetch_from_by_uid(self, uids):
+        return dict((uid, email_from.lower()) for uid, email_from in self.iter_from_addresses(uids)
+                    if email_from is not None)
+
+    def move_emails_from_users(self, from_users, to_folder, from_folder='inbox', uid_range=None):
+        matched_uids = []
+        canonical_users = set(canonical_address(f) for f in from_users)
+        from_lower_users = sorted(set(a for a in (self.extract_email_address(f) for f in from_users) if a))
+        if len(from_lower_users) == 0:
+            return []
+        email_uids = self.list_email_uids_from_users(from_lower_users, from_folder=from_folder, uid_range=uid_range)
+        for uid, email_from in self.iter_from_addresses(email_uids):
+            if email_from is not None and canonical_address(email_from) in canonical_users:
+                matched_uids.append(uid)
             else:
-                trace('%s not in %s', email_from.lower(), str(from_lower_users))
-        return moved_uids
+                trace('%s not in %s', str(email_from).lower(), str(from_lower_users))
+        return self.move_uids(matched_uids, to_folder)
 
     def delete_uids(self, uids):
-        uid_str = ",".join(uids)
+        uid_str = self.sequence_set(uids)
         result, data = self.imap.uid('STORE', uid_str, '+FLAGS', '(\Deleted)')
-        if result == 'OK':
+        if result != 'OK':
+            logger.error('items not deleted, %s' % str(data))
+        elif self.has_capability('UIDPLUS'):
+            # only expunge our own messages, not everything flagged deleted in the folder
+            self.imap.uid('EXPUNGE', uid_str)
+        else:
             self.imap.expunge()
+
+    @traced('move')
+    def move_uids(self, uids, to_folder):
+        if len(uids) == 0:
+            return []
+
+        uid_str = self.sequence_set(uids)
+        if self.has_capability('MOVE'):
+            result, data = self.imap.uid('MOVE', uid_str, to_folder)
+            if result != 'OK':
+                logger.error('items not moved, %s' % str(data))
+                return []
         else:
-            logger.error('items not deleted, %s' % str(data))
+            result, data = self.imap.uid('COPY', uid_str, to_folder)
+            if result != 'OK':
+                logger.error('items not copied, %s' % str(data))
+                return []
+            self.delete_uids(uids)
+        trace('moved { %s } to %s', uid_str, to_folder)
+        return list(uids)
+
+    @traced('move')
+    def move_uids_by_target(self, uids_by_target):
+        """
+        Move messages to several folders, all moves are sent in one round trip and without
+        MOVE the copies are deleted in a second one
+        :param uids_by_target: dictionary of target folder => list of uids
+        :return:
+        dictionary of target folder => list of moved uids
+        """
+        targets = sorted(t for t in uids_by_target.keys() if len(uids_by_target[t]) > 0)
+        if len(targets) == 0:
+            return {}
+
+        use_move = self.has_capability('MOVE')
+        pipe = self.pipeline()
+        for target in targets:
+            pipe.uid('MOVE' if use_move else 'COPY', self.sequence_set(uids_by_target[target]), target)
+
+        moved = {}
+        for target, (result, data) in zip(targets, pipe.execute()):
+            if result != 'OK':
+                logger.error('items not %s to %s, %s', 'moved' if use_move else 'copied', target, str(data))
+                moved[target] = []
+            else:
+                moved[target] = list(uids_by_target[target])
+
+        copied = [uid for target in targets for uid in moved[target]]
+        if not use_move and len(copied) > 0:
+            uid_str = self.sequence_set(copied)
+            pipe.uid('STORE', uid_str, '+FLAGS', '(\Deleted)')
+            if self.has_capability('UIDPLUS'):
+                pipe.uid('EXPUNGE', uid_str)
+            else:
+                pipe.command('EXPUNGE')
+            results = pipe.execute()
+            if results[0][0] != 'OK':
+                logger.error('items not deleted, %s' % str(results[0][1]))
+        trace('moved %s', str(moved))
+        return moved
 
     def move_uid(self, uid, to_folder):
-        result, data = self.imap.uid('COPY', uid, to_folder)
-        if result == 'OK':
-            self.delete_uids([uid])
-        else:
-            logger.error('item not copied, %s' % str(data))
+        self.move_uids([uid], to_folder)
 
-    def forward_message(self, uid, to_user, smtp_server, smtp_login=None, smtp_passwd=None, smtp_port=587):
-        email_message = self.fetch_uid_headers([uid])
-        if len(email_message) > 0 and 'From' in email_message[0]:
-            try:
-                server = smtplib.SMTP(smtp_server, smtp_port)
-                server.ehlo()
-                server.starttls()
-                if smtp_login is not None:
-                    server.login(smtp_login, smtp_passwd)
-                server.sendmail(email_message[0]['From'], to_user, self.fetch_uid(uid))
-                server.quit()
-                from_user = email_message[0]['From']
-                logger.debug('Forwarded message from %s to %s', from_user, to_user)
-            except Exception as e:
-                logger.error('Failed to forward mail from %s, %s', email_message[0]['From'], e.message)
-                raise e
-        else:
-            from_user = None
+    def fetch_messages(self, uids, mark_read=None):
+        """
+        Fetch whole messages in one round trip, flags for earlier messages can ride along
+        :param uids: list of uids to fetch
+        :param mark_read: optional list of uids to flag \Seen in the same round trip
+        :return:
+        dictionary of uid => raw message
+        """
+        pipe = self.pipeline()
+        if mark_read:
+            pipe.uid('STORE', self.sequence_set(mark_read), '+FLAGS', '(\Seen)')
+        for uid in uids:
+            pipe.uid('FETCH', uid, '(BODY.PEEK[])')
+        results = pipe.execute()
+
+        if mark_read and results[0][0] != 'OK':
+            logger.error('%s not marked read, %s', str(mark_read), str(results[0][1]))
+        messages = {}
+        for uid, (result, data) in zip(uids, results[1:] if mark_read else results):
+            literals = [d[1] for d in data if isinstance(d, tuple)]
+            if result == 'OK' and len(literals) > 0:
+                messages[uid] = literals[0]
+            else:
+                logger.warning('%s: fetch failed, %s', uid, str(data))
+        return messages
+
+    def iter_messages(self, uids, batch_size=MAX_FETCH_HEADERS):
+        """
+        Fetch whole messages with one FETCH per batch, each is yielded as it is read
+        :param uids: list of uids
+        :param batch_size: uids per FETCH command
+        :return:
+        iterator of (uid, raw message)
+        """
+        return self.iter_fetch(uids, 'BODY.PEEK[]', batch_size=batch_size)
+
+    def fetch_sizes(self, uids):
+        """
+        :param uids: list of uids
+        :return:
+        dictionary of uid => RFC822.SIZE in bytes
+        """
+        sizes = {}
+        if len(uids) == 0:
+            return sizes
+        result, data = self.imap.uid('FETCH', self.sequence_set(uids), '(RFC822.SIZE)')
+        if result != 'OK':
+            raise LookupError('%s not found' % str(uids))
+        for dat in data:
+            found = re.search('UID (\d+)', dat or '')
+            size = re.search('RFC822\.SIZE (\d+)', dat or '')
+            if found is not None and size is not None:
+                sizes[found.group(1)] = int(size.group(1))
+        return sizes
+
+    def iter_message_chunks(self, uid, size, chunk_size=STREAM_CHUNK_SIZE, read_ahead=STREAM_READ_AHEAD):
+        """
+        Fetch a message in pieces with partial BODY.PEEK[]<offset.length> fetches, the next
+        pieces are requested before the current one is read so the transfer does not stall
+        :param uid: message uid
+        :param size: RFC822.SIZE of the message
+        :param chunk_size: bytes per partial fetch
+        :param read_ahead: partial fetches in flight, memory use is about read_ahead * chunk_size
+        :return:
+        iterator of message pieces
+        """
+        offsets = range(0, size, chunk_size)
+        pending = []
+        try:
+            while len(offsets) > 0 or len(pending) > 0:
+                while len(offsets) > 0 and len(pending) < read_ahead:
+                    item = '(BODY.PEEK[]<%d.%d>)' % (offsets.pop(0), chunk_size)
+                    pending.append(self.imap._command('UID', 'FETCH', uid, item))
+                self._bound_reads()
+                result, data = self.imap._command_complete('FETCH', pending.pop(0))
+                literals = [d[1] for d in self.imap.untagged_responses.pop('FETCH', []) if isinstance(d, tuple)]
+                if result != 'OK' or len(literals) == 0:
+                    raise LookupError('%s: partial fetch failed, %s' % (uid, str(data)))
+                yield literals[0]
+        finally:
+            for tag in pending:
+                self._drain_fetch(tag)
+
+    def stream_message(self, uid, size, from_user, to_user, smtp, chunk_size=STREAM_CHUNK_SIZE):
+        """
+        Forward a large message from IMAP to SMTP without holding it in memory
+        :param uid: message uid
+        :param size: RFC822.SIZE of the message
+        :param from_user: From of the message, the envelope sender
+        :param to_user: envelope recipient
+        :param smtp: SmtpForwarder
+        :param chunk_size: bytes per partial fetch
+        :return:
+        from_user
+        """
+        try:
+            smtp.send_stream(from_user, to_user, self.iter_message_chunks(uid, size, chunk_size=chunk_size))
+            logger.debug('Streamed %d byte message from %s to %s', size, from_user, to_user)
+        except Exception as e:
+            logger.error('Failed to forward mail from %s, %s', from_user, str(e))
+            raise e
+        return from_user
+
+    def send_message(self, message, to_user, smtp_server=None, smtp_login=None, smtp_passwd=None, smtp_port=587,
+                     smtp=None):
+        """
+        Send a raw message on, the envelope sender is the message's From
+        :param message: raw message
+        :param to_user: envelope recipient
+        :param smtp_server: smtp server, a session is opened for this message only
+        :param smtp_login: optional smtp login name
+        :param smtp_passwd: smtp password
+        :param smtp_port: smtp port
+        :param smtp: optional SmtpForwarder to send on instead of opening a session
+        :return:
+        From of the message or None if it has none
+        """
+        from_user = self._parse_header_fields(re.split('\r?\n\r?\n', message, 1)[0]).get('from')
+        if from_user is None:
+            return None
+        try:
+            if smtp is not None:
+                smtp.send(from_user, to_user, message)
+            else:
+                with SmtpForwarder(smtp_server, port=smtp_port, login=smtp_login, password=smtp_passwd,
+                                   rate=0) as session:
+                    session.send(from_user, to_user, message)
+            logger.debug('Forwarded message from %s to %s', from_user, to_user)
+        except Exception as e:
+            logger.error('Failed to forward mail from %s, %s', from_user, str(e))
+            raise e
         return from_user
+
+    def forward_message(self, uid, to_user, smtp_server, smtp_login=None, smtp_passwd=None, smtp_port=587):
+        message = self.fetch_messages([uid]).get(uid)
+        if message is None:
+            return None
+        return self.send_message(message, to_user, smtp_server, smtp_login=smtp_login, smtp_passwd=smtp_passwd,
+                                 smtp_port=smtp_port)
@@ -0,0 +1,395 @@
+# Copyright (c) 2016, Kevin Rodgers
+# Released subject to the New BSD License
+# Please see http://en.wikipedia.org/wiki/BSD_licenses
+
+import time
+import threading
+from contextlib import contextmanager
+from active_mail_filter import get_logger, trace
+
+PREFIX = 'amf_'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEF_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+# most label sets kept per metric, protects the daemon from an unbounded number of users or folders
+MAX_CHILDREN = 10000
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if len(pairs) == 0:
+        return ''
+    escaped = [(n, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for n, v in pairs]
+    return '{%s}' % ','.join('%s="%s"' % (n, v) for n, v in escaped)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+class Metric(object):
+    metric_type = 'untyped'
+    # drain() hands counts over as increments and starts them again from zero
+    cumulative = False
+
+    def __init__(self, name, doc, labels=()):
+        """
+        A named value per label set, the Prometheus text format is produced by render()
+
+        :param name: metric name without the amf_ prefix
+        :param doc: help text
+        :param labels: label names, every update passes a value for each
+        """
+        self.name = PREFIX + name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.children = {}
+        self.changed = set()
+        if len(self.labels) == 0:
+            self.children[()] = self._new_child()
+
+    def __str__(self):
+        return '%s [name=%s, labels=%s, children=%d]' % \
+               (self.__class__.__name__, self.name, str(self.labels), len(self.children))
+
+    def _key(self, labels):
+        if sorted(labels.keys()) != sorted(self.labels):
+            raise ValueError('%s: expected labels %s got %s' % (self.name, str(self.labels), str(labels.keys())))
+        return tuple(labels[n] for n in self.labels)
+
+    def _child(self, labels):
+        # caller holds the lock
+        return self._add_child(self._key(labels))
+
+    def _add_child(self, key):
+        # caller holds the lock
+        if key not in self.children:
+            if len(self.children) >= MAX_CHILDREN:
+                trace('%s: label limit reached, dropping %s', self.name, str(key))
+                return None
+            self.children[key] = self._new_child()
+        self.changed.add(key)
+        return key
+
+    def _new_child(self):
+        return 0.0
+
+    def remove(self, **labels):
+        with self.lock:
+            self.children.pop(self._key(labels), None)
+
+    def clear(self):
+        with self.lock:
+            self.children = {(): self._new_child()} if len(self.labels) == 0 else {}
+            self.changed = set()
+
+    def _merged(self, current, value):
+        return value
+
+    def drain(self):
+        """
+        Take the values updated since the last drain, for a process handing its metrics to another
+        :return:
+        dictionary of label values => value, increments for counters and histograms
+        """
+        with self.lock:
+            values = dict((key, self.children[key]) for key in self.changed if key in self.children)
+            self.changed = set()
+            if self.cumulative:
+                for key in values.keys():
+                    self.children[key] = self._new_child()
+            return values
+
+    def merge(self, values):
+        """
+        :param values: what drain() returned in another process
+        :return:
+        """
+        with self.lock:
+            for key, value in values.items():
+                if self._add_child(key) is not None:
+                    self.children[key] = self._merged(self.children[key], value)
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, self.labels, key, (), value) for key, value in sorted(self.children.items())]
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.doc), '# TYPE %s %s' % (self.name, self.metric_type)]
+        for name, label_names, values, extra, value in self.samples():
+            lines.append('%s%s %s' % (name, _format_labels(label_names, values, extra), _format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    metric_type = 'counter'
+    cumulative = True
+
+    def _merged(self, current, value):
+        return current + value
+
+    def inc(self, amount=1, **labels):
+        with self.lock:
+            key = self._child(labels)
+            if key is not None:
+                self.children[key] += amount
+
+    def value(self, **labels):
+        with self.lock:
+            return self.children.get(self._key(labels), 0.0)
+
+
+class Gauge(Counter):
+    metric_type = 'gauge'
+    cumulative = False
+
+    def _merged(self, current, value):
+        return value
+
+    def set(self, value, **labels):
+        with self.lock:
+            key = self._child(labels)
+            if key is not None:
+                self.children[key] = value
+
+
+class Histogram(Metric):
+    metric_type = 'histogram'
+    cumulative = True
+
+    def __init__(self, name, doc, labels=(), buckets=DEF_BUCKETS):
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        Metric.__init__(self, name, doc, labels=labels)
+
+    def _new_child(self):
+        return {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+
+    def _merged(self, current, value):
+        return {'buckets': [a + b for a, b in zip(current['buckets'], value['buckets'])],
+                'sum': current['sum'] + value['sum'], 'count': current['count'] + value['count']}
+
+    def observe(self, value, **labels):
+        with self.lock:
+            key = self._child(labels)
+            if key is None:
+                return
+            child = self.children[key]
+            for i in range(0, len(self.buckets)):
+                if value <= self.buckets[i]:
+                    child['buckets'][i] += 1
+            child['sum'] += value
+            child['count'] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def value(self, **labels):
+        with self.lock:
+            child = self.children.get(self._key(labels))
+            return (child['count'], child['sum']) if child is not None else (0, 0.0)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, child in sorted(self.children.items()):
+                for bound, count in zip(self.buckets, child['buckets']):
+                    samples.append((self.name + '_bucket', self.labels, key, (('le', _format_value(bound)),), count))
+                samples.append((self.name + '_sum', self.labels, key, (), child['sum']))
+                samples.append((self.name + '_count', self.labels, key, (), child['count']))
+        return samples
+
+
+class Registry(object):
+    def __init__(self):
+        """
+        Every metric of the process plus collectors that read their values at scrape time
+        """
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self.collectors = {}
+
+    def __str__(self):
+        return 'Registry [metrics=%d, collectors=%d]' % (len(self.metrics), len(self.collectors))
+
+    def register(self, metric):
+        # registering a name twice returns the first metric so modules can be reloaded
+        with self.lock:
+            existing = self.metrics.get(metric.name)
+            if existing is not None:
+                if existing.__class__ is not metric.__class__ or existing.labels != metric.labels:
+                    raise ValueError('%s is already registered as %s' % (metric.name, str(existing)))
+                return existing
+            self.metrics[metric.name] = metric
+            return metric
+
+    def register_collector(self, name, collector):
+        """
+        :param name: unique name, registering the same name again replaces the collector
+        :param collector: callable returning a list of Metric filled in with current values
+        :return:
+        """
+        with self.lock:
+            self.collectors[name] = collector
+
+    def drain(self):
+        """
+        :return:
+        dictionary of metric name => Metric.drain() for the metrics updated since the last drain
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        drained = {}
+        for metric in metrics:
+            values = metric.drain()
+            if len(values) > 0:
+                drained[metric.name] = values
+        return drained
+
+    def merge(self, drained):
+        """
+        Add the metrics drained from another process, e.g. a worker process, to this one
+        :param drained: what drain() returned
+        :return:
+        """
+        for name, values in drained.items():
+            metric = self.metrics.get(name)
+            if metric is None:
+                trace('%s: not registered, dropped', name)
+                continue
+            metric.merge(values)
+
+    def render(self):
+        with self.lock:
+            metrics = [self.metrics[name] for name in sorted(self.metrics.keys())]
+            collectors = [self.collectors[name] for name in sorted(self.collectors.keys())]
+        for collector in collectors:
+            try:
+                metrics.extend(collector())
+            except Exception as e:
+                get_logger().warning('metrics collector failed, %s', str(e))
+
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, doc, labels=()):
+    return REGISTRY.register(Counter(name, doc, labels=labels))
+
+
+def gauge(name, doc, labels=()):
+    return REGISTRY.register(Gauge(name, doc, labels=labels))
+
+
+def histogram(name, doc, labels=(), buckets=DEF_BUCKETS):
+    return REGISTRY.register(Histogram(name, doc, labels=labels, buckets=buckets))
+
+
+def register_collector(name, collector):
+    REGISTRY.register_collector(name, collector)
+
+
+def render():
+    return REGISTRY.render()
+
+
+IMAP_COMMANDS = counter('imap_commands_total', 'IMAP commands sent', labels=('command',))
+IMAP_LATENCY = histogram('imap_command_seconds', 'Time from sending an IMAP command to its tagged reply',
+                         labels=('command',))
+IMAP_BYTES = counter('imap_bytes_total', 'Bytes exchanged with IMAP servers', labels=('direction',))
+REDIS_CALLS = counter('redis_calls_total', 'Redis round trips, a pipeline counts once', labels=('command',))
+
+
+def instrument_imap(imap):
+    """
+    Count the commands, latency and bytes of one imaplib connection, pipelined and
+    streamed commands are timed from when they are sent to when their tagged reply is read
+    :param imap: imaplib.IMAP4 instance
+    :return:
+    imap
+    """
+    if getattr(imap, '_amf_metrics', False):
+        return imap
+    imap._amf_metrics = True
+    sent = {}
+    command, command_complete = imap._command, imap._command_complete
+    read, readline, send = imap.read, imap.readline, imap.send
+
+    def timed_command(name, *args):
+        label = '%s %s' % (name, args[0].upper()) if name == 'UID' and len(args) > 0 else name
+        tag = command(name, *args)
+        if len(sent) > 1000:
+            # replies drained without _command_complete are never timed
+            sent.clear()
+        sent[tag] = (label, time.time())
+        IMAP_COMMANDS.inc(command=label)
+        return tag
+
+    def timed_command_complete(name, tag):
+        try:
+            return command_complete(name, tag)
+        finally:
+            label, start = sent.pop(tag, (name, None))
+            if start is not None:
+                IMAP_LATENCY.observe(time.time() - start, command=label)
+
+    def counted_read(size):
+        data = read(size)
+        IMAP_BYTES.inc(len(data), direction='in')
+        return data
+
+    def counted_readline():
+        data = readline()
+        IMAP_BYTES.inc(len(data), direction='in')
+        return data
+
+    def counted_send(data):
+        IMAP_BYTES.inc(len(data), direction='out')
+        return send(data)
+
+    imap._command, imap._command_complete = timed_command, timed_command_complete
+    imap.read, imap.readline, imap.send = counted_read, counted_readline, counted_send
+    return imap
+
+
+def instrument_redis(client):
+    """
+    Count the round trips of one redis client
+    :param client: redis.Redis instance
+    :return:
+    client
+    """
+    if getattr(client, '_amf_metrics', False):
+        return client
+    client._amf_metrics = True
+    execute_command, pipeline = client.execute_command, client.pipeline
+
+    def counted_execute_command(*args, **kwargs):
+        REDIS_CALLS.inc(command=str(args[0]).upper())
+        return execute_command(*args, **kwargs)
+
+    def counted_pipeline(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        execute = pipe.execute
+
+        def counted_execute(*exec_args, **exec_kwargs):
+            REDIS_CALLS.inc(command='PIPELINE')
+            return execute(*exec_args, **exec_kwargs)
+        pipe.execute = counted_execute
+        return pipe
+
+    client.execute_command, client.pipeline = counted_execute_command, counted_pipeline
+    return client
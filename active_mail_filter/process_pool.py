@@ -0,0 +1,293 @@
+# Copyright (c) 2016, Kevin Rodgers
+# Released subject to the New BSD License
+# Please see http://en.wikipedia.org/wiki/BSD_licenses
+
+import os
+import time
+import zlib
+import signal
+import logging
+import cProfile
+import itertools
+import threading
+import multiprocessing
+from Queue import Empty
+from active_mail_filter import get_logger, trace
+from active_mail_filter.metrics import REGISTRY, counter
+from active_mail_filter.stoppable_thread import StoppableThread
+from active_mail_filter.tracing import SLOW_RULES, CYCLE_PROFILER
+from active_mail_filter.worker_pool import WorkerPool, WorkerJob, DEF_MAX_WORKERS, DEF_MAX_PER_SERVER, \
+    DEF_BACKOFF, DEF_MAX_BACKOFF, HUNG_TIMEOUT
+
+logger = get_logger()
+
+DEF_PROCESSES = 2
+PROCESS_PREFIX = 'process'
+# seconds between checks while blocked on a queue, bounds how long a dead process goes unnoticed
+POLL_TIMEOUT = 1.0
+# seconds a process has to finish its running jobs once told to stop
+STOP_TIMEOUT = 10.0
+
+PROCESSES_RESTARTED = counter('worker_processes_restarted_total', 'Worker processes started again after exiting')
+
+
+class WorkerProcessDied(Exception):
+    pass
+
+
+class WorkerProcessError(Exception):
+    pass
+
+
+def partition(name, count):
+    """
+    :param name: user
+    :param count: number of processes
+    :return:
+    index of the process that runs the user, the same on every call so its connections and caches are reused
+    """
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    return (zlib.crc32(name) & 0xffffffff) % count
+
+
+def _reinit_locks():
+    # a lock held by another supervisor thread at the fork would never be released in the child
+    logging._lock = threading.RLock()
+    for ref in logging._handlerList:
+        handler = ref()
+        if handler is not None:
+            handler.createLock()
+    REGISTRY.lock = threading.Lock()
+    for metric in REGISTRY.metrics.values():
+        metric.lock = threading.Lock()
+    SLOW_RULES.lock = threading.Lock()
+    CYCLE_PROFILER.lock = threading.Lock()
+
+
+class _ProcessWorkerPool(WorkerPool):
+    # the worker threads inside one worker process, a job can ask to be profiled
+    def _run(self, job):
+        if not job.profile:
+            return self.target(job.records)
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(self.target, job.records)
+        finally:
+            profiler.create_stats()
+            job.stats = profiler.stats
+
+
+def _process_main(target, inbox, outbox, parent_pid, max_workers, max_per_server, hung_timeout,
+                  initializer, report):
+    # the supervisor stops its processes, a signal sent to the whole group is left to it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    _reinit_locks()
+    # values inherited from the supervisor have already been counted there
+    REGISTRY.drain()
+    SLOW_RULES.clear()
+    # each job says whether to profile it, a cycle being profiled in the supervisor is not inherited
+    CYCLE_PROFILER.armed = CYCLE_PROFILER.active = False
+    if initializer is not None:
+        initializer()
+
+    def reply(job_id, job):
+        outbox.put({'id': job_id,
+                    'result': job.result,
+                    'failed': job.failed,
+                    'error': job.error,
+                    'metrics': REGISTRY.drain(),
+                    'slow_rules': SLOW_RULES.drain(),
+                    'profile': getattr(job, 'stats', None),
+                    'report': report() if report is not None else None})
+
+    # failures are backed off by the supervisor, not again here
+    pool = _ProcessWorkerPool(target, max_workers=max_workers, max_per_server=max_per_server, backoff=0, max_backoff=0)
+    while os.getppid() == parent_pid:
+        pool.kill_hung_workers(hung_timeout)
+        try:
+            message = inbox.get(timeout=POLL_TIMEOUT)
+        except Empty:
+            continue
+        if message is None:
+            break
+
+        job_id, name, server, records, profile = message
+        job = WorkerJob(name, server, records, on_done=lambda done, job_id=job_id: reply(job_id, done))
+        job.profile = profile
+        if pool.submit([job]) == 0:
+            # the supervisor gave up waiting on an earlier run of this user that is still going
+            job.failed = True
+            job.error = 'an earlier run is still in progress'
+            reply(job_id, job)
+
+    pool.stop()
+    pool.wait(hung_timeout=hung_timeout, is_stopped=lambda: os.getppid() != parent_pid)
+    trace('%s: exiting', multiprocessing.current_process().name)
+
+
+class WorkerProcess(object):
+    def __init__(self, index):
+        """
+        One worker process and the queues to and from it, replaced when the process exits
+
+        :param index: partition number
+        """
+        self.index = index
+        self.name = '%s:%d' % (PROCESS_PREFIX, index)
+        self.process = None
+        self.inbox = None
+        self.waiting = {}
+        self.report = None
+        self.restarts = 0
+
+    def __str__(self):
+        return 'WorkerProcess [name=%s, pid=%s, waiting=%d]' % \
+               (self.name, str(self.process.pid if self.process is not None else None), len(self.waiting))
+
+    def is_alive(self):
+        return self.process is not None and self.process.is_alive()
+
+
+class ProcessPool(WorkerPool):
+    def __init__(self, target, processes=DEF_PROCESSES, max_workers=DEF_MAX_WORKERS,
+                 max_per_server=DEF_MAX_PER_SERVER, backoff=DEF_BACKOFF, max_backoff=DEF_MAX_BACKOFF,
+                 hung_timeout=HUNG_TIMEOUT, initializer=None, report=None):
+        """
+        Worker pool whose jobs run in worker processes, so header parsing and matching use
+        more than one core. Users are partitioned across the processes, each process runs its
+        jobs on its own threads and sends the result, its metrics, slow rules and profile back.
+        Queueing, fairness, backoff and completion callbacks stay in this process
+
+        :param target: called as target(records) in a worker process, must return a picklable value
+        :param processes: number of worker processes
+        :param max_workers: most jobs running at once across all processes
+        :param max_per_server: most jobs running at once against one mail server
+        :param backoff: seconds a user whose job raised is left out of submit()
+        :param max_backoff: longest a failing user is left out
+        :param hung_timeout: seconds after which a worker process kills a job's thread
+        :param initializer: optional callable run first in each new worker process
+        :param report: optional callable run in a worker process after each job, its latest
+        picklable return value per process is kept for reports()
+        """
+        WorkerPool.__init__(self, target, max_workers=max_workers, max_per_server=max_per_server,
+                            backoff=backoff, max_backoff=max_backoff)
+        self.hung_timeout = hung_timeout
+        self.initializer = initializer
+        self.report = report
+        self.processes = [WorkerProcess(i) for i in range(0, processes)]
+        self.process_lock = threading.Lock()
+        self.job_ids = itertools.count(1)
+
+    def __str__(self):
+        return 'ProcessPool [processes=%d, max_workers=%d, max_per_server=%d, queued=%d]' % \
+               (len(self.processes), self.max_workers, self.max_per_server, len(self.pending))
+
+    def _start_process(self, worker):
+        # caller holds the process lock, processes are only forked when a job needs one
+        if worker.process is not None:
+            logger.error('%s: pid %d exited with code %s, restarting', worker.name, worker.process.pid,
+                         str(worker.process.exitcode))
+            worker.restarts += 1
+            PROCESSES_RESTARTED.inc()
+        worker.inbox = multiprocessing.Queue()
+        outbox = multiprocessing.Queue()
+        worker.waiting = {}
+        worker.process = multiprocessing.Process(name=worker.name, target=_process_main,
+                                                 args=(self.target, worker.inbox, outbox, os.getpid(),
+                                                       self.max_workers, self.max_per_server, self.hung_timeout,
+                                                       self.initializer, self.report))
+        worker.process.daemon = True
+        worker.process.start()
+        logger.info('%s: started pid %d', worker.name, worker.process.pid)
+
+        th = StoppableThread(name='%s:replies' % worker.name, target=self._read_replies,
+                             args=(worker, worker.process, outbox, worker.waiting))
+        th.setDaemon(True)
+        th.start()
+
+    def _read_replies(self, worker, process, outbox, waiting):
+        my_thread = StoppableThread.current_thread()
+        while not my_thread.is_stopped():
+            try:
+                reply = outbox.get(timeout=POLL_TIMEOUT)
+            except Empty:
+                if not process.is_alive():
+                    break
+                continue
+
+            REGISTRY.merge(reply['metrics'])
+            SLOW_RULES.merge(reply['slow_rules'])
+            if reply['profile'] is not None:
+                CYCLE_PROFILER.add_stats(reply['profile'])
+            with self.process_lock:
+                if reply['report'] is not None:
+                    worker.report = reply['report']
+                entry = waiting.get(reply['id'])
+                if entry is not None:
+                    entry[1] = reply
+                    entry[0].set()
+        trace('%s: exiting', my_thread.getName())
+
+    def _run(self, job):
+        with self.process_lock:
+            worker = self.processes[partition(job.name, len(self.processes))]
+            if not worker.is_alive():
+                self._start_process(worker)
+            process, inbox, waiting = worker.process, worker.inbox, worker.waiting
+            job_id = next(self.job_ids)
+            entry = waiting[job_id] = [threading.Event(), None]
+
+        try:
+            inbox.put((job_id, job.name, job.server, job.records, CYCLE_PROFILER.active))
+            # short waits keep this thread killable by kill_hung_workers()
+            while not entry[0].wait(POLL_TIMEOUT):
+                if not process.is_alive() and not entry[0].wait(POLL_TIMEOUT):
+                    raise WorkerProcessDied('%s: pid %d exited with code %s' %
+                                            (worker.name, process.pid, str(process.exitcode)))
+        finally:
+            with self.process_lock:
+                waiting.pop(job_id, None)
+
+        reply = entry[1]
+        if reply['failed']:
+            raise WorkerProcessError(reply['error'])
+        return reply['result']
+
+    def stop(self):
+        WorkerPool.stop(self)
+        with self.process_lock:
+            workers = [w for w in self.processes if w.process is not None]
+            for worker in workers:
+                worker.inbox.put(None)
+
+        deadline = time.time() + STOP_TIMEOUT
+        for worker in workers:
+            worker.process.join(max(0.0, deadline - time.time()))
+            if worker.process.is_alive():
+                logger.warning('%s: pid %d did not exit, terminating', worker.name, worker.process.pid)
+                worker.process.terminate()
+                worker.process.join(POLL_TIMEOUT)
+            with self.process_lock:
+                # a later submit() starts a new process without counting a restart
+                worker.process = None
+                worker.report = None
+
+    def reports(self):
+        """
+        :return:
+        the latest report of each running worker process
+        """
+        with self.process_lock:
+            return [w.report for w in self.processes if w.is_alive() and w.report is not None]
+
+    def stats(self):
+        stats = WorkerPool.stats(self)
+        with self.process_lock:
+            stats['processes'] = dict((w.name, {'pid': w.process.pid if w.process is not None else None,
+                                                'alive': w.is_alive(),
+                                                'running': len(w.waiting),
+                                                'restarts': w.restarts})
+                                      for w in self.processes)
+        return stats
@@ -0,0 +1,74 @@
+# Copyright (c) 2016, Kevin Rodgers
+# Released subject to the New BSD License
+# Please see http://en.wikipedia.org/wiki/BSD_licenses
+
+import threading
+from copy import deepcopy
+from active_mail_filter import get_logger, trace
+from active_mail_filter.user_records import UUID
+
+logger = get_logger()
+
+
+class RuleCache(object):
+    def __init__(self, userdb):
+        """
+        In memory copy of the user records with decrypted passwords, only records whose
+        revision changed are read back from redis
+
+        :param userdb: UserRecords
+        """
+        self.userdb = userdb
+        self.version = None
+        self.revisions = {}
+        self.records = {}
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return 'RuleCache [version=%s, records=%d]' % (str(self.version), len(self.records))
+
+    def refresh(self):
+        """
+        Reload the records that were added or updated since the last refresh
+        :return:
+        True if anything changed
+        """
+        with self.lock:
+            # read the version first, a write racing with the reload is seen next time
+            version = self.userdb.get_version()
+            if version == self.version:
+                trace('rule cache is current, version %d', version)
+                return False
+
+            revisions = self.userdb.get_revisions()
+            changed = [uuid for uuid in revisions.keys() if self.revisions.get(uuid) != revisions[uuid]]
+            removed = [uuid for uuid in self.records.keys() if uuid not in revisions]
+
+            for uuid in removed:
+                del self.records[uuid]
+            for rec in self.userdb.get_users_by_uuid(changed):
+                self.records[rec[UUID]] = rec
+
+            logger.debug('rule cache version %s => %d, %d changed, %d removed', str(self.version), version,
+                         len(changed), len(removed))
+            self.revisions = revisions
+            self.version = version
+            return True
+
+    def invalidate(self):
+        with self.lock:
+            self.version = None
+            self.revisions = {}
+            self.records = {}
+
+    def get_all_users(self):
+        self.refresh()
+        with self.lock:
+            return [deepcopy(rec) for rec in self.records.values()]
+
+    def get_user_by_uuid(self, uuid):
+        self.refresh()
+        with self.lock:
+            if uuid not in self.records:
+                raise LookupError('%s key not found' % uuid)
+            return deepcopy(self.records[uuid])
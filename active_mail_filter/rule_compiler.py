@@ -0,0 +1,260 @@
+# Copyright (c) 2016, Kevin Rodgers
+# Released subject to the New BSD License
+# Please see http://en.wikipedia.org/wiki/BSD_licenses
+
+import re
+import time
+from active_mail_filter import get_logger, read_configuration_file, trace
+from active_mail_filter.metrics import counter, gauge, histogram
+from active_mail_filter.sender_address import parse_from, canonical_address
+from active_mail_filter.tracing import span, RULE_SPAN
+from active_mail_filter.user_records import UUID, USER, SOURCE, TARGET
+
+_CONF_ = read_configuration_file()
+
+logger = get_logger()
+
+SEARCH_AUTO = 'auto'
+SEARCH_SERVER = 'server'
+SEARCH_CLIENT = 'client'
+SEARCH_STRATEGIES = (SEARCH_AUTO, SEARCH_SERVER, SEARCH_CLIENT)
+
+# senders per SEARCH, the OR tree is balanced so this is 8 levels deep
+SEARCH_BATCH_SIZE = 256
+# From headers worth fetching to save one SEARCH round trip over the folder
+CLIENT_MESSAGES_PER_SEARCH = 200
+
+MESSAGES_SCANNED = counter('messages_scanned_total', 'Messages whose From header was checked against the rules')
+MESSAGES_MATCHED = counter('messages_matched_total', 'Messages from a sender filed in a target folder')
+MESSAGES_MOVED = counter('messages_moved_total', 'Messages moved to a target folder')
+USER_SECONDS = histogram('user_filter_seconds', 'Time to run all of one user\'s rules')
+USER_LAST_SECONDS = gauge('user_filter_last_seconds', 'Time the last run of a user\'s rules took', labels=('user',))
+RULE_SECONDS = histogram('rule_filter_seconds', 'Time to filter one source folder of one user')
+RULE_LAST_SECONDS = gauge('rule_filter_last_seconds', 'Time the last pass over a source folder took',
+                          labels=('user', 'source'))
+
+
+def rule_order(rule):
+    # conflicting rules resolve by target folder name then rule uuid, the first rule to claim a sender wins
+    return rule[TARGET].lower(), rule[UUID]
+
+
+class CompiledSource(object):
+    def __init__(self, source, rule_records):
+        """
+        All of one user's rules that share a source folder, the source folder is searched
+        once and each matched message is moved to the target folder that claims its sender
+
+        :param source: source folder name
+        :param rule_records: rules whose SOURCE is source
+        """
+        self.source = source
+        self.rules = sorted(rule_records, key=rule_order)
+        self.targets = [r[TARGET] for r in self.rules if r[TARGET] != source]
+        self.sender_targets = {}
+        self.search_keys = {}
+        self.conflicts = 0
+
+    def __str__(self):
+        return 'CompiledSource [source=%s, targets=%s, senders=%d]' % \
+               (self.source, str(self.targets), len(self.sender_targets))
+
+    def load_senders(self, mailbox, sender_index=None):
+        """
+        Build the canonical sender => target folder map from the messages filed in each target
+        :param mailbox: connected MboxFolder
+        :param sender_index: optional SenderIndex, otherwise every target folder is fetched
+        :return:
+        set of canonical senders added to the index by this load, None without a sender index
+        """
+        self.sender_targets = {}
+        self.search_keys = {}
+        self.conflicts = 0
+        new_senders = set() if sender_index is not None else None
+        for target in self.targets:
+            if sender_index is not None:
+                new_senders.update(canonical_address(f) for f in sender_index.update(mailbox, target))
+                from_list = sender_index.get_senders(mailbox.host, mailbox.username, target)
+            else:
+                from_list = mailbox.list_from_addresses(folder_name=target)
+            for from_string in from_list:
+                address, sender = parse_from(from_string)
+                if not sender:
+                    continue
+                # SEARCH FROM is a substring match, every spelling seen and the canonical form are searched for
+                self.search_keys.setdefault(sender, set()).update((address.lower(), sender))
+                if sender not in self.sender_targets:
+                    self.sender_targets[sender] = target
+                elif self.sender_targets[sender] != target:
+                    trace('%s: %s is filed in %s and %s, using %s', mailbox.username, sender,
+                          self.sender_targets[sender], target, self.sender_targets[sender])
+                    self.conflicts += 1
+        return new_senders
+
+    @staticmethod
+    def _range_size(mailbox, folder, uid_range):
+        # upper bound on the messages a search over uid_range can see
+        found = re.match('^(\d+):(\d+|\*)$', uid_range or '')
+        if found is None:
+            return mailbox.folder_status(folder, 'MESSAGES').get('MESSAGES', 0)
+        if found.group(2) == '*':
+            return max(0, mailbox.folder_status(folder, 'UIDNEXT').get('UIDNEXT', 0) - int(found.group(1)))
+        return max(0, int(found.group(2)) - int(found.group(1)) + 1)
+
+    def choose_strategy(self, mailbox, sender_count, batch_size=SEARCH_BATCH_SIZE, uid_range=None):
+        """
+        Fetching every candidate's From header beats searching when there are few
+        candidates compared to the number of SEARCH commands the senders need, senders
+        that do not fit in one SEARCH are always matched on the client, each extra batch
+        makes the server scan the whole folder again
+        :param mailbox: connected MboxFolder
+        :param sender_count: senders being searched for
+        :param batch_size: senders per SEARCH command
+        :param uid_range: optional UID set limiting the search
+        :return:
+        SEARCH_SERVER or SEARCH_CLIENT
+        """
+        searches = (sender_count + batch_size - 1) // batch_size
+        if searches > 1:
+            trace('%s: %d senders need %d searches, using %s', self.source, sender_count, searches, SEARCH_CLIENT)
+            return SEARCH_CLIENT
+        candidates = self._range_size(mailbox, self.source, uid_range)
+        strategy = SEARCH_CLIENT if candidates <= searches * CLIENT_MESSAGES_PER_SEARCH else SEARCH_SERVER
+        trace('%s: %d candidates, %d searches, using %s', self.source, candidates, searches, strategy)
+        return strategy
+
+    def _search_senders(self, mailbox, senders, batch_size, uid_range):
+        # every batch is searched in the same round trip
+        addresses = sorted(set(a for s in senders for a in self.search_keys.get(s, ())))
+        batches = [addresses[i:i+batch_size] for i in range(0, len(addresses), batch_size)]
+        if len(batches) == 0:
+            return []
+        return mailbox.list_email_uids_from_user_batches(batches, from_folder=self.source, uid_range=uid_range)
+
+    def filter_mail(self, mailbox, batch_size=SEARCH_BATCH_SIZE, uid_range=None, strategy=SEARCH_AUTO, senders=None):
+        """
+        Find the source folder's messages from known senders and move them
+        :param mailbox: connected MboxFolder
+        :param batch_size: senders per SEARCH command
+        :param uid_range: optional UID set limiting the search, e.g. new mail only
+        :param strategy: SEARCH_SERVER searches for the senders, SEARCH_CLIENT fetches the From
+        header of every candidate and matches locally, SEARCH_AUTO picks one
+        :param senders: optional subset of the loaded canonical senders to look for
+        :return:
+        dictionary of target folder => list of moved uids
+        """
+        if senders is None:
+            sender_targets = self.sender_targets
+        else:
+            sender_targets = dict((s, self.sender_targets[s]) for s in senders if s in self.sender_targets)
+        if len(sender_targets) == 0:
+            return {}
+
+        if strategy == SEARCH_AUTO:
+            strategy = self.choose_strategy(mailbox, len(sender_targets), batch_size=batch_size, uid_range=uid_range)
+        if strategy == SEARCH_CLIENT:
+            pattern = '(UID %s)' % uid_range if uid_range is not None else 'ALL'
+            email_uids = mailbox.list_email_uids(folder_name=self.source, pattern=pattern)
+        else:
+            email_uids = self._search_senders(mailbox, sender_targets.keys(), batch_size, uid_range)
+
+        # SEARCH FROM is a substring match, the From header decides which target gets the message
+        by_target = {}
+        for uid, email_from in mailbox.iter_from_addresses(email_uids):
+            MESSAGES_SCANNED.inc()
+            target = sender_targets.get(canonical_address(email_from)) if email_from is not None else None
+            if target is not None:
+                MESSAGES_MATCHED.inc()
+                by_target.setdefault(target, []).append(uid)
+
+        moved = mailbox.move_uids_by_target(by_target)
+        MESSAGES_MOVED.inc(sum(len(uids) for uids in moved.values()))
+        return moved
+
+
+def compile_rules(rule_records):
+    """
+    Merge one user's rules by source folder
+    :param rule_records: rules of one user
+    :return:
+    list of CompiledSource ordered by source folder
+    """
+    by_source = {}
+    for rule in rule_records:
+        by_source.setdefault(rule[SOURCE], []).append(rule)
+    return [CompiledSource(source, by_source[source]) for source in sorted(by_source.keys())]
+
+
+def _filter_from_checkpoint(mailbox, compiled, new_senders, checkpoints, strategy):
+    # new mail is matched against every sender, newly indexed senders against the whole folder
+    user = mailbox.username
+    status = mailbox.folder_status(compiled.source, checkpoints.status_items(mailbox))
+    checkpoint = checkpoints.get_checkpoint(user, compiled.source)
+
+    reason = checkpoints.needs_full_sweep(checkpoint, status, compiled.targets)
+    if reason is not None:
+        logger.debug('%s: full sweep of %s, %s', user, compiled.source, reason)
+        moved = compiled.filter_mail(mailbox, strategy=strategy)
+        checkpoints.save_checkpoint(user, compiled.source, status, compiled.targets, full_sweep=True)
+        return moved
+
+    uid_range = checkpoints.new_uid_range(checkpoint, status)
+    if uid_range is None and len(new_senders) == 0:
+        trace('%s: %s unchanged since checkpoint', user, compiled.source)
+        return {}
+
+    moved = {}
+    if uid_range is not None:
+        trace('%s: filtering new uids %s in %s', user, uid_range, compiled.source)
+        moved = compiled.filter_mail(mailbox, uid_range=uid_range, strategy=strategy)
+    if len(new_senders) > 0:
+        trace('%s: searching %s for %d new senders', user, compiled.source, len(new_senders))
+        for target, uids in compiled.filter_mail(mailbox, strategy=strategy, senders=new_senders).items():
+            moved[target] = moved.get(target, []) + uids
+    checkpoints.save_checkpoint(user, compiled.source, status, compiled.targets)
+    return moved
+
+
+def filter_user_rules(mailbox, rule_records, sender_index=None, checkpoints=None, uid_range=None, strategy=None,
+                      is_stopped=None):
+    """
+    Run all of one user's rules with one search pass per source folder
+    :param mailbox: MboxFolder for the user
+    :param rule_records: rules of one user
+    :param sender_index: optional SenderIndex
+    :param checkpoints: optional FolderCheckpoints, used with a sender_index and no uid_range to
+    filter only what changed since the last pass
+    :param uid_range: optional UID set limiting the search
+    :param strategy: one of SEARCH_STRATEGIES, default is filter_daemon search_strategy
+    :param is_stopped: optional callable, remaining source folders are skipped once it returns True
+    :return:
+    number of messages moved
+    """
+    if strategy is None:
+        strategy = _CONF_['filter_daemon']['search_strategy'].lower()
+    if strategy not in SEARCH_STRATEGIES:
+        raise ValueError('unknown search strategy %s' % strategy)
+
+    moved_count = 0
+    mailbox.connect()
+    for compiled in compile_rules(rule_records):
+        if is_stopped is not None and is_stopped():
+            break
+
+        user = compiled.rules[0][USER]
+        start = time.time()
+        with span(RULE_SPAN, user=user, source=compiled.source):
+            new_senders = compiled.load_senders(mailbox, sender_index=sender_index)
+            logger.debug('%s: filtering %s into %s, %d senders, %d conflicts', user, compiled.source,
+                         str(compiled.targets), len(compiled.sender_targets), compiled.conflicts)
+            if checkpoints is not None and new_senders is not None and uid_range is None:
+                moved = _filter_from_checkpoint(mailbox, compiled, new_senders, checkpoints, strategy)
+            else:
+                moved = compiled.filter_mail(mailbox, uid_range=uid_range, strategy=strategy)
+        RULE_SECONDS.observe(time.time() - start)
+        RULE_LAST_SECONDS.set(time.time() - start, user=user, source=compiled.source)
+        for target in sorted(moved.keys()):
+            if len(moved[target]) > 0:
+                logger.info('%s: moved %d messages %s to %s', user, len(moved[target]), str(moved[target]), target)
+                moved_count += len(moved[target])
+    return moved_count
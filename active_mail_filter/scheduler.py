@@ -0,0 +1,213 @@
+# Copyright (c) 2016, Kevin Rodgers
+# Released subject to the New BSD License
+# Please see http://en.wikipedia.org/wiki/BSD_licenses
+
+import time
+import heapq
+import random
+import itertools
+import threading
+from active_mail_filter import get_logger, trace
+from active_mail_filter.metrics import histogram
+from active_mail_filter.user_records import MAILSERVER
+
+logger = get_logger()
+
+DEF_INTERVAL = 60
+DEF_MIN_INTERVAL = 30
+DEF_MAX_INTERVAL = 900
+DEF_JITTER = 0.1
+DEF_PROVIDER_RATE = 5.0
+DEF_STALE_TIMEOUT = 1800
+# interval multipliers after a run that moved mail and one that did not
+SPEED_UP = 0.5
+SLOW_DOWN = 1.5
+
+SCHEDULE_LAG = histogram('schedule_lag_seconds', 'Time between a user\'s planned start and its hand off to a worker')
+
+
+class UserSchedule(object):
+    def __init__(self, name, server, records, interval, min_interval):
+        self.name = name
+        self.server = server
+        self.records = records
+        self.interval = interval
+        self.min_interval = min_interval
+        self.next_run = 0.0
+        self.reserved = None
+        self.running = None
+
+    def __str__(self):
+        return 'UserSchedule [name=%s, server=%s, interval=%.1f, next_run=%.1f, running=%s]' % \
+               (self.name, self.server, self.interval, self.next_run, str(self.running is not None))
+
+
+class UserScheduler(object):
+    def __init__(self, interval=DEF_INTERVAL, min_interval=DEF_MIN_INTERVAL, max_interval=DEF_MAX_INTERVAL,
+                 jitter=DEF_JITTER, provider_rate=DEF_PROVIDER_RATE, stale_timeout=DEF_STALE_TIMEOUT):
+        """
+        Priority queue of per-user next run times. A user that moved mail is run again
+        sooner and a quiet one later, starts are jittered and spaced per mail server,
+        and a slow user only delays its own next run
+
+        :param interval: first interval of a new user, its first start is spread over it
+        :param min_interval: shortest interval
+        :param max_interval: longest interval
+        :param jitter: each interval is varied by up to this fraction either way
+        :param provider_rate: most users started per second against one mail server, 0 is unlimited
+        :param stale_timeout: seconds after which a user whose run never reported back is rescheduled
+        """
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.jitter = jitter
+        self.provider_rate = provider_rate
+        self.stale_timeout = stale_timeout
+        self.lock = threading.Lock()
+        self.heap = []
+        self.users = {}
+        self.next_start = {}
+        self.sequence = itertools.count()
+
+    def __str__(self):
+        return 'UserScheduler [users=%d, min_interval=%d, max_interval=%d, provider_rate=%.1f]' % \
+               (len(self.users), self.min_interval, self.max_interval, self.provider_rate)
+
+    def _schedule(self, user, next_run):
+        # caller holds the lock, entries left behind by an earlier next_run are skipped when popped
+        user.next_run = next_run
+        heapq.heappush(self.heap, (next_run, next(self.sequence), user.name))
+
+    def _jittered(self, interval):
+        return interval * (1.0 + random.uniform(-self.jitter, self.jitter))
+
+    def sync(self, users_jobs, min_intervals=None):
+        """
+        Add new users with a random first start, drop removed ones and take updated rules
+        :param users_jobs: dictionary of user => list of rule records
+        :param min_intervals: optional dictionary of user => shortest interval for that user
+        :return:
+        """
+        min_intervals = min_intervals or {}
+        now = time.time()
+        with self.lock:
+            for name in [n for n in self.users.keys() if n not in users_jobs]:
+                trace('%s: no rules left, unscheduled', name)
+                del self.users[name]
+
+            for name, records in users_jobs.items():
+                floor = max(self.min_interval, min_intervals.get(name, 0))
+                user = self.users.get(name)
+                if user is None:
+                    interval = min(self.max_interval, max(floor, self.interval))
+                    user = UserSchedule(name, records[0][MAILSERVER], records, interval, floor)
+                    self.users[name] = user
+                    self._schedule(user, now + random.uniform(0, interval))
+                    continue
+
+                user.records = records
+                user.server = records[0][MAILSERVER]
+                user.min_interval = floor
+                user.interval = max(user.interval, floor)
+                if user.running is not None and now - user.running > self.stale_timeout:
+                    logger.warning('%s: run started %ds ago never finished, rescheduling', name, now - user.running)
+                    user.running = None
+                    self._schedule(user, now)
+
+    def _start_slot(self, server, now):
+        # caller holds the lock, starts against one server are spaced 1/provider_rate apart
+        if self.provider_rate <= 0:
+            return now
+        start = max(now, self.next_start.get(server, 0.0))
+        self.next_start[server] = start + 1.0 / self.provider_rate
+        return start
+
+    def due(self):
+        """
+        Take the users whose next run time has come, each is marked running until completed()
+        :return:
+        list of UserSchedule
+        """
+        now = time.time()
+        due = []
+        with self.lock:
+            while len(self.heap) > 0 and self.heap[0][0] <= now:
+                next_run, sequence, name = heapq.heappop(self.heap)
+                user = self.users.get(name)
+                if user is None or user.running is not None or user.next_run != next_run:
+                    continue
+
+                if user.reserved is None:
+                    start = self._start_slot(user.server, now)
+                    if start > now:
+                        # the slot is kept, the user starts on it without waiting for another
+                        user.reserved = start
+                        self._schedule(user, start)
+                        continue
+
+                SCHEDULE_LAG.observe(now - (user.reserved or next_run))
+                user.reserved = None
+                user.running = now
+                due.append(user)
+        if len(due) > 0:
+            trace('%d users due, %d scheduled', len(due), len(self.users))
+        return due
+
+    def completed(self, name, moved=0, retry_at=None):
+        """
+        Schedule a user's next run after one finishes
+        :param name: user
+        :param moved: number of messages the run moved, adapts the interval, None leaves it as it is
+        :param retry_at: optional earliest next run, e.g. after a failure
+        :return:
+        """
+        now = time.time()
+        with self.lock:
+            user = self.users.get(name)
+            if user is None or user.running is None:
+                return
+            user.running = None
+            if retry_at is None and moved is not None:
+                if moved > 0:
+                    user.interval = max(user.min_interval, user.interval * SPEED_UP)
+                else:
+                    user.interval = min(self.max_interval, user.interval * SLOW_DOWN)
+            self._schedule(user, max(now + self._jittered(user.interval), retry_at or 0))
+            trace('%s: moved %s, next run in %.1fs', name, str(moved), user.next_run - now)
+
+    def cancelled(self, name):
+        """
+        Put back a user whose run was dropped before it started, e.g. when the daemon stopped
+        :param name: user
+        :return:
+        """
+        with self.lock:
+            user = self.users.get(name)
+            if user is None or user.running is None:
+                return
+            user.running = None
+            self._schedule(user, time.time())
+            trace('%s: run cancelled, due again', name)
+
+    def next_wakeup(self):
+        """
+        :return:
+        seconds until the earliest next run, None when no user is waiting
+        """
+        with self.lock:
+            while len(self.heap) > 0:
+                next_run, sequence, name = self.heap[0]
+                user = self.users.get(name)
+                if user is not None and user.running is None and user.next_run == next_run:
+                    return max(0.0, next_run - time.time())
+                heapq.heappop(self.heap)
+            return None
+
+    def stats(self):
+        with self.lock:
+            intervals = [u.interval for u in self.users.values()]
+            return {'users': len(self.users),
+                    'running': len([u for u in self.users.values() if u.running is not None]),
+                    'min_interval': min(intervals) if len(intervals) > 0 else 0.0,
+                    'max_interval': max(intervals) if len(intervals) > 0 else 0.0,
+                    'avg_interval': sum(intervals) / len(intervals) if len(intervals) > 0 else 0.0}
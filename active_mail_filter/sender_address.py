@@ -0,0 +1,117 @@
+# Copyright (c) 2016, Kevin Rodgers
+# Released subject to the New BSD License
+# Please see http://en.wikipedia.org/wiki/BSD_licenses
+
+import threading
+from collections import OrderedDict
+from email.header import decode_header
+from email.utils import parseaddr
+from active_mail_filter import get_logger
+
+logger = get_logger()
+
+DEF_CACHE_SIZE = 50000
+
+
+class LruCache(object):
+    def __init__(self, maxsize=DEF_CACHE_SIZE):
+        """
+        Thread safe least recently used cache
+
+        :param maxsize: most entries kept, the least recently used is dropped first
+        """
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __str__(self):
+        return 'LruCache [maxsize=%d, size=%d, hits=%d, misses=%d]' % \
+               (self.maxsize, len(self.entries), self.hits, self.misses)
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+
+_parsed = LruCache()
+
+
+def _decoded(from_string):
+    # RFC 2047 encoded words, some mailers encode the whole header address included
+    try:
+        return ' '.join(part for part, charset in decode_header(from_string))
+    except Exception:
+        return from_string
+
+
+def _parse(from_string):
+    name, address = parseaddr(from_string)
+    if '@' not in address and '=?' in from_string:
+        name, address = parseaddr(_decoded(from_string))
+    if '@' not in address:
+        # not an addr-spec, e.g. a bare local name, keep the first word like older releases
+        words = from_string.replace('"', ' ').split()
+        address = words[0] if len(words) > 0 else ''
+
+    address = address.strip()
+    local, at, domain = address.rpartition('@')
+    if at and '+' in local[1:]:
+        # plus addressing, user+tag@domain is user@domain
+        local = local[:local.index('+', 1)]
+    canonical = ('%s@%s' % (local, domain) if at else address).lower()
+    return address, canonical
+
+
+def parse_from(from_string):
+    """
+    Parse a From header once, repeated senders are a cache lookup
+    :param from_string: From header value, e.g. "Name" <user+tag@Example.com>
+    :return:
+    tuple of (address as written, canonical address), e.g. ('user+tag@Example.com', 'user@example.com')
+    """
+    parsed = _parsed.get(from_string)
+    if parsed is None:
+        parsed = _parse(from_string)
+        _parsed.put(from_string, parsed)
+    return parsed
+
+
+def canonical_address(from_string):
+    """
+    Lower case addr-spec without display name, comments, encoding or plus tag, two From
+    headers for the same mailbox have the same canonical address
+    :param from_string: From header value
+    :return:
+    canonical address
+    """
+    return parse_from(from_string)[1]
+
+
+def address_cache_stats():
+    return _parsed.stats()
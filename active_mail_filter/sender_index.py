@@ -0,0 +1,162 @@
+# Copyright (c) 2016, Kevin Rodgers
+# Released subject to the New BSD License
+# Please see http://en.wikipedia.org/wiki/BSD_licenses
+
+import redis
+from active_mail_filter import get_logger, trace
+from active_mail_filter.simple_db import SimpleRedisDb
+
+logger = get_logger()
+
+UIDVALIDITY = 'uidvalidity'
+LAST_UID = 'last_uid'
+MESSAGES = 'messages'
+
+
+class SenderIndex(SimpleRedisDb):
+    def __init__(self, host, key, port=6379, connection_class=redis.Connection):
+        """
+
+        :param host: database host
+        :param port: database port default 6397
+        :param key: prefix for the index keys, normally the redis_key from the configuration
+        :param connection_class: redis connection class, e.g. GreenRedisConnection under gevent
+        """
+        SimpleRedisDb.__init__(self, host=host, key=key, port=port, connection_class=connection_class)
+
+    def __str__(self):
+        return 'SenderIndex [host=%s, port=%d, key=%s, redis=%s]' % \
+               (self.host, self.port, self.key, str(self.redis))
+
+    def _senders_key(self, mail_server, user, folder_name):
+        # the same login on two mail servers is two accounts
+        if folder_name.lower() == 'inbox':
+            folder_name = folder_name.lower()
+        return '%s:senders:%s:%s:%s' % (self.key, mail_server, user, folder_name)
+
+    def _state_key(self, mail_server, user, folder_name):
+        return '%s:state' % self._senders_key(mail_server, user, folder_name)
+
+    def get_state(self, mail_server, user, folder_name):
+        """
+        Return the saved UIDVALIDITY and highest indexed UID for a folder
+        :param mail_server: imap server
+        :param user: imap login name
+        :param folder_name: folder being indexed
+        :return:
+        tuple of (uidvalidity, last_uid), both 0 if the folder has never been indexed
+        """
+        self._open_db()
+        state = self.redis.hgetall(self._state_key(mail_server, user, folder_name))
+        return int(state.get(UIDVALIDITY, 0)), int(state.get(LAST_UID, 0))
+
+    def clear(self, mail_server, user, folder_name):
+        """
+        Removes the index for a folder, the next update does a full rebuild
+        :param mail_server: imap server
+        :param user: imap login name
+        :param folder_name: folder being indexed
+        :return:
+        """
+        self._open_db()
+        self.redis.delete(self._senders_key(mail_server, user, folder_name),
+                          self._state_key(mail_server, user, folder_name))
+
+    def update(self, mailbox, folder_name):
+        """
+        Brings the index for a folder up to date, only UIDs above the last indexed UID are
+        fetched unless the folder's UIDVALIDITY changed in which case the index is rebuilt.
+        When the folder holds fewer messages than were indexed plus the new ones, mail was
+        removed from it and every From header is fetched again so senders no longer filed
+        there are dropped
+        :param mailbox: connected MboxFolder
+        :param folder_name: folder to index
+        :return:
+        set of From strings added to the index by this update
+        """
+        self._open_db()
+        server, user = mailbox.host, mailbox.username
+        state = self.redis.hgetall(self._state_key(server, user, folder_name))
+        uidvalidity, last_uid = int(state.get(UIDVALIDITY, 0)), int(state.get(LAST_UID, 0))
+        indexed = int(state[MESSAGES]) if MESSAGES in state else None
+        status = mailbox.folder_status(folder_name, 'MESSAGES UIDNEXT UIDVALIDITY')
+
+        if status.get('UIDVALIDITY', 0) != uidvalidity:
+            logger.debug('%s/%s: uidvalidity changed %d => %d, rebuilding sender index',
+                         user, folder_name, uidvalidity, status.get('UIDVALIDITY', 0))
+            self.clear(server, user, folder_name)
+            uidvalidity, last_uid, indexed = status.get('UIDVALIDITY', 0), 0, None
+        elif 'UIDNEXT' in status and status['UIDNEXT'] - 1 <= last_uid and status.get('MESSAGES') == indexed:
+            trace('%s/%s: sender index is current, last_uid=%d', user, folder_name, last_uid)
+            return set()
+
+        # UIDs past the STATUS reply are left for the next update so the counts agree
+        highest = str(status['UIDNEXT'] - 1) if 'UIDNEXT' in status else '*'
+        uid_list = []
+        if highest == '*' or int(highest) > last_uid:
+            uid_list = mailbox.list_email_uids(folder_name=folder_name, pattern='(UID %d:%s)' % (last_uid + 1, highest))
+            # UID SEARCH n:* always matches the highest UID even when it is below n
+            uid_list = [uid for uid in uid_list if int(uid) > last_uid]
+
+        rebuild = indexed is not None and 'MESSAGES' in status and indexed + len(uid_list) > status['MESSAGES']
+        if rebuild:
+            logger.debug('%s/%s: %d messages removed, reindexing every sender', user, folder_name,
+                         indexed + len(uid_list) - status['MESSAGES'])
+            uid_list = mailbox.list_email_uids(folder_name=folder_name, pattern='(UID 1:%s)' % highest)
+        from_list = list(mailbox.fetch_from_addresses(uid_list))
+
+        if len(uid_list) > 0:
+            last_uid = max(last_uid, max(int(uid) for uid in uid_list))
+        last_uid = max(last_uid, status.get('UIDNEXT', 1) - 1)
+
+        # only senders the index did not already hold are reported as added
+        senders_key = self._senders_key(server, user, folder_name)
+        removed = set()
+        if rebuild:
+            known = self.redis.smembers(senders_key)
+            added, removed = set(from_list) - known, known - set(from_list)
+        else:
+            pipe = self.redis.pipeline()
+            for sender in from_list:
+                pipe.sismember(senders_key, sender)
+            added = set(from_list[i] for i, known in enumerate(pipe.execute()) if not known)
+
+        state = {UIDVALIDITY: uidvalidity, LAST_UID: last_uid}
+        if 'MESSAGES' in status:
+            state[MESSAGES] = status['MESSAGES']
+        pipe = self.redis.pipeline()
+        if len(added) > 0:
+            pipe.sadd(senders_key, *added)
+        if len(removed) > 0:
+            pipe.srem(senders_key, *removed)
+        pipe.hmset(self._state_key(server, user, folder_name), state)
+        pipe.execute()
+
+        logger.debug('%s/%s: indexed %d uids, %d from addresses, %d new, %d removed, last_uid=%d',
+                     user, folder_name, len(uid_list), len(from_list), len(added), len(removed), last_uid)
+        return added
+
+    def get_senders(self, mail_server, user, folder_name):
+        """
+        Return the indexed From strings of a folder without updating the index
+        :param mail_server: imap server
+        :param user: imap login name
+        :param folder_name: indexed folder
+        :return:
+        list of lower case From strings
+        """
+        self._open_db()
+        return list(self.redis.smembers(self._senders_key(mail_server, user, folder_name)))
+
+    def get_from_addresses(self, mailbox, folder_name):
+        """
+        Return the From strings of every message filed in a folder, updating the index first
+        :param mailbox: connected MboxFolder
+        :param folder_name: folder to index
+        :return:
+        list of lower case From strings
+        """
+        self.update(mailbox, folder_name)
+        from_list = self.get_senders(mailbox.host, mailbox.username, folder_name)
+        logger.debug('found %d from addresses' % len(from_list))
+        return from_list
@@ -12,6 +12,7 @@ from flask_cors import CORS
 import connexion
 
 from active_mail_filter import get_logger, read_configuration_file
+from active_mail_filter.metrics import render, CONTENT_TYPE
 from daemon import start_daemon_thread, sigterm_handler
 
 _CONF_ = read_configuration_file()
@@ -41,6 +42,11 @@ def index():
     return _read_file('../active_mail_filter/index.html')
 
 
+@webapp.route('/metrics')
+def metrics():
+    return make_response(render(), 200, {'Content-Type': CONTENT_TYPE})
+
+
 @auth.get_password
 def get_password(username):
     password = None
@@ -2,23 +2,33 @@
 # Released subject to the New BSD License
 # Please see http://en.wikipedia.org/wiki/BSD_licenses
 
+import ast
+import json
 import redis
 from uuid import uuid4
+from active_mail_filter.metrics import instrument_redis
 
 UUID = 'uuid'
+RECORD_FORMAT = 'json-2'
 
 
 class SimpleRedisDb(object):
-    def __init__(self, host, key, port=6379):
+    def __init__(self, host, key, port=6379, index_fields=None, unique_fields=None, connection_class=redis.Connection):
         """
 
         :param host: database host
         :param port: database port default 6397
         :param key: hash set name default active_mail_filter
+        :param index_fields: record fields with a value => UUIDs secondary index
+        :param unique_fields: record fields whose combined values must be unique
+        :param connection_class: redis connection class, e.g. GreenRedisConnection under gevent
         """
         self.host = host
         self.port = port
         self.key = key
+        self.index_fields = list(index_fields or [])
+        self.unique_fields = list(unique_fields or [])
+        self.connection_class = connection_class
         self.redis = None
 
     def __str__(self):
@@ -38,7 +48,8 @@ class SimpleRedisDb(object):
         :return:
         """
         if self.redis is None:
-            self.redis = redis.Redis(connection_pool=redis.ConnectionPool(host=self.host, port=self.port, db=0))
+            pool = redis.ConnectionPool(host=self.host, port=self.port, db=0, connection_class=self.connection_class)
+            self.redis = instrument_redis(redis.Redis(connection_pool=pool))
 
     def _close_db(self):
         """
@@ -49,15 +60,105 @@ class SimpleRedisDb(object):
             del self.redis
             self.redis = None
 
+    @staticmethod
+    def _encode(record_dict):
+        return json.dumps(record_dict, sort_keys=True, separators=(',', ':'))
+
+    @staticmethod
+    def _decode(record_str):
+        """
+        Parse a stored record, older releases stored unicode(dict) which is read with
+        literal_eval rather than eval
+        :param record_str:
+        :return:
+        record dictionary
+        """
+        try:
+            return json.loads(record_str)
+        except ValueError:
+            return ast.literal_eval(record_str)
+
+    def _index_key(self, field, value):
+        return '%s:index:%s:%s' % (self.key, field, value)
+
+    def _unique_key(self):
+        return '%s:unique:%s' % (self.key, ':'.join(self.unique_fields))
+
+    def _unique_value(self, record_dict):
+        return '\0'.join(unicode(record_dict.get(f)) for f in self.unique_fields)
+
+    def _version_key(self):
+        return '%s:version' % self.key
+
+    def _revisions_key(self):
+        return '%s:revisions' % self.key
+
+    def _claim_unique(self, record_dict):
+        """
+        Reserve the record's combined unique field values for its UUID
+        :param record_dict: record dictionary with its UUID
+        :return:
+        False if another record holds them
+        """
+        value = self._unique_value(record_dict)
+        if self.redis.hsetnx(self._unique_key(), value, record_dict[UUID]):
+            return True
+        return self.redis.hget(self._unique_key(), value) == record_dict[UUID]
+
+    def _add_indexes(self, pipe, record_dict):
+        for field in self.index_fields:
+            pipe.sadd(self._index_key(field, record_dict.get(field)), record_dict[UUID])
+        if len(self.unique_fields) > 0:
+            # never takes the entry of another record, add and update claim it first
+            pipe.hsetnx(self._unique_key(), self._unique_value(record_dict), record_dict[UUID])
+
+    def _remove_indexes(self, pipe, record_dict):
+        for field in self.index_fields:
+            pipe.srem(self._index_key(field, record_dict.get(field)), record_dict[UUID])
+        if len(self.unique_fields) > 0:
+            # an entry held by another record, e.g. a duplicate stored by an older release, stays
+            value = self._unique_value(record_dict)
+            if self.redis.hget(self._unique_key(), value) == record_dict[UUID]:
+                pipe.hdel(self._unique_key(), value)
+
     def _clear_all(self):
         """
-        Removes all keys from hash set
+        Removes all keys from hash set and its indexes
         :return:
         """
         self._open_db()
-        record_keys = self.redis.hkeys(self.key)
-        for u in record_keys:
-            self.redis.hdel(self.key, u)
+        pipe = self.redis.pipeline()
+        for record_dict in self.get_all_records():
+            self._remove_indexes(pipe, record_dict)
+        pipe.delete(self.key, self._revisions_key())
+        pipe.incr(self._version_key())
+        pipe.execute()
+
+    def migrate_records(self):
+        """
+        One time conversion of unicode(dict) records to JSON and build of the
+        secondary indexes, does nothing once the hash set is marked as converted
+        :return:
+        number of records converted
+        """
+        self._open_db()
+        format_key = '%s:format' % self.key
+        if self.redis.get(format_key) == RECORD_FORMAT:
+            return 0
+
+        converted = 0
+        pipe = self.redis.pipeline()
+        for record_key, record_str in self.redis.hgetall(self.key).items():
+            record_dict = self._decode(record_str)
+            record_dict[UUID] = record_key
+            pipe.hset(self.key, record_key, self._encode(record_dict))
+            pipe.hsetnx(self._revisions_key(), record_key, 1)
+            self._add_indexes(pipe, record_dict)
+            converted += 1
+        pipe.incr(self._version_key())
+        pipe.set(format_key, RECORD_FORMAT)
+        pipe.execute()
+        return converted
 
     def get_record(self, record_key):
         """
@@ -72,24 +173,63 @@ class SimpleRedisDb(object):
         if record_str is None:
             raise LookupError('%s key not found' % record_key)
 
-        return eval(record_str)
+        return self._decode(record_str)
 
     def get_all_records(self):
         """
-        Return a list of all records
+        Return a list of all records, read with a single HGETALL
         :return:
         list of all record dictionaries
         """
         self._open_db()
 
-        all_records = []
-        record_keys = self.redis.hkeys(self.key)
-        for u in record_keys:
-            record_str = self.redis.hget(self.key, u)
-            if record_str is not None:
-                all_records.append(eval(record_str))
+        return [self._decode(record_str) for record_str in self.redis.hgetall(self.key).values()]
+
+    def get_records(self, record_keys):
+        """
+        Return the records for a list of UUIDs with a single HMGET
+        :param record_keys: list of UUIDs
+        :return:
+        list of record dictionaries, missing UUIDs are skipped
+        """
+        self._open_db()
+
+        if len(record_keys) == 0:
+            return []
+
+        return [self._decode(record_str) for record_str in self.redis.hmget(self.key, record_keys)
+                if record_str is not None]
 
-        return all_records
+    def get_version(self):
+        """
+        Return the change counter, incremented by every add, update and delete
+        :return:
+        version number
+        """
+        self._open_db()
+        return int(self.redis.get(self._version_key()) or 0)
+
+    def get_revisions(self):
+        """
+        Return the revision of every record, a record's revision is incremented each
+        time it is written
+        :return:
+        dictionary of UUID => revision
+        """
+        self._open_db()
+        return dict((k, int(v)) for k, v in self.redis.hgetall(self._revisions_key()).items())
+
+    def get_records_by_index(self, field, value):
+        """
+        Return the records whose field has value using the secondary index
+        :param field: one of index_fields
+        :param value: value to look up
+        :return:
+        list of matching record dictionaries
+        """
+        self._open_db()
+
+        return self.get_records(list(self.redis.smembers(self._index_key(field, value))))
 
     def add_record(self, record_dict):
         """
@@ -101,7 +241,15 @@ class SimpleRedisDb(object):
         self._open_db()
 
         record_dict[UUID] = unicode(uuid4())
-        self.redis.hset(self.key, record_dict[UUID], unicode(record_dict))
+        if len(self.unique_fields) > 0 and not self._claim_unique(record_dict):
+            raise ValueError('duplicate entry')
+
+        pipe = self.redis.pipeline()
+        pipe.hset(self.key, record_dict[UUID], self._encode(record_dict))
+        pipe.hincrby(self._revisions_key(), record_dict[UUID], 1)
+        pipe.incr(self._version_key())
+        self._add_indexes(pipe, record_dict)
+        pipe.execute()
         return record_dict[UUID]
 
     def delete_record(self, record_key):
@@ -111,7 +259,15 @@ class SimpleRedisDb(object):
         :return:
         """
         self._open_db()
-        self.redis.hdel(self.key, record_key)
+        pipe = self.redis.pipeline()
+        try:
+            self._remove_indexes(pipe, self.get_record(record_key))
+        except LookupError:
+            pass
+        pipe.hdel(self.key, record_key)
+        pipe.hdel(self._revisions_key(), record_key)
+        pipe.incr(self._version_key())
+        pipe.execute()
 
     def update_record(self, record_key, record_dict):
         """
@@ -122,4 +278,16 @@ class SimpleRedisDb(object):
         """
         self._open_db()
         record_dict[UUID] = record_key
-        self.redis.hset(self.key, record_dict[UUID], unicode(record_dict))
+        if len(self.unique_fields) > 0 and not self._claim_unique(record_dict):
+            raise ValueError('duplicate entry')
+
+        pipe = self.redis.pipeline()
+        try:
+            self._remove_indexes(pipe, self.get_record(record_key))
+        except LookupError:
+            pass
+        pipe.hset(self.key, record_dict[UUID], self._encode(record_dict))
+        pipe.hincrby(self._revisions_key(), record_dict[UUID], 1)
+        pipe.incr(self._version_key())
+        self._add_indexes(pipe, record_dict)
+        pipe.execute()
@@ -0,0 +1,180 @@
+# Copyright (c) 2016, Kevin Rodgers
+# Released subject to the New BSD License
+# Please see http://en.wikipedia.org/wiki/BSD_licenses
+
+import re
+import time
+import smtplib
+from active_mail_filter import get_logger, read_configuration_file, trace
+
+_CONF_ = read_configuration_file()
+
+logger = get_logger()
+
+DEF_SMTP_PORT = 587
+CRLF = '\r\n'
+
+
+class DotStuffer(object):
+    """
+    smtplib.quotedata for a message that arrives in pieces, a line end or leading dot
+    split across two pieces is handled as if the message were whole
+    """
+    def __init__(self):
+        self.line_start = True
+        self.carried_cr = False
+
+    def feed(self, data):
+        if self.carried_cr:
+            data = '\r' + data
+        # a trailing CR may be the first half of CRLF
+        self.carried_cr = data.endswith('\r')
+        if self.carried_cr:
+            data = data[:-1]
+        if len(data) == 0:
+            return ''
+
+        data = re.sub(r'(?:\r\n|\n|\r(?!\n))', CRLF, data)
+        data = data.replace('\n.', '\n..')
+        if self.line_start and data.startswith('.'):
+            data = '.' + data
+        self.line_start = data.endswith('\n')
+        return data
+
+    def close(self):
+        # the message always ends with CRLF before the terminating dot
+        if self.carried_cr or not self.line_start:
+            return CRLF
+        return ''
+
+
+class SmtpForwarder(object):
+    def __init__(self, host, port=DEF_SMTP_PORT, login=None, password=None, rate=None):
+        """
+        One authenticated SMTP session reused for a batch of messages, the session is
+        opened on the first send and reopened if the server drops it
+
+        :param host: smtp server
+        :param port: smtp port default 587
+        :param login: optional smtp login name
+        :param password: smtp password
+        :param rate: most messages sent per second, 0 is unlimited, default is filter_daemon forward_rate
+        """
+        self.host = host
+        self.port = port
+        self.login = login
+        self.password = password
+        self.rate = float(_CONF_['filter_daemon']['forward_rate'] if rate is None else rate)
+        self.server = None
+        self.next_send = 0.0
+        self.sent = 0
+
+    def __str__(self):
+        return 'SmtpForwarder [host=%s, port=%d, rate=%.1f, sent=%d]' % (self.host, self.port, self.rate, self.sent)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        if self.server is None:
+            logger.debug('smtp connecting to host %s:%d', self.host, self.port)
+            server = smtplib.SMTP(self.host, self.port)
+            try:
+                server.ehlo()
+                server.starttls()
+                server.ehlo()
+                if self.login is not None:
+                    server.login(self.login, self.password)
+            except Exception:
+                server.close()
+                raise
+            self.server = server
+
+    def close(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except Exception as e:
+                trace('smtp quit failed, %s', str(e))
+                self.server.close()
+            self.server = None
+
+    def _throttle(self):
+        if self.rate > 0:
+            delay = self.next_send - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            self.next_send = max(self.next_send, time.time()) + 1.0 / self.rate
+
+    def send(self, from_user, to_user, message):
+        """
+        Send one message on the shared session
+        :param from_user: envelope sender
+        :param to_user: envelope recipient
+        :param message: raw message
+        :return:
+        """
+        self._throttle()
+        self.open()
+        try:
+            self.server.sendmail(from_user, to_user, message)
+        except smtplib.SMTPServerDisconnected:
+            # servers close sessions after a number of messages or an idle period
+            logger.debug('smtp session to %s dropped, reconnecting', self.host)
+            self.server = None
+            self.open()
+            self.server.sendmail(from_user, to_user, message)
+        self.sent += 1
+
+    def _envelope(self, from_user, to_user):
+        self.server.ehlo_or_helo_if_needed()
+        code, response = self.server.mail(from_user)
+        if code != 250:
+            self.server.rset()
+            raise smtplib.SMTPSenderRefused(code, response, from_user)
+        code, response = self.server.rcpt(to_user)
+        if code not in (250, 251):
+            self.server.rset()
+            raise smtplib.SMTPRecipientsRefused({to_user: (code, response)})
+
+    def send_stream(self, from_user, to_user, chunks):
+        """
+        Send one message on the shared session as its pieces arrive, only one piece is
+        held in memory at a time
+        :param from_user: envelope sender
+        :param to_user: envelope recipient
+        :param chunks: iterator of raw message pieces
+        :return:
+        """
+        self._throttle()
+        self.open()
+        try:
+            self._envelope(from_user, to_user)
+        except smtplib.SMTPServerDisconnected:
+            logger.debug('smtp session to %s dropped, reconnecting', self.host)
+            self.server = None
+            self.open()
+            self._envelope(from_user, to_user)
+
+        code, response = self.server.docmd('data')
+        if code != 354:
+            # the envelope is still open, without RSET the next MAIL on the session is refused
+            self.server.rset()
+            raise smtplib.SMTPDataError(code, response)
+        try:
+            stuffer = DotStuffer()
+            for chunk in chunks:
+                self.server.send(stuffer.feed(chunk))
+            self.server.send(stuffer.close() + '.' + CRLF)
+        except Exception:
+            # the message is incomplete, dropping the session keeps it from being delivered
+            self.server.close()
+            self.server = None
+            raise
+        code, response = self.server.getreply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, response)
+        self.sent += 1
@@ -0,0 +1,278 @@
+# Copyright (c) 2016, Kevin Rodgers
+# Released subject to the New BSD License
+# Please see http://en.wikipedia.org/wiki/BSD_licenses
+
+import time
+import marshal
+import pstats
+import cProfile
+import threading
+import functools
+from StringIO import StringIO
+from contextlib import contextmanager
+from gevent.local import local
+from active_mail_filter import get_logger
+
+DEF_SLOW_RULES = 20
+SLOW_RULE_MAX_AGE = 3600
+RULE_SPAN = 'rule'
+
+# one span stack per greenlet, the gevent engine runs many users on one thread without monkey patching
+_local = local()
+
+
+class Span(object):
+    def __init__(self, name, tags):
+        self.name = name
+        self.tags = tags
+        self.start = time.time()
+        self.stages = {}
+
+    def __str__(self):
+        return 'Span [name=%s, tags=%s]' % (self.name, str(self.tags))
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def _format_stages(stages):
+    return ' '.join('%s=%.3fs' % (stage, stages[stage]) for stage in sorted(stages.keys()))
+
+
+@contextmanager
+def span(name, **tags):
+    """
+    Time a stage of the work done by this thread, each enclosing span adds the time to
+    its per-stage totals. The outermost span logs one line with every stage it contains
+    and a span named rule is recorded in the slow rule table
+    :param name: stage name, e.g. search
+    :param tags: values identifying the work, e.g. user and source
+    :return:
+    """
+    stack = _stack()
+    current = Span(name, tags)
+    stack.append(current)
+    try:
+        yield current
+    finally:
+        stack.pop()
+        elapsed = time.time() - current.start
+        if len(stack) > 0:
+            # the parent passes these on to its own parent when it finishes
+            stack[-1].add(name, elapsed)
+            for stage, seconds in current.stages.items():
+                stack[-1].add(stage, seconds)
+
+        if name == RULE_SPAN:
+            SLOW_RULES.record(current.tags, elapsed, current.stages)
+        if len(stack) == 0:
+            get_logger().debug('span %s %s total=%.3fs %s', name,
+                               ' '.join('%s=%s' % (k, current.tags[k]) for k in sorted(current.tags.keys())),
+                               elapsed, _format_stages(current.stages))
+
+
+def traced(stage):
+    """
+    Decorator running a function in a span when the calling thread has one open
+    :param stage: stage name
+    :return:
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if len(_stack()) == 0:
+                return func(*args, **kwargs)
+            with span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def add_time(stage, seconds):
+    """
+    Count time spent on a stage that is not one block of code, e.g. reads interleaved
+    with other work, against the innermost open span of this thread
+    :param stage: stage name
+    :param seconds: time spent
+    :return:
+    """
+    stack = _stack()
+    if len(stack) > 0:
+        stack[-1].add(stage, seconds)
+
+
+class SlowRuleTable(object):
+    def __init__(self, size=DEF_SLOW_RULES, max_age=SLOW_RULE_MAX_AGE):
+        """
+        Last run time of every rule seen recently, the slowest are reported
+
+        :param size: rules returned by top()
+        :param max_age: seconds after which a rule that has not run is forgotten
+        """
+        self.size = size
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def __str__(self):
+        return 'SlowRuleTable [size=%d, max_age=%d, entries=%d]' % (self.size, self.max_age, len(self.entries))
+
+    def _expire(self):
+        # caller holds the lock
+        oldest = time.time() - self.max_age
+        for key in [k for k in self.entries.keys() if self.entries[k]['finished'] < oldest]:
+            del self.entries[key]
+
+    def record(self, tags, seconds, stages):
+        key = tuple(sorted(tags.items()))
+        entry = dict(tags)
+        entry.update({'seconds': round(seconds, 6), 'finished': time.time(),
+                      'stages': dict((stage, round(stages[stage], 6)) for stage in stages.keys())})
+        with self.lock:
+            self.entries[key] = entry
+            if len(self.entries) > 10 * self.size:
+                self._expire()
+
+    def top(self, count=None):
+        """
+        :param count: number of rules, default is the table size
+        :return:
+        list of the slowest rules, slowest first, each with its tags, seconds and per-stage seconds
+        """
+        with self.lock:
+            self._expire()
+            entries = sorted(self.entries.values(), key=lambda e: e['seconds'], reverse=True)
+            return [dict(e) for e in entries[:count or self.size]]
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+
+    def drain(self):
+        """
+        Take every entry, for a process handing its rules to another
+        :return:
+        list of (key, entry)
+        """
+        with self.lock:
+            entries = self.entries.items()
+            self.entries = {}
+            return entries
+
+    def merge(self, entries):
+        with self.lock:
+            self.entries.update(entries)
+            if len(self.entries) > 10 * self.size:
+                self._expire()
+
+
+SLOW_RULES = SlowRuleTable()
+
+
+class _RawProfile(object):
+    # what pstats.Stats needs to load the stats of a profile run elsewhere
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class CycleProfiler(object):
+    def __init__(self):
+        """
+        cProfile for one filter cycle, armed through the API. Each job profiles its own
+        thread and the results are merged when the cycle ends
+        """
+        self.lock = threading.Lock()
+        self.armed = False
+        self.active = False
+        self.stats = None
+        self.finished = None
+
+    def __str__(self):
+        return 'CycleProfiler [armed=%s, active=%s, finished=%s]' % (self.armed, self.active, str(self.finished))
+
+    def arm(self):
+        with self.lock:
+            self.armed = True
+
+    def begin_cycle(self):
+        with self.lock:
+            if self.armed:
+                self.armed = False
+                self.active = True
+                self.stats = None
+                get_logger().info('profiling filter cycle')
+
+    def end_cycle(self):
+        with self.lock:
+            if self.active:
+                self.active = False
+                self.finished = time.time()
+                get_logger().info('filter cycle profile ready')
+
+    def profile_call(self, target, *args, **kwargs):
+        """
+        Run target, under the profiler when a profiled cycle is in progress
+        :return:
+        what target returns
+        """
+        if not self.active:
+            return target(*args, **kwargs)
+
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(target, *args, **kwargs)
+        finally:
+            self._add(profiler)
+
+    def _add(self, profile):
+        with self.lock:
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+
+    def add_stats(self, stats):
+        """
+        Merge a profile taken in another process into the cycle in progress
+        :param stats: the stats attribute of a cProfile.Profile after create_stats()
+        :return:
+        """
+        if self.active:
+            self._add(_RawProfile(stats))
+
+    def report(self, sort='cumulative', limit=100):
+        """
+        :param sort: pstats sort key, e.g. cumulative or tottime
+        :param limit: number of functions listed
+        :return:
+        pstats text report of the last profiled cycle or None if no cycle has been profiled
+        """
+        with self.lock:
+            if self.stats is None or self.active:
+                return None
+            output = StringIO()
+            self.stats.stream = output
+            self.stats.sort_stats(sort).print_stats(limit)
+            return output.getvalue()
+
+    def dump(self):
+        """
+        :return:
+        the last profiled cycle in the pstats file format, or None
+        """
+        with self.lock:
+            if self.stats is None or self.active:
+                return None
+            return marshal.dumps(self.stats.stats)
+
+
+CYCLE_PROFILER = CycleProfiler()
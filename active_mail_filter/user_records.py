@@ -19,7 +19,8 @@ TARGET = 'target'
 class UserRecords(object):
     def __init__(self, host, key='active_mail_filter', cipher='1234567890123456'):
         self.cipher = SimplePassword(cipher)
-        self.redis_db = SimpleRedisDb(host=host, key=key)
+        self.redis_db = SimpleRedisDb(host=host, key=key, index_fields=[USER], unique_fields=[USER, SOURCE, TARGET])
+        self.redis_db.migrate_records()
 
     def __str__(self):
         return 'UserRecords [cipher=%s, redis_db=%s]' % (str(self.cipher), str(self.redis_db))
@@ -33,17 +34,20 @@ class UserRecords(object):
                   SOURCE: source,
                   TARGET: target}
 
-        for rec in self.redis_db.get_all_records():
-            if rec[USER] == user and rec[SOURCE] == source and rec[TARGET] == target:
-                logger.error('%s already added' % user)
-                raise ValueError('duplicate entry')
-
-        return self.redis_db.add_record(record_dict=record)
+        try:
+            return self.redis_db.add_record(record_dict=record)
+        except ValueError:
+            logger.error('%s already added' % user)
+            raise
 
     def update_user(self, record_uuid, user_record):
         password = self.cipher.encode(user_record[PASSWORD])
         user_record[PASSWORD] = password
-        self.redis_db.update_record(record_uuid, user_record)
+        try:
+            self.redis_db.update_record(record_uuid, user_record)
+        except ValueError:
+            logger.error('%s would duplicate another rule' % user_record[USER])
+            raise
         return
 
     def get_all_users(self):
@@ -56,14 +60,26 @@ class UserRecords(object):
 
     def get_user(self, user, source=None, target=None):
         records = []
-        for rec in self.get_all_users():
-            if (rec[USER] == user) and \
-                    (source is None or rec[SOURCE] == source) and \
+        for rec in self.redis_db.get_records_by_index(USER, user):
+            if (source is None or rec[SOURCE] == source) and \
                     (target is None or rec[TARGET] == target):
+                rec[PASSWORD] = self.cipher.decode(rec[PASSWORD])
                 records.append(rec)
 
         return records
 
+    def get_users_by_uuid(self, uuids):
+        records = self.redis_db.get_records(uuids)
+        for rec in records:
+            rec[PASSWORD] = self.cipher.decode(rec[PASSWORD])
+        return records
+
+    def get_version(self):
+        return self.redis_db.get_version()
+
+    def get_revisions(self):
+        return self.redis_db.get_revisions()
+
     def get_user_by_uuid(self, uuid):
         rec = self.redis_db.get_record(uuid)
         password = self.cipher.decode(rec[PASSWORD])
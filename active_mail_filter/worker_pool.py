@@ -0,0 +1,315 @@
+# Copyright (c) 2016, Kevin Rodgers
+# Released subject to the New BSD License
+# Please see http://en.wikipedia.org/wiki/BSD_licenses
+
+import time
+import threading
+from active_mail_filter import get_logger, trace
+from active_mail_filter.metrics import counter
+from active_mail_filter.stoppable_thread import StoppableThread
+
+logger = get_logger()
+
+DEF_MAX_WORKERS = 16
+DEF_MAX_PER_SERVER = 8
+HUNG_TIMEOUT = 900
+DEF_BACKOFF = 60
+DEF_MAX_BACKOFF = 3600
+WORKER_PREFIX = 'worker'
+
+THREADS_KILLED = counter('threads_killed_total', 'Worker threads killed because their job appeared hung')
+JOBS_FAILED = counter('jobs_failed_total', 'User jobs that raised and were rescheduled with backoff')
+
+
+class WorkerJob(object):
+    def __init__(self, name, server, records, on_done=None):
+        """
+        :param name: user
+        :param server: mail server, jobs per server are limited
+        :param records: passed to the pool's target
+        :param on_done: optional callable, called as on_done(job) once the job has finished or failed,
+        or with job.cancelled set when stop() drops it before it started
+        """
+        self.name = name
+        self.server = server
+        self.records = records
+        self.on_done = on_done
+        self.queued = time.time()
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.failed = False
+        self.cancelled = False
+        self.error = None
+        self.retry_at = None
+
+    def __str__(self):
+        return 'WorkerJob [name=%s, server=%s, records=%d]' % (self.name, self.server, len(self.records))
+
+    def wait_time(self):
+        return (self.started or time.time()) - self.queued
+
+
+class WorkerPool(object):
+    def __init__(self, target, max_workers=DEF_MAX_WORKERS, max_per_server=DEF_MAX_PER_SERVER,
+                 backoff=DEF_BACKOFF, max_backoff=DEF_MAX_BACKOFF):
+        """
+        Fixed number of worker threads running per-user jobs from a queue
+
+        :param target: called as target(records) for each job, what it returns is kept in job.result
+        :param max_workers: number of worker threads
+        :param max_per_server: most jobs running at once against one mail server
+        :param backoff: seconds a user whose job raised is left out of submit(), doubled
+        for each further failure in a row
+        :param max_backoff: longest a failing user is left out
+        """
+        self.target = target
+        self.max_workers = max_workers
+        self.max_per_server = max_per_server
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failures = {}
+        self.condition = threading.Condition()
+        self.pending = []
+        self.running = {}
+        self.workers = []
+        self.last_run = {}
+        self.wait_times = {}
+        self.worker_count = 0
+
+    def __str__(self):
+        return 'WorkerPool [max_workers=%d, max_per_server=%d, queued=%d]' % \
+               (self.max_workers, self.max_per_server, len(self.pending))
+
+    def _fair_order(self, jobs):
+        # round robin across mail servers, users that ran longest ago go first
+        by_server = {}
+        for job in jobs:
+            by_server.setdefault(job.server, []).append(job)
+        for server in by_server.keys():
+            by_server[server].sort(key=lambda j: self.last_run.get(j.name, 0))
+
+        ordered = []
+        servers = sorted(by_server.keys())
+        while len(servers) > 0:
+            for server in list(servers):
+                ordered.append(by_server[server].pop(0))
+                if len(by_server[server]) == 0:
+                    servers.remove(server)
+        return ordered
+
+    def submit(self, jobs):
+        """
+        Queue jobs, a user that is already queued or running is not queued twice and one
+        backing off after a failure is not queued until its retry time
+        :param jobs: list of WorkerJob
+        :return:
+        number of jobs queued
+        """
+        self.condition.acquire()
+        try:
+            busy = set(j.name for j in self.pending)
+            busy.update(j.name for j in self.running.values())
+            now = time.time()
+            busy.update(name for name, (count, retry_at) in self.failures.items() if retry_at > now)
+            new_jobs = self._fair_order([j for j in jobs if j.name not in busy])
+            self.pending.extend(new_jobs)
+            self._start_workers()
+            self.condition.notify_all()
+            trace('queued %d jobs, queue depth %d', len(new_jobs), len(self.pending))
+            return len(new_jobs)
+        finally:
+            self.condition.release()
+
+    def _start_workers(self):
+        # caller holds the condition lock
+        self.workers = [th for th in self.workers if th.is_alive() and not th.is_stopped()]
+        while len(self.workers) < min(self.max_workers, len(self.pending) + len(self.running)):
+            self.worker_count += 1
+            th = StoppableThread(name='%s:%d' % (WORKER_PREFIX, self.worker_count), target=self._worker)
+            th.setDaemon(True)
+            self.workers.append(th)
+            th.start()
+
+    def _running_on(self, server):
+        return len([j for j in self.running.values() if j.server == server])
+
+    def _next_job(self, my_thread):
+        self.condition.acquire()
+        try:
+            for i in range(0, len(self.pending)):
+                if self._running_on(self.pending[i].server) < self.max_per_server:
+                    job = self.pending.pop(i)
+                    job.started = time.time()
+                    self.running[my_thread.getName()] = job
+                    return job
+            self.condition.wait(1.0)
+            return None
+        finally:
+            self.condition.release()
+
+    def _job_done(self, worker_name, job, failed=False):
+        self.condition.acquire()
+        try:
+            if self.running.get(worker_name) is not job:
+                return
+            del self.running[worker_name]
+            job.finished = time.time()
+            job.failed = failed
+            self.last_run[job.name] = job.finished
+            self.wait_times[job.name] = job.wait_time()
+            if failed:
+                count = self.failures.get(job.name, (0, 0))[0] + 1
+                delay = min(self.max_backoff, self.backoff * 2 ** (count - 1))
+                job.retry_at = job.finished + delay
+                self.failures[job.name] = (count, job.retry_at)
+                logger.warning('%s: failed %d times in a row, retrying in %ds', job.name, count, delay)
+                JOBS_FAILED.inc()
+            else:
+                self.failures.pop(job.name, None)
+            self.condition.notify_all()
+        finally:
+            self.condition.release()
+
+        self._notify(job)
+
+    @staticmethod
+    def _notify(job):
+        if job.on_done is not None:
+            try:
+                job.on_done(job)
+            except Exception as e:
+                logger.error('%s: completion callback failed, %s', job.name, str(e))
+
+    def _run(self, job):
+        return self.target(job.records)
+
+    def _worker(self):
+        my_thread = StoppableThread.current_thread()
+        while not my_thread.is_stopped():
+            job = self._next_job(my_thread)
+            if job is None:
+                continue
+
+            logger.debug('%s: started on %s after waiting %.3fs, queue depth %d', job.name, my_thread.getName(),
+                         job.wait_time(), len(self.pending))
+            failed = True
+            try:
+                job.result = self._run(job)
+                failed = False
+            except Exception as e:
+                job.error = str(e)
+                logger.error('%s: job failed, %s', job.name, str(e))
+            finally:
+                self._job_done(my_thread.getName(), job, failed=failed)
+        trace('%s: exiting', my_thread.getName())
+
+    def kill_hung_workers(self, hung_timeout=HUNG_TIMEOUT):
+        for th in list(self.workers):
+            job = self.running.get(th.getName())
+            if job is not None and time.time() - job.started > hung_timeout:
+                logger.error('%s: job on %s appears hung, killing', job.name, th.getName())
+                th.kill()
+                THREADS_KILLED.inc()
+                self._job_done(th.getName(), job, failed=True)
+                self.condition.acquire()
+                try:
+                    self.workers.remove(th)
+                    self._start_workers()
+                finally:
+                    self.condition.release()
+
+    def wait(self, hung_timeout=HUNG_TIMEOUT, is_stopped=None):
+        """
+        Block until every queued job has finished
+        :param hung_timeout: seconds after which a job's worker thread is killed, a last resort for
+        jobs stuck outside the IMAP deadline, e.g. on redis
+        :param is_stopped: optional callable, return early once it returns True
+        :return:
+        """
+        while is_stopped is None or not is_stopped():
+            self.condition.acquire()
+            try:
+                if len(self.pending) == 0 and len(self.running) == 0:
+                    break
+                self.condition.wait(5.0)
+            finally:
+                self.condition.release()
+            self.kill_hung_workers(hung_timeout)
+
+    def stop(self):
+        self.condition.acquire()
+        try:
+            dropped = self.pending
+            self.pending = []
+            for th in self.workers:
+                th.stop()
+            self.condition.notify_all()
+        finally:
+            self.condition.release()
+
+        # whoever queued the dropped jobs, e.g. the scheduler, still hears about them
+        for job in dropped:
+            job.cancelled = True
+            self._notify(job)
+
+    def stats(self):
+        self.condition.acquire()
+        try:
+            waits = list(self.wait_times.values())
+            running = {}
+            for job in self.running.values():
+                running[job.server] = running.get(job.server, 0) + 1
+            return {'workers': len([th for th in self.workers if th.is_alive()]),
+                    'queue_depth': len(self.pending),
+                    'running': running,
+                    'backing_off': len([f for f in self.failures.values() if f[1] > time.time()]),
+                    'max_wait': max(waits) if len(waits) > 0 else 0.0,
+                    'avg_wait': sum(waits) / len(waits) if len(waits) > 0 else 0.0}
+        finally:
+            self.condition.release()
+
+
+def run_parallel(target, items, parallelism, name=WORKER_PREFIX, is_stopped=None):
+    """
+    Call target(item) for every item on up to parallelism threads and return once all
+    have finished, a failed item does not stop the others
+    :param target: called as target(item)
+    :param items: list of arguments
+    :param parallelism: most items running at once, 1 runs them in the calling thread
+    :param name: thread name prefix
+    :param is_stopped: optional callable, remaining items are skipped once it returns True
+    :return:
+    list of (item, exception) for the items that failed
+    """
+    lock = threading.Lock()
+    remaining = list(items)
+    errors = []
+
+    def run_items():
+        while is_stopped is None or not is_stopped():
+            with lock:
+                if len(remaining) == 0:
+                    return
+                item = remaining.pop(0)
+            try:
+                target(item)
+            except Exception as e:
+                with lock:
+                    errors.append((item, e))
+
+    parallelism = min(parallelism, len(remaining))
+    if parallelism <= 1:
+        run_items()
+        return errors
+
+    threads = []
+    for i in range(0, parallelism):
+        th = StoppableThread(name='%s.%d' % (name, i + 1), target=run_items)
+        th.setDaemon(True)
+        threads.append(th)
+        th.start()
+    for th in threads:
+        th.join()
+    trace('%s: %d items on %d threads, %d failed', name, len(items), parallelism, len(errors))
+    return errors
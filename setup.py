@@ -12,6 +12,10 @@ with codecs.open('DESCRIPTION.rst', encoding='utf-8') as f:
 with open("requirements.txt") as requirements:
     install_requires = requirements.readlines()
 
+# the tests stand in for redis with fakeredis
+with open("test-requirements.txt") as requirements:
+    tests_require = requirements.readlines()
+
 setup(
     name='active_mail_filter',
     version='0.1.0',
@@ -41,6 +45,8 @@ setup(
                             'amf_update_conf = active_mail_filter.commands:update_config']
     },
     install_requires=install_requires,
+    tests_require=tests_require,
+    extras_require={'test': tests_require},
     data_files=[
         ('/active_mail_filter', ['active_mail_filter/index.html', 'active_mail_filter/swagger.yaml']),
     ],
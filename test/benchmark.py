@@ -0,0 +1,229 @@
+#! /usr/bin/python
+# Copyright (c) 2016, Kevin Rodgers
+# Released subject to the New BSD License
+# Please see http://en.wikipedia.org/wiki/BSD_licenses
+
+import os
+import sys
+import json
+import time
+import getopt
+import resource
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_imap_server import FakeImapServer
+from active_mail_filter import read_configuration_file
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+DEF_TOLERANCE = 0.25
+DEF_SETTINGS = {'latency': 0.005, 'messages': 4000, 'senders': 50, 'folders': 4, 'users': 8}
+# worker processes of the cycle_processes scenario
+BENCH_PROCESSES = 2
+
+USAGE = '''Usage: benchmark.py [-s] [-b <baseline-file>] [-t <tolerance>] [-l <latency>] [-m <messages>]
+                    [-k <senders>] [-f <folders>] [-u <users>] [scenario ...]
+    -s  save the results as the new baseline
+scenarios: %s
+'''
+
+
+def _rules(server, user, folders):
+    return [{'uuid': '%s-%d' % (user, f), 'user': user, 'password': 'secret', 'mail_server': server.url,
+             'email': '%s@example.com' % user, 'source': 'inbox', 'target': 'folder%d' % f}
+            for f in range(0, folders)]
+
+
+def _use_redis():
+    # a local redis server if one is running, otherwise fakeredis when it is installed
+    import redis
+    conf = read_configuration_file()
+    try:
+        redis.Redis(host=conf['redis_server']['redis_server_address']).ping()
+        return 'redis'
+    except redis.ConnectionError:
+        import fakeredis
+        shared = fakeredis.FakeStrictRedis()
+        redis.Redis = lambda *args, **kwargs: shared
+        return 'fakeredis'
+
+
+def bench_filter_user_rules(server, settings):
+    from active_mail_filter.mboxfolder import MboxFolder
+    from active_mail_filter.rule_compiler import filter_user_rules
+
+    account = server.seed('bench', 'secret', folders=settings['folders'], messages=settings['messages'],
+                          senders=settings['senders'])
+    scanned = len(account.folder('inbox').messages)
+    mailbox = MboxFolder(server.url, 'bench', 'secret')
+    server.reset_counts()
+    start = time.time()
+    filter_user_rules(mailbox, _rules(server, 'bench', settings['folders']))
+    return scanned, time.time() - start
+
+
+def bench_imapuser_filter_mail(server, settings):
+    from active_mail_filter.mboxfolder import MboxFolder
+    from active_mail_filter.imapuser import ImapUser
+
+    account = server.seed('bench', 'secret', folders=settings['folders'], messages=settings['messages'],
+                          senders=settings['senders'])
+    scanned = len(account.folder('inbox').messages)
+    mailbox = MboxFolder(server.url, 'bench', 'secret')
+    server.reset_counts()
+    start = time.time()
+    for f in range(0, settings['folders']):
+        ImapUser(mailbox, 'folder%d' % f).filter_mail()
+    return scanned, time.time() - start
+
+
+def bench_cycle(server, settings):
+    _use_redis()
+    from active_mail_filter import daemon
+    from active_mail_filter.stoppable_thread import StoppableThread
+
+    scanned = 0
+    users = {}
+    for u in range(0, settings['users']):
+        user = 'bench%d' % u
+        account = server.seed(user, 'secret', folders=settings['folders'],
+                              messages=settings['messages'] // settings['users'], senders=settings['senders'])
+        scanned += len(account.folder('inbox').messages)
+        users[user] = _rules(server, user, settings['folders'])
+    server.reset_counts()
+    start = time.time()
+    th = StoppableThread(name='filter_daemon', target=daemon.run_all_workers, args=(users,))
+    th.start()
+    th.join()
+    elapsed = time.time() - start
+    daemon._get_worker_pool().stop()
+    daemon._get_mbox_pool().close_all()
+    return scanned, elapsed
+
+
+def bench_cycle_processes(server, settings):
+    read_configuration_file().set('filter_daemon', 'worker_processes', str(BENCH_PROCESSES))
+    return bench_cycle(server, settings)
+
+
+SCENARIOS = {'filter_user_rules': bench_filter_user_rules,
+             'imapuser_filter_mail': bench_imapuser_filter_mail,
+             'cycle': bench_cycle,
+             'cycle_processes': bench_cycle_processes}
+
+
+def _run_scenario(name, settings, results):
+    server = FakeImapServer(latency=settings['latency']).start()
+    try:
+        scanned, elapsed = SCENARIOS[name](server, settings)
+        # worker processes have exited by now, the largest of them counts
+        peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                       resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        results.put({'messages': scanned,
+                     'seconds': round(elapsed, 3),
+                     'messages_per_sec': round(scanned / elapsed, 1) if elapsed > 0 else 0.0,
+                     'round_trips': server.round_trips(),
+                     'peak_rss_mb': round(peak_rss / 1024.0, 1)})
+    finally:
+        server.stop()
+
+
+def run_scenario(name, settings):
+    # a fresh process per scenario so peak memory belongs to that scenario alone
+    results = multiprocessing.Queue()
+    child = multiprocessing.Process(target=_run_scenario, args=(name, settings, results))
+    child.start()
+    child.join()
+    if child.exitcode != 0 or results.empty():
+        raise RuntimeError('%s: benchmark failed, exit code %s' % (name, str(child.exitcode)))
+    return results.get()
+
+
+def compare(name, result, baseline, tolerance):
+    """
+    :return:
+    list of regressions, throughput may drop and round trips and memory may grow by tolerance
+    """
+    regressions = []
+    if baseline is None:
+        return regressions
+    if result['messages_per_sec'] < baseline['messages_per_sec'] * (1 - tolerance):
+        regressions.append('%s: %.1f messages/sec, baseline %.1f' % (name, result['messages_per_sec'],
+                                                                     baseline['messages_per_sec']))
+    for key in ('round_trips', 'peak_rss_mb'):
+        if result[key] > baseline[key] * (1 + tolerance):
+            regressions.append('%s: %s %s, baseline %s' % (name, key, str(result[key]), str(baseline[key])))
+    return regressions
+
+
+def main():
+    try:
+        options, scenarios = getopt.getopt(sys.argv[1:], 'sb:t:l:m:k:f:u:h', [])
+    except getopt.GetoptError as err:
+        sys.stderr.write('%s\n' % err)
+        sys.stderr.write(USAGE % ', '.join(sorted(SCENARIOS.keys())))
+        return 1
+
+    save = False
+    baseline_file = BASELINE_FILE
+    tolerance = DEF_TOLERANCE
+    settings = dict(DEF_SETTINGS)
+    names = {'-l': 'latency', '-m': 'messages', '-k': 'senders', '-f': 'folders', '-u': 'users'}
+    for opt, arg in options:
+        if opt == '-s':
+            save = True
+        elif opt == '-b':
+            baseline_file = arg
+        elif opt == '-t':
+            tolerance = float(arg)
+        elif opt in names:
+            settings[names[opt]] = float(arg) if opt == '-l' else int(arg)
+        else:
+            sys.stderr.write(USAGE % ', '.join(sorted(SCENARIOS.keys())))
+            return 1
+
+    for name in scenarios:
+        if name not in SCENARIOS:
+            sys.stderr.write('unknown scenario %s\n' % name)
+            return 1
+
+    baseline = {'settings': settings, 'results': {}}
+    if os.path.exists(baseline_file):
+        with open(baseline_file) as handle:
+            baseline = json.load(handle)
+    if baseline['settings'] != settings:
+        print('settings differ from the baseline, results are not compared')
+
+    results = {}
+    regressions = []
+    print('%-22s %9s %9s %12s %11s %8s' % ('scenario', 'messages', 'seconds', 'messages/sec', 'round trips',
+                                          'peak MB'))
+    for name in scenarios or sorted(SCENARIOS.keys()):
+        result = run_scenario(name, settings)
+        results[name] = result
+        print('%-22s %9d %9.3f %12.1f %11d %8.1f' % (name, result['messages'], result['seconds'],
+                                                     result['messages_per_sec'], result['round_trips'],
+                                                     result['peak_rss_mb']))
+        if baseline['settings'] == settings:
+            regressions.extend(compare(name, result, baseline['results'].get(name), tolerance))
+
+    if save:
+        baseline['settings'] = settings
+        baseline['results'].update(results)
+        with open(baseline_file, 'w') as handle:
+            json.dump(baseline, handle, indent=2, sort_keys=True, separators=(',', ': '))
+            handle.write('\n')
+        print('baseline saved to %s' % baseline_file)
+
+    for regression in regressions:
+        print('REGRESSION %s' % regression)
+    return 1 if len(regressions) > 0 else 0
+
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,19 @@
+#! /usr/bin/python
+# Copyright (c) 2016, Kevin Rodgers
+# Released subject to the New BSD License
+# Please see http://en.wikipedia.org/wiki/BSD_licenses
+
+import pytest
+import fakeredis
+
+
+@pytest.fixture
+def redis_server():
+    # in-memory stand-in for the redis server, every client made from it shares its data
+    return fakeredis.FakeServer()
+
+
+@pytest.fixture
+def fake_redis(redis_server):
+    # assigned to the redis attribute of a SimpleRedisDb, whose _open_db() then keeps it
+    return fakeredis.FakeStrictRedis(server=redis_server)
@@ -0,0 +1,582 @@
+#! /usr/bin/python
+# Copyright (c) 2016, Kevin Rodgers
+# Released subject to the New BSD License
+# Please see http://en.wikipedia.org/wiki/BSD_licenses
+
+import re
+import sys
+import time
+import select
+import socket
+import threading
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+
+CRLF = '\r\n'
+DEF_CAPABILITIES = ['IMAP4rev1', 'MOVE', 'UIDPLUS', 'IDLE', 'CONDSTORE', 'LIST-STATUS']
+
+
+class FakeMessage(object):
+    def __init__(self, uid, raw, flags=None, modseq=1):
+        self.uid = uid
+        self.raw = raw
+        self.flags = set(flags or [])
+        self.modseq = modseq
+        self.headers = {}
+        for name, value in re.findall(r'^([\w-]+):[ \t]*([^\r\n]*(?:\r\n[ \t][^\r\n]*)*)',
+                                       raw.split('\r\n\r\n')[0], re.M):
+            self.headers.setdefault(name.lower(), re.sub(r'\r\n[ \t]+', ' ', value))
+
+    def header(self, name):
+        return self.headers.get(name.lower(), '')
+
+
+class FakeFolder(object):
+    def __init__(self, name, uidvalidity=1):
+        self.name = name
+        self.uidvalidity = uidvalidity
+        self.uidnext = 1
+        self.modseq = 1
+        self.messages = []
+
+    def add(self, raw, flags=None):
+        self.modseq += 1
+        msg = FakeMessage(self.uidnext, raw, flags=flags, modseq=self.modseq)
+        self.uidnext += 1
+        self.messages.append(msg)
+        return msg
+
+    def unseen(self):
+        return len([m for m in self.messages if '\\Seen' not in m.flags])
+
+
+class FakeAccount(object):
+    def __init__(self, user, password):
+        self.user = user
+        self.password = password
+        self.folders = {'INBOX': FakeFolder('INBOX')}
+
+    def folder(self, name):
+        if name.lower() == 'inbox':
+            name = 'INBOX'
+        return self.folders.get(name)
+
+    def create(self, name):
+        if self.folder(name) is None:
+            self.folders[name] = FakeFolder(name, uidvalidity=len(self.folders) + 1)
+        return self.folder(name)
+
+
+def make_message(sender, to='user@example.com', subject='test', body='hello', size=0):
+    if size > len(body):
+        body = (body + '\r\n') * (size // (len(body) + 2) + 1)
+    return 'From: %s\r\nTo: %s\r\nSubject: %s\r\nDate: Mon, 1 Jan 2018 00:00:00 +0000\r\n\r\n%s\r\n' % \
+           (sender, to, subject, body)
+
+
+def _tokenize(line):
+    tokens = []
+    stack = []
+    cur = tokens
+    i = 0
+    while i < len(line):
+        c = line[i]
+        if c == ' ':
+            i += 1
+        elif c == '(':
+            new = []
+            cur.append(new)
+            stack.append(cur)
+            cur = new
+            i += 1
+        elif c == ')':
+            cur = stack.pop()
+            i += 1
+        elif c == '"':
+            j = i + 1
+            buf = []
+            while line[j] != '"':
+                if line[j] == '\\':
+                    j += 1
+                buf.append(line[j])
+                j += 1
+            cur.append(''.join(buf))
+            i = j + 1
+        else:
+            j = i
+            depth = 0
+            while j < len(line) and (depth or line[j] not in ' ()'):
+                if line[j] == '[':
+                    depth += 1
+                elif line[j] == ']':
+                    depth -= 1
+                j += 1
+            cur.append(line[i:j])
+            i = j
+    return tokens
+
+
+def _quote(name):
+    return '"%s"' % name.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def _in_set(value, seq_set, largest):
+    for part in seq_set.split(','):
+        if ':' in part:
+            lo, hi = part.split(':')
+            lo = largest if lo == '*' else int(lo)
+            hi = largest if hi == '*' else int(hi)
+            if min(lo, hi) <= value <= max(lo, hi):
+                return True
+        elif (largest if part == '*' else int(part)) == value:
+            return True
+    return False
+
+
+class FakeImapHandler(socketserver.StreamRequestHandler):
+    # unbuffered so select() on the socket tells whether the client pipelined its next command
+    rbufsize = 0
+
+    def setup(self):
+        socketserver.StreamRequestHandler.setup(self)
+        self.account = None
+        self.selected = None
+        self.exists = 0
+        self.command_count = 0
+        with self.server.lock:
+            self.server.connections += 1
+
+    def finish(self):
+        with self.server.lock:
+            self.server.connections -= 1
+        try:
+            socketserver.StreamRequestHandler.finish(self)
+        except socket.error:
+            pass
+
+    def send(self, line):
+        data = line + CRLF
+        self.server.bytes_sent += len(data)
+        self.wfile.write(data.encode('latin-1'))
+        self.wfile.flush()
+
+    def readline(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        return line.decode('latin-1').rstrip('\r\n')
+
+    def handle(self):
+        self.send('* OK FakeImapServer ready')
+        while True:
+            pipelined = len(select.select([self.connection], [], [], 0)[0]) > 0
+            line = self.readline()
+            if line is None:
+                break
+            tokens = _tokenize(line)
+            if len(tokens) < 2:
+                self.send('* BAD invalid command')
+                continue
+            tag, name, args = tokens[0], tokens[1].upper(), tokens[2:]
+            if name == 'UID' and len(args) > 0:
+                name, args, use_uid = 'UID ' + args[0].upper(), args[1:], True
+            else:
+                use_uid = False
+            self.server.count(name)
+
+            self.command_count += 1
+            if 0 < self.server.bye_after <= self.command_count:
+                self.send('* BYE server going away')
+                break
+            # latency is a network round trip, commands sent before the last reply was read share one
+            if not pipelined:
+                self.server.count_round_trip()
+                if self.server.latency > 0:
+                    time.sleep(self.server.latency)
+            if name.split()[-1] in self.server.hang_on:
+                time.sleep(self.server.hang_seconds)
+            if name.split()[-1] in self.server.reject:
+                self.send('%s NO %s rejected' % (tag, name))
+                continue
+
+            method = getattr(self, 'do_' + name.split()[-1], None)
+            if method is None or (name.split()[-1] in self.server.cap_commands and
+                                  self.server.cap_commands[name.split()[-1]] not in self.server.capabilities):
+                self.send('%s BAD unknown command %s' % (tag, name))
+                continue
+            try:
+                result = method(tag, args, use_uid)
+            except Exception as e:
+                self.send('%s BAD %s' % (tag, str(e)))
+                continue
+            if result is False:
+                break
+
+    def _messages(self, seq_set, use_uid):
+        msgs = self.selected.messages
+        if len(msgs) == 0:
+            return []
+        largest = msgs[-1].uid if use_uid else len(msgs)
+        found = []
+        for i, m in enumerate(msgs):
+            if _in_set(m.uid if use_uid else i + 1, seq_set, largest):
+                found.append((i + 1, m))
+        return found
+
+    def _notify_exists(self):
+        if self.selected is not None and len(self.selected.messages) != self.exists:
+            self.exists = len(self.selected.messages)
+            self.send('* %d EXISTS' % self.exists)
+
+    def do_CAPABILITY(self, tag, args, use_uid):
+        self.send('* CAPABILITY %s' % ' '.join(self.server.capabilities))
+        self.send('%s OK CAPABILITY completed' % tag)
+
+    def do_LOGIN(self, tag, args, use_uid):
+        account = self.server.accounts.get(args[0])
+        if account is None or account.password != args[1]:
+            self.send('%s NO [AUTHENTICATIONFAILED] invalid credentials' % tag)
+        else:
+            self.account = account
+            self.send('%s OK [CAPABILITY %s] LOGIN completed' % (tag, ' '.join(self.server.capabilities)))
+
+    def do_LOGOUT(self, tag, args, use_uid):
+        self.send('* BYE logging out')
+        self.send('%s OK LOGOUT completed' % tag)
+        return False
+
+    def do_NOOP(self, tag, args, use_uid):
+        self._notify_exists()
+        self.send('%s OK NOOP completed' % tag)
+
+    def _status_items(self, folder, items):
+        values = {'MESSAGES': len(folder.messages), 'UNSEEN': folder.unseen(), 'UIDNEXT': folder.uidnext,
+                  'UIDVALIDITY': folder.uidvalidity, 'RECENT': 0, 'HIGHESTMODSEQ': folder.modseq}
+        return ' '.join('%s %d' % (i.upper(), values[i.upper()]) for i in items
+                        if i.upper() != 'HIGHESTMODSEQ' or 'CONDSTORE' in self.server.capabilities)
+
+    def do_LIST(self, tag, args, use_uid):
+        status_items = None
+        if len(args) > 3 and args[2].upper() == 'RETURN':
+            status_items = args[3][1]
+        for name in sorted(self.account.folders.keys()):
+            self.send('* LIST (\\HasNoChildren) "/" %s' % self._astring(name))
+            if status_items is not None:
+                self.send('* STATUS %s (%s)' % (self._astring(name),
+                                                self._status_items(self.account.folders[name], status_items)))
+        self.send('%s OK LIST completed' % tag)
+
+    def _astring(self, name):
+        # some servers send folder names as literals rather than quoted strings
+        if self.server.literal_names:
+            return '{%d}%s%s' % (len(name), CRLF, name)
+        return _quote(name)
+
+    def do_STATUS(self, tag, args, use_uid):
+        folder = self.account.folder(args[0])
+        if folder is None:
+            self.send('%s NO no such mailbox' % tag)
+            return
+        self.send('* STATUS %s (%s)' % (self._astring(folder.name), self._status_items(folder, args[1])))
+        self.send('%s OK STATUS completed' % tag)
+
+    def do_SELECT(self, tag, args, use_uid):
+        folder = self.account.folder(args[0])
+        if folder is None:
+            self.selected = None
+            self.send('%s NO no such mailbox' % tag)
+            return
+        self.selected = folder
+        self.exists = len(folder.messages)
+        self.send('* FLAGS (\\Answered \\Flagged \\Deleted \\Seen \\Draft)')
+        self.send('* %d EXISTS' % self.exists)
+        self.send('* 0 RECENT')
+        self.send('* OK [UIDVALIDITY %d] UIDs valid' % folder.uidvalidity)
+        self.send('* OK [UIDNEXT %d] Predicted next UID' % folder.uidnext)
+        if 'CONDSTORE' in self.server.capabilities:
+            self.send('* OK [HIGHESTMODSEQ %d] Highest' % folder.modseq)
+        self.send('%s OK [READ-WRITE] SELECT completed' % tag)
+
+    do_EXAMINE = do_SELECT
+
+    def _criteria(self, keys):
+        key = keys.pop(0)
+        if isinstance(key, list):
+            tests = []
+            while len(key) > 0:
+                tests.append(self._criteria(key))
+            return lambda seq, msg: all(t(seq, msg) for t in tests)
+
+        key = key.upper()
+        if key == 'ALL':
+            return lambda seq, msg: True
+        if key in ('FROM', 'TO', 'SUBJECT'):
+            value = keys.pop(0).lower()
+            return lambda seq, msg: value in msg.header(key).lower()
+        if key in ('SEEN', 'UNSEEN', 'DELETED', 'UNDELETED'):
+            flag = '\\' + key.replace('UN', '').capitalize()
+            return lambda seq, msg: (flag in msg.flags) != key.startswith('UN')
+        if key == 'UID':
+            uid_set = keys.pop(0)
+            return lambda seq, msg: _in_set(msg.uid, uid_set, self.selected.messages[-1].uid)
+        if key == 'MODSEQ':
+            modseq = int(keys.pop(0))
+            return lambda seq, msg: msg.modseq >= modseq
+        if key == 'NOT':
+            test = self._criteria(keys)
+            return lambda seq, msg: not test(seq, msg)
+        if key == 'OR':
+            left = self._criteria(keys)
+            right = self._criteria(keys)
+            return lambda seq, msg: left(seq, msg) or right(seq, msg)
+        if re.match(r'^[\d:*,]+$', key):
+            return lambda seq, msg: _in_set(seq, key, len(self.selected.messages))
+        raise ValueError('unsupported search key %s' % key)
+
+    def do_SEARCH(self, tag, args, use_uid):
+        if self.selected is None:
+            self.send('%s BAD no mailbox selected' % tag)
+            return
+        if len(args) > 1 and not isinstance(args[0], list) and args[0].upper() == 'CHARSET':
+            args = args[2:]
+        if len(self.selected.messages) == 0:
+            self.send('* SEARCH')
+            self.send('%s OK SEARCH completed' % tag)
+            return
+        test = self._criteria([list(args)])
+        found = []
+        for i, m in enumerate(self.selected.messages):
+            if test(i + 1, m):
+                found.append(str(m.uid if use_uid else i + 1))
+        self.send('* SEARCH' + ''.join(' ' + f for f in found))
+        self.send('%s OK SEARCH completed' % tag)
+
+    @staticmethod
+    def _section(msg, section):
+        header, body = msg.raw.split('\r\n\r\n', 1) if '\r\n\r\n' in msg.raw else (msg.raw, '')
+        section = section.upper()
+        if section == '':
+            return msg.raw
+        if section == 'HEADER':
+            return header + '\r\n\r\n'
+        if section == 'TEXT':
+            return body
+        fields = re.match(r'HEADER\.FIELDS \((.*)\)', section)
+        if fields is not None:
+            wanted = fields.group(1).split()
+            lines = re.findall(r'^[\w-]+:[^\r\n]*(?:\r\n[ \t][^\r\n]*)*', header, re.M)
+            return ''.join(l + '\r\n' for l in lines if l.split(':')[0].upper() in wanted) + '\r\n'
+        raise ValueError('unsupported section %s' % section)
+
+    def do_FETCH(self, tag, args, use_uid):
+        items = args[1] if isinstance(args[1], list) else [args[1]]
+        for seq, msg in self._messages(args[0], use_uid):
+            plain = ['UID %d' % msg.uid] if use_uid else []
+            literals = []
+            for item in items:
+                upper = item.upper()
+                if upper == 'UID':
+                    if not use_uid:
+                        plain.append('UID %d' % msg.uid)
+                elif upper == 'FLAGS':
+                    plain.append('FLAGS (%s)' % ' '.join(sorted(msg.flags)))
+                elif upper == 'RFC822.SIZE':
+                    plain.append('RFC822.SIZE %d' % len(msg.raw))
+                elif upper == 'MODSEQ':
+                    plain.append('MODSEQ (%d)' % msg.modseq)
+                elif upper.startswith('BODY') or upper.startswith('RFC822'):
+                    section = re.match(r'(BODY(?:\.PEEK)?\[(.*)\]|RFC822(?:\.HEADER)?)(?:<(\d+)\.(\d+)>)?$',
+                                       item, re.I)
+                    if section is None:
+                        raise ValueError('unsupported fetch item %s' % item)
+                    if section.group(2) is not None:
+                        name = 'BODY[%s]' % section.group(2)
+                        data = self._section(msg, section.group(2))
+                    else:
+                        name = section.group(1).upper()
+                        data = self._section(msg, 'HEADER' if name == 'RFC822.HEADER' else '')
+                    if section.group(3) is not None:
+                        offset = int(section.group(3))
+                        data = data[offset:offset + int(section.group(4))]
+                        name = '%s<%d>' % (name, offset)
+                    if 'PEEK' not in upper and 'HEADER' not in upper:
+                        msg.flags.add('\\Seen')
+                    literals.append((name, data))
+                else:
+                    raise ValueError('unsupported fetch item %s' % item)
+            response = '* %d FETCH (%s' % (seq, ' '.join(plain))
+            for name, data in literals:
+                response += '%s%s {%d}%s%s' % (' ' if response[-1] != '(' else '', name, len(data), CRLF, data)
+            self.send(response + ')')
+        self.send('%s OK FETCH completed' % tag)
+
+    def do_STORE(self, tag, args, use_uid):
+        action = args[1].upper()
+        flags = args[2] if isinstance(args[2], list) else [args[2]]
+        for seq, msg in self._messages(args[0], use_uid):
+            if action.startswith('+'):
+                msg.flags.update(flags)
+            elif action.startswith('-'):
+                msg.flags.difference_update(flags)
+            else:
+                msg.flags = set(flags)
+            self.selected.modseq += 1
+            msg.modseq = self.selected.modseq
+            if not action.endswith('.SILENT'):
+                self.send('* %d FETCH (%sFLAGS (%s))' % (seq, 'UID %d ' % msg.uid if use_uid else '',
+                                                        ' '.join(sorted(msg.flags))))
+        self.send('%s OK STORE completed' % tag)
+
+    def _copy(self, tag, args, use_uid):
+        target = self.account.folder(args[1])
+        if target is None:
+            self.send('%s NO [TRYCREATE] no such mailbox' % tag)
+            return None
+        moved = self._messages(args[0], use_uid)
+        src_uids, dst_uids = [], []
+        for seq, msg in moved:
+            copy = target.add(msg.raw, flags=msg.flags - set(['\\Deleted']))
+            src_uids.append(str(msg.uid))
+            dst_uids.append(str(copy.uid))
+        return moved, 'COPYUID %d %s %s' % (target.uidvalidity, ','.join(src_uids), ','.join(dst_uids))
+
+    def do_COPY(self, tag, args, use_uid):
+        result = self._copy(tag, args, use_uid)
+        if result is not None:
+            self.send('%s OK [%s] COPY completed' % (tag, result[1]))
+
+    def _expunge(self, messages):
+        for seq, msg in sorted(messages, key=lambda s: s[0], reverse=True):
+            self.selected.messages.remove(msg)
+            self.send('* %d EXPUNGE' % seq)
+        self.selected.modseq += 1
+        self.exists = len(self.selected.messages)
+
+    def do_MOVE(self, tag, args, use_uid):
+        result = self._copy(tag, args, use_uid)
+        if result is not None:
+            self.send('* OK [%s] moved' % result[1])
+            self._expunge(result[0])
+            self.send('%s OK MOVE completed' % tag)
+
+    def do_EXPUNGE(self, tag, args, use_uid):
+        if use_uid:
+            messages = self._messages(args[0], True)
+        else:
+            messages = list(enumerate(self.selected.messages, 1))
+        self._expunge([(s, m) for s, m in messages if '\\Deleted' in m.flags])
+        self.send('%s OK EXPUNGE completed' % tag)
+
+    def do_IDLE(self, tag, args, use_uid):
+        self.send('+ idling')
+        while True:
+            self._notify_exists()
+            readable, _, _ = select.select([self.rfile], [], [], 0.05)
+            if len(readable) > 0:
+                line = self.readline()
+                if line is None:
+                    return False
+                if line.upper() == 'DONE':
+                    break
+        self.send('%s OK IDLE terminated' % tag)
+
+
+class FakeImapServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    cap_commands = {'MOVE': 'MOVE', 'IDLE': 'IDLE'}
+
+    def __init__(self, address=('127.0.0.1', 0), capabilities=None, latency=0.0):
+        """
+        In process IMAP4rev1 server holding its mailboxes in memory, for tests and benchmarks
+
+        :param address: listen address, port 0 picks a free port
+        :param capabilities: advertised capabilities, MOVE and IDLE are refused when not listed
+        :param latency: seconds added to every network round trip, pipelined commands share one
+        Failure modes are set on the instance: bye_after sends BYE after that many commands
+        on a connection, hang_on is a set of command names that sleep hang_seconds and reject
+        a set of command names answered with NO, literal_names sends folder names as literals
+        """
+        socketserver.TCPServer.__init__(self, address, FakeImapHandler)
+        self.capabilities = list(DEF_CAPABILITIES if capabilities is None else capabilities)
+        self.latency = latency
+        self.bye_after = 0
+        self.hang_on = set()
+        self.hang_seconds = 0
+        self.reject = set()
+        self.literal_names = False
+        self.accounts = {}
+        self.commands = {}
+        self.trips = 0
+        self.connections = 0
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopped = False
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    @property
+    def url(self):
+        # mail server value for MboxFolder, a plain connection to this server
+        return 'imap://%s:%d' % self.server_address
+
+    def count(self, name):
+        with self.lock:
+            self.commands[name] = self.commands.get(name, 0) + 1
+
+    def count_round_trip(self):
+        with self.lock:
+            self.trips += 1
+
+    def round_trips(self):
+        return self.trips
+
+    def reset_counts(self):
+        with self.lock:
+            self.commands = {}
+            self.trips = 0
+            self.bytes_sent = 0
+
+    def add_account(self, user, password):
+        self.accounts[user] = FakeAccount(user, password)
+        return self.accounts[user]
+
+    def seed(self, user, password, folders=1, messages=100, senders=10, filed=0.5, size=0):
+        account = self.add_account(user, password)
+        inbox = account.folder('inbox')
+        for f in range(0, folders):
+            target = account.create('folder%d' % f)
+            for s in range(0, senders):
+                sender = '"Sender %d" <sender%d.%d@example.com>' % (s, f, s)
+                for m in range(0, int(messages * filed) // (senders * folders) or 1):
+                    target.add(make_message(sender, subject='filed %d' % m, size=size), flags=['\\Seen'])
+                for m in range(0, int(messages * (1 - filed)) // (senders * folders)):
+                    inbox.add(make_message(sender, subject='new %d' % m, size=size))
+        return account
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name='fake_imap')
+        self.thread.setDaemon(True)
+        self.thread.start()
+        return self
+
+    def handle_error(self, request, client_address):
+        # clients hanging up and handler threads cut off by stop() are expected, module
+        # globals may already be gone when a daemon thread fails during interpreter exit
+        try:
+            error = sys.exc_info()[1]
+            if self.stopped or isinstance(error, socket.error):
+                return
+        except Exception:
+            return
+        socketserver.TCPServer.handle_error(self, request, client_address)
+
+    def stop(self):
+        self.stopped = True
+        self.shutdown()
+        self.server_close()
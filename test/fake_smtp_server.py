@@ -0,0 +1,191 @@
+#! /usr/bin/python
+# Copyright (c) 2016, Kevin Rodgers
+# Released subject to the New BSD License
+# Please see http://en.wikipedia.org/wiki/BSD_licenses
+
+import sys
+import base64
+import socket
+import threading
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+
+CRLF = '\r\n'
+
+
+def no_starttls(smtp, *args, **kwargs):
+    # SmtpForwarder always starts TLS, tests put this in place of smtplib.SMTP.starttls and
+    # the session stays in plain text, the server forgets the EHLO as it would after STARTTLS
+    smtp.ehlo_resp = smtp.helo_resp = None
+    smtp.esmtp_features = {}
+    smtp.does_esmtp = 0
+    return smtp.docmd('STARTTLS')
+
+
+class FakeSmtpHandler(socketserver.StreamRequestHandler):
+    def setup(self):
+        socketserver.StreamRequestHandler.setup(self)
+        self.mail_from = None
+        self.rcpt_to = []
+        self.delivered = 0
+        with self.server.lock:
+            self.server.sessions += 1
+
+    def send(self, line):
+        self.wfile.write(line + CRLF)
+        self.wfile.flush()
+
+    def readline(self):
+        line = self.rfile.readline()
+        if len(line) == 0:
+            return None
+        return line[:-2] if line.endswith(CRLF) else line.rstrip('\n')
+
+    def handle(self):
+        self.send('220 FakeSmtpServer ready')
+        while True:
+            line = self.readline()
+            if line is None:
+                break
+            name, _, args = line.partition(' ')
+            name = name.upper()
+            self.server.count(name)
+            method = getattr(self, 'do_' + name, None)
+            if method is None:
+                self.send('502 unknown command %s' % name)
+                continue
+            if method(args) is False:
+                break
+
+    def do_EHLO(self, args):
+        self.send('250-FakeSmtpServer')
+        self.send('250-STARTTLS')
+        self.send('250 AUTH PLAIN')
+
+    def do_HELO(self, args):
+        self.send('250 FakeSmtpServer')
+
+    def do_STARTTLS(self, args):
+        self.send('220 ready to start TLS')
+
+    def do_AUTH(self, args):
+        mechanism, _, response = args.partition(' ')
+        fields = base64.b64decode(response).split('\0') if mechanism.upper() == 'PLAIN' else []
+        if fields[1:] != [self.server.login, self.server.password]:
+            self.send('535 authentication failed')
+        else:
+            self.send('235 authentication succeeded')
+
+    def do_MAIL(self, args):
+        if self.mail_from is not None:
+            self.send('503 nested MAIL command')
+            return
+        self.mail_from = args.split(':', 1)[1].strip().strip('<>')
+        self.send('250 OK')
+
+    def do_RCPT(self, args):
+        if self.mail_from is None:
+            self.send('503 need MAIL command')
+            return
+        self.rcpt_to.append(args.split(':', 1)[1].strip().strip('<>'))
+        self.send('250 OK')
+
+    def do_DATA(self, args):
+        if len(self.rcpt_to) == 0:
+            self.send('503 need RCPT command')
+            return
+        if self.server.refuse_data:
+            self.send('%d message refused' % self.server.refuse_data)
+            return
+        self.send('354 end data with <CR><LF>.<CR><LF>')
+        lines = []
+        while True:
+            line = self.rfile.readline()
+            if len(line) == 0:
+                return False
+            if line == '.' + CRLF:
+                break
+            lines.append(line[1:] if line.startswith('.') else line)
+        with self.server.lock:
+            self.server.messages.append((self.mail_from, list(self.rcpt_to), ''.join(lines)))
+        self.mail_from, self.rcpt_to = None, []
+        self.send('250 OK queued')
+
+        # servers close a session after a number of messages
+        self.delivered += 1
+        if 0 < self.server.drop_after <= self.delivered:
+            return False
+
+    def do_RSET(self, args):
+        self.mail_from, self.rcpt_to = None, []
+        self.send('250 OK')
+
+    def do_NOOP(self, args):
+        self.send('250 OK')
+
+    def do_QUIT(self, args):
+        self.send('221 bye')
+        return False
+
+
+class FakeSmtpServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 0), login='user', password='secret'):
+        """
+        In process SMTP server keeping every message it accepts, for tests, it speaks plain
+        text only so the client's starttls is replaced with no_starttls
+
+        :param address: listen address, port 0 picks a free port
+        :param login: AUTH PLAIN user
+        :param password: AUTH PLAIN password
+        Failure modes are set on the instance: drop_after closes a session after that many
+        messages and refuse_data answers DATA with that reply code
+        """
+        socketserver.TCPServer.__init__(self, address, FakeSmtpHandler)
+        self.login = login
+        self.password = password
+        self.drop_after = 0
+        self.refuse_data = 0
+        self.messages = []
+        self.commands = {}
+        self.sessions = 0
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopped = False
+
+    @property
+    def host(self):
+        return self.server_address[0]
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def count(self, name):
+        with self.lock:
+            self.commands[name] = self.commands.get(name, 0) + 1
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name='fake_smtp')
+        self.thread.setDaemon(True)
+        self.thread.start()
+        return self
+
+    def handle_error(self, request, client_address):
+        # clients hanging up are expected
+        try:
+            error = sys.exc_info()[1]
+            if self.stopped or isinstance(error, socket.error):
+                return
+        except Exception:
+            return
+        socketserver.TCPServer.handle_error(self, request, client_address)
+
+    def stop(self):
+        self.stopped = True
+        self.shutdown()
+        self.server_close()
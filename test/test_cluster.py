@@ -0,0 +1,71 @@
+#! /usr/bin/python
+# Copyright (c) 2016, Kevin Rodgers
+# Released subject to the New BSD License
+# Please see http://en.wikipedia.org/wiki/BSD_licenses
+
+import time
+import logging
+import fakeredis
+from active_mail_filter import get_logger
+from active_mail_filter.cluster import ClusterMembership
+
+logger = get_logger()
+logger.setLevel(logging.DEBUG)
+
+USERS = [{'user': 'user%d@example.com' % i} for i in range(0, 300)]
+
+
+def _nodes(redis_server, names, node_timeout=15):
+    # every node shares one in-memory redis, as daemons on several hosts share one server
+    nodes = []
+    for name in names:
+        node = ClusterMembership('127.0.0.1', 'test', node_id=name, node_timeout=node_timeout)
+        node.redis = fakeredis.FakeStrictRedis(server=redis_server)
+        nodes.append(node)
+    return nodes
+
+
+def _heartbeat(nodes):
+    for i in range(0, 2):
+        for node in nodes:
+            node.heartbeat()
+
+
+def _owned(node):
+    return set(rec['user'] for rec in node.owned_records(USERS))
+
+
+def test_users_split_between_nodes(redis_server):
+    nodes = _nodes(redis_server, ['a', 'b', 'c'])
+    _heartbeat(nodes)
+    owned = [_owned(node) for node in nodes]
+    assert set.union(*owned) == set(rec['user'] for rec in USERS)
+    assert sum(len(o) for o in owned) == len(USERS)
+    assert all(len(o) > len(USERS) // 6 for o in owned)
+
+    # only the users of the node that left move
+    nodes[2].leave()
+    _heartbeat(nodes[:2])
+    assert nodes[0].ring.nodes == ('a', 'b')
+    assert _owned(nodes[0]) >= owned[0] and _owned(nodes[1]) >= owned[1]
+    assert _owned(nodes[0]) | _owned(nodes[1]) == set(rec['user'] for rec in USERS)
+
+
+def test_dead_node_dropped(redis_server):
+    nodes = _nodes(redis_server, ['a', 'b'], node_timeout=0.5)
+    _heartbeat(nodes)
+    assert nodes[0].live_nodes() == ['a', 'b']
+    time.sleep(0.6)
+    assert nodes[0].heartbeat()
+    assert nodes[0].ring.nodes == ('a',)
+    assert len(_owned(nodes[0])) == len(USERS)
+
+
+def test_lease(redis_server):
+    nodes = _nodes(redis_server, ['a', 'b'])
+    assert nodes[0].acquire('user', 30)
+    assert not nodes[1].acquire('user', 30)
+    nodes[1].release('user')
+    assert not nodes[1].acquire('user', 30)
+    nodes[0].release('user')
+    assert nodes[1].acquire('user', 30)
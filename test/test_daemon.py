@@ -0,0 +1,79 @@
+#! /usr/bin/python
+# Copyright (c) 2016, Kevin Rodgers
+# Released subject to the New BSD License
+# Please see http://en.wikipedia.org/wiki/BSD_licenses
+
+import time
+import logging
+from active_mail_filter import get_logger
+from active_mail_filter import daemon
+from active_mail_filter.scheduler import UserScheduler
+from active_mail_filter.worker_pool import WorkerJob
+from active_mail_filter.stoppable_thread import StoppableThread
+
+logger = get_logger()
+logger.setLevel(logging.DEBUG)
+
+
+def _rule(source, target):
+    return {'uuid': '%s-%s' % (source, target), 'user': 'user', 'password': 'secret',
+            'mail_server': 'imap.example.com', 'email': 'user@example.com', 'source': source, 'target': target}
+
+
+def _run_user(records):
+    # _filter_user runs on a worker thread, returns what it returned or raised
+    outcome = []
+
+    def run():
+        try:
+            outcome.append(daemon._filter_user(records))
+        except Exception as e:
+            outcome.append(e)
+    th = StoppableThread(name='worker:test', target=run)
+    th.start()
+    th.join(10)
+    return outcome[0]
+
+
+def test_parallel_sources_fail_user(monkeypatch):
+    # a source folder that fails on its own thread still fails the user's job
+    def filter_group(records, is_stopped=None, deadline=None):
+        if records[0]['source'] == 'broken':
+            raise ValueError('folder gone')
+        return len(records)
+
+    monkeypatch.setattr(daemon, '_filter_rule_group', filter_group)
+    parallelism = daemon._CONF_.get('filter_daemon', 'user_parallelism')
+    daemon._CONF_.set('filter_daemon', 'user_parallelism', '2')
+    try:
+        assert _run_user([_rule('inbox', 'a'), _rule('work', 'b')]) == 2
+        error = _run_user([_rule('inbox', 'a'), _rule('broken', 'b'), _rule('work', 'c')])
+        assert isinstance(error, ValueError) and str(error) == 'folder gone'
+    finally:
+        daemon._CONF_.set('filter_daemon', 'user_parallelism', parallelism)
+
+
+class _LeasedElsewhere(object):
+    def acquire(self, user, ttl):
+        return False
+
+
+def test_lease_miss_keeps_interval(monkeypatch):
+    # a user another node is filtering did not run here, it is not slowed down as a quiet user is
+    scheduler = UserScheduler(interval=0.01, min_interval=0.01, max_interval=10, jitter=0, provider_rate=0)
+    monkeypatch.setattr(daemon, '_get_scheduler', lambda: scheduler)
+    monkeypatch.setattr(daemon, '_get_cluster', lambda: _LeasedElsewhere())
+    records = [_rule('inbox', 'a')]
+    assert daemon.worker_thread(records) == daemon.LEASE_HELD
+
+    def run(result):
+        time.sleep(0.02)
+        user = scheduler.due()[0]
+        job = WorkerJob(user.name, user.server, user.records)
+        job.result = result
+        daemon._job_completed(job)
+        return scheduler.users['user'].interval
+
+    scheduler.sync({'user': records})
+    assert run(daemon.LEASE_HELD) == 0.01
+    assert run(0) > 0.01
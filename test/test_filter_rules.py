@@ -0,0 +1,224 @@
+#! /usr/bin/python
+# Copyright (c) 2016, Kevin Rodgers
+# Released subject to the New BSD License
+# Please see http://en.wikipedia.org/wiki/BSD_licenses
+
+import time
+import logging
+from fake_imap_server import FakeImapServer, DEF_CAPABILITIES, make_message
+from active_mail_filter import get_logger
+from active_mail_filter.mboxfolder import MboxFolder, OperationTimeout, DeadlineExceeded, parse_server
+from active_mail_filter.folder_checkpoints import FolderCheckpoints
+from active_mail_filter.sender_index import SenderIndex
+from active_mail_filter.rule_compiler import filter_user_rules, CompiledSource, SEARCH_STRATEGIES, SEARCH_SERVER, \
+    SEARCH_CLIENT
+
+logger = get_logger()
+logger.setLevel(logging.DEBUG)
+
+
+def _rules(server, folders):
+    return [{'uuid': 'rule-%d' % f, 'user': 'user', 'password': 'secret', 'mail_server': server.url,
+             'email': 'user@example.com', 'source': 'inbox', 'target': 'folder%d' % f}
+            for f in range(0, folders)]
+
+
+def _run(strategy=None, capabilities=None, sender_index=None):
+    server = FakeImapServer(capabilities=capabilities).start()
+    try:
+        account = server.seed('user', 'secret', folders=2, messages=80, senders=4)
+        inbox = len(account.folder('inbox').messages)
+        filed = dict((f, len(account.folder('folder%d' % f).messages)) for f in range(0, 2))
+        mailbox = MboxFolder(server.url, 'user', 'secret')
+        moved = filter_user_rules(mailbox, _rules(server, 2), strategy=strategy, sender_index=sender_index)
+        mailbox.disconnect()
+        assert moved == inbox
+        assert len(account.folder('inbox').messages) == 0
+        for f in range(0, 2):
+            folder = account.folder('folder%d' % f)
+            assert len(folder.messages) == filed[f] + inbox // 2
+            assert all(('<sender%d.' % f) in m.header('from') for m in folder.messages)
+        return moved
+    finally:
+        server.stop()
+
+
+def test_filter_user_rules():
+    assert _run() == 40
+
+
+def test_search_strategies_agree():
+    assert len(set(_run(strategy=s) for s in SEARCH_STRATEGIES)) == 1
+
+
+def test_choose_strategy():
+    # one SEARCH beats fetching a large folder's headers, senders needing several never do
+    server = FakeImapServer().start()
+    try:
+        server.seed('user', 'secret', folders=1, messages=800, senders=1, filed=0)
+        mailbox = MboxFolder(server.url, 'user', 'secret')
+        compiled = CompiledSource('inbox', _rules(server, 1))
+        assert compiled.choose_strategy(mailbox, 10, batch_size=8) == SEARCH_CLIENT
+        assert compiled.choose_strategy(mailbox, 8, batch_size=8) == SEARCH_SERVER
+        assert compiled.choose_strategy(mailbox, 8, batch_size=8, uid_range='1:10') == SEARCH_CLIENT
+        mailbox.disconnect()
+    finally:
+        server.stop()
+
+
+def test_filter_with_sender_index(fake_redis):
+    # senders come from the index, which the pass builds for each target folder
+    index = SenderIndex('127.0.0.1', 'test')
+    index.redis = fake_redis
+    assert _run(sender_index=index) == 40
+    senders = [k for k in fake_redis.keys('test:senders:*') if not k.endswith(':state')]
+    assert len(senders) == 2 and all(len(fake_redis.smembers(k)) == 4 for k in senders)
+
+
+def _count_searches(monkeypatch):
+    # (uid_range, senders) of each search a pass makes
+    searches = []
+    filter_mail = CompiledSource.filter_mail
+
+    def counted(compiled, mailbox, uid_range=None, senders=None, **kwargs):
+        searches.append((uid_range, sorted(senders) if senders is not None else None))
+        return filter_mail(compiled, mailbox, uid_range=uid_range, senders=senders, **kwargs)
+    monkeypatch.setattr(CompiledSource, 'filter_mail', counted)
+    return searches
+
+
+def test_filter_from_checkpoint(monkeypatch, fake_redis):
+    server = FakeImapServer().start()
+    try:
+        account = server.seed('user', 'secret', folders=2, messages=80, senders=4)
+        inbox, folder0 = account.folder('inbox'), account.folder('folder0')
+        index, checkpoints = SenderIndex('127.0.0.1', 'test'), FolderCheckpoints('127.0.0.1', 'test')
+        index.redis = checkpoints.redis = fake_redis
+        filed = len(folder0.messages)
+        searches = _count_searches(monkeypatch)
+        mailbox = MboxFolder(server.url, 'user', 'secret')
+
+        def run():
+            return filter_user_rules(mailbox, _rules(server, 2), sender_index=index, checkpoints=checkpoints)
+
+        # the first pass sweeps the folder, the next only finds there is nothing new
+        assert run() == 40 and searches == [(None, None)]
+        assert run() == 0 and len(searches) == 1
+
+        # new mail is searched for by its uids alone
+        inbox.add(make_message('"Sender 0" <sender0.0@example.com>'))
+        inbox.add(make_message('"Stranger" <stranger@example.com>'))
+        assert run() == 1 and searches[-1] == ('%d:%d' % (inbox.uidnext - 2, inbox.uidnext - 1), None)
+        assert len(inbox.messages) == 1
+
+        # a sender filed by hand is searched for in the whole folder
+        folder0.add(make_message('"Stranger" <stranger@example.com>'))
+        assert run() == 1 and searches[-1] == (None, ['stranger@example.com'])
+        assert len(inbox.messages) == 0 and len(folder0.messages) == filed + 20 + 3
+        mailbox.disconnect()
+    finally:
+        server.stop()
+
+
+def test_filter_without_move():
+    # COPY, STORE \Deleted and EXPUNGE stand in for MOVE
+    assert _run(capabilities=[c for c in DEF_CAPABILITIES if c != 'MOVE']) == 40
+
+
+def test_list_folder_counts():
+    # LIST-STATUS returns the counts with the folder list, without it one STATUS per folder is pipelined,
+    # folder names may come back quoted or as literals
+    for capabilities, literal_names in [(c, l) for c in [DEF_CAPABILITIES, [c for c in DEF_CAPABILITIES
+                                                                             if c != 'LIST-STATUS']]
+                                        for l in [False, True]]:
+        server = FakeImapServer(capabilities=capabilities).start()
+        server.literal_names = literal_names
+        try:
+            account = server.seed('user', 'secret', folders=2, messages=40, senders=2)
+            account.create('Sent "Items"').add(make_message('user@example.com'))
+            account.folder('inbox').messages[0].flags.add('\\Seen')
+            mailbox = MboxFolder(server.url, 'user', 'secret')
+            server.reset_counts()
+            assert mailbox.list_folder_counts() == dict(
+                (name if name != 'INBOX' else 'inbox',
+                 {'messages': len(folder.messages), 'unseen': folder.unseen(), 'uidnext': folder.uidnext})
+                for name, folder in account.folders.items())
+            assert server.commands.get('STATUS', 0) == (0 if 'LIST-STATUS' in capabilities else 4)
+            mailbox.disconnect()
+        finally:
+            server.stop()
+
+
+def test_timeouts():
+    server = FakeImapServer().start()
+    try:
+        server.seed('user', 'secret', folders=1, messages=20, senders=2)
+        server.hang_on = set(['FETCH'])
+        server.hang_seconds = 2
+        mailbox = MboxFolder(server.url, 'user', 'secret', op_timeout=0.5)
+        start = time.time()
+        try:
+            mailbox.list_from_addresses(folder_name='folder0')
+            assert False, 'FETCH did not time out'
+        except OperationTimeout:
+            assert time.time() - start < 1.5
+
+        mailbox = MboxFolder(server.url, 'user', 'secret', deadline=time.time() + 0.5)
+        time.sleep(0.5)
+        try:
+            mailbox.list_folders(max_age=0)
+            assert False, 'LIST sent after the deadline'
+        except DeadlineExceeded:
+            pass
+    finally:
+        server.stop()
+
+
+def _expect_deadline(items):
+    try:
+        next(items)
+        assert False, 'read past the deadline'
+    except DeadlineExceeded:
+        pass
+
+
+def test_deadline_during_fetch():
+    # the deadline also cuts off a FETCH whose responses are still being read
+    server = FakeImapServer().start()
+    try:
+        account = server.seed('user', 'secret', folders=1, messages=20, senders=2)
+        account.folder('inbox').add(make_message('sender@example.com', size=4096))
+        mailbox = MboxFolder(server.url, 'user', 'secret')
+        uids = mailbox.list_email_uids('inbox')
+        mailbox.set_deadline(time.time() + 0.5)
+        messages = mailbox.iter_messages(uids)
+        next(messages)
+        time.sleep(0.5)
+        _expect_deadline(messages)
+        try:
+            mailbox.list_folders(max_age=0)
+            assert False, 'connection reused after a cut off FETCH'
+        except OperationTimeout:
+            pass
+
+        mailbox = MboxFolder(server.url, 'user', 'secret')
+        mailbox.select_folder('inbox')
+        mailbox.set_deadline(time.time() + 0.5)
+        chunks = mailbox.iter_message_chunks(uids[-1], 4096, chunk_size=512, read_ahead=8)
+        next(chunks)
+        time.sleep(0.5)
+        _expect_deadline(chunks)
+    finally:
+        server.stop()
+
+
+def test_parse_server():
+    assert parse_server('imap.mail.yahoo.com') == ('imap.mail.yahoo.com', 993, True)
+    assert parse_server('imap://127.0.0.1:1143') == ('127.0.0.1', 1143, False)
+    assert parse_server('imaps://mail.example.com') == ('mail.example.com', 993, True)
+
+
+def test_sequence_set():
+    assert MboxFolder.sequence_set(['1', '2', '3', '7']) == '1:3,7'
+    assert MboxFolder.sequence_set([9, 5, 6, 5]) == '5:6,9'
+    assert MboxFolder.sequence_set([]) == ''
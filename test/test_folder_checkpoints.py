@@ -0,0 +1,54 @@
+#! /usr/bin/python
+# Copyright (c) 2016, Kevin Rodgers
+# Released subject to the New BSD License
+# Please see http://en.wikipedia.org/wiki/BSD_licenses
+
+import time
+import logging
+from active_mail_filter import get_logger
+from active_mail_filter.folder_checkpoints import FolderCheckpoints, LAST_FULL
+
+logger = get_logger()
+logger.setLevel(logging.DEBUG)
+
+STATUS = {'UIDNEXT': 100, 'UIDVALIDITY': 7, 'HIGHESTMODSEQ': 50}
+
+
+def _checkpoints(fake_redis, full_sweep_interval=3600):
+    checkpoints = FolderCheckpoints('127.0.0.1', 'test', full_sweep_interval=full_sweep_interval)
+    checkpoints.redis = fake_redis
+    return checkpoints
+
+
+def test_needs_full_sweep(fake_redis):
+    checkpoints = _checkpoints(fake_redis)
+    targets = ['a', 'b']
+    assert checkpoints.needs_full_sweep(checkpoints.get_checkpoint('user', 'INBOX'), STATUS, targets) == \
+        'no checkpoint'
+
+    checkpoints.save_checkpoint('user', 'INBOX', STATUS, targets, full_sweep=True)
+    checkpoint = checkpoints.get_checkpoint('user', 'inbox')
+    assert checkpoints.needs_full_sweep(checkpoint, STATUS, targets) is None
+    assert checkpoints.needs_full_sweep(checkpoint, dict(STATUS, UIDVALIDITY=8), targets) == 'uidvalidity changed'
+    assert checkpoints.needs_full_sweep(checkpoint, STATUS, ['a']) == 'rules changed'
+    assert checkpoints.needs_full_sweep(dict(checkpoint, **{LAST_FULL: time.time() - 3600}), STATUS, targets) == \
+        'full sweep interval'
+
+    # an incremental pass moves the checkpoint but not the time of the last full sweep
+    checkpoints.save_checkpoint('user', 'inbox', dict(STATUS, UIDNEXT=120), targets)
+    assert checkpoints.get_checkpoint('user', 'inbox') == dict(checkpoint, uidnext=120)
+    always = _checkpoints(fake_redis, full_sweep_interval=0)
+    assert always.needs_full_sweep(checkpoint, STATUS, targets) == 'full sweep interval'
+
+
+def test_new_uid_range():
+    checkpoint = {'uidvalidity': 7, 'uidnext': 100, 'highestmodseq': 50}
+    assert FolderCheckpoints.new_uid_range(checkpoint, STATUS) is None
+    assert FolderCheckpoints.new_uid_range(checkpoint, dict(STATUS, UIDNEXT=103, HIGHESTMODSEQ=53)) == '100:102'
+
+    # flag changes and expunges raise HIGHESTMODSEQ without new mail
+    assert FolderCheckpoints.new_uid_range(checkpoint, dict(STATUS, HIGHESTMODSEQ=60)) is None
+
+    # without CONDSTORE only UIDNEXT is compared
+    assert FolderCheckpoints.new_uid_range(checkpoint, {'UIDNEXT': 100, 'UIDVALIDITY': 7}) is None
+    assert FolderCheckpoints.new_uid_range(checkpoint, {'UIDNEXT': 101, 'UIDVALIDITY': 7}) == '100:100'
@@ -0,0 +1,60 @@
+#! /usr/bin/python
+# Copyright (c) 2016, Kevin Rodgers
+# Released subject to the New BSD License
+# Please see http://en.wikipedia.org/wiki/BSD_licenses
+
+import smtplib
+import logging
+from fake_imap_server import FakeImapServer, make_message
+from fake_smtp_server import FakeSmtpServer, no_starttls
+from active_mail_filter import get_logger
+from active_mail_filter.mboxfolder import MboxFolder
+from active_mail_filter.imapuser import ImapUser
+
+logger = get_logger()
+logger.setLevel(logging.DEBUG)
+
+
+def _count_streamed(monkeypatch):
+    # uids read in pieces rather than whole
+    streamed = []
+    iter_message_chunks = MboxFolder.iter_message_chunks
+
+    def counted(mailbox, uid, size, **kwargs):
+        streamed.append(uid)
+        return iter_message_chunks(mailbox, uid, size, **kwargs)
+    monkeypatch.setattr(MboxFolder, 'iter_message_chunks', counted)
+    return streamed
+
+
+def test_forward_mail(monkeypatch):
+    monkeypatch.setattr(smtplib.SMTP, 'starttls', no_starttls)
+    streamed = _count_streamed(monkeypatch)
+    imap, smtp = FakeImapServer().start(), FakeSmtpServer().start()
+    try:
+        inbox = imap.add_account('user', 'secret').folder('inbox')
+        small = [inbox.add(make_message('"Sender %d" <sender%d@example.com>' % (n, n))) for n in range(0, 5)]
+        large = inbox.add(make_message('"Big" <big@example.com>', size=8192))
+        inbox.add(make_message('"Read" <read@example.com>'), flags=['\\Seen'])
+        user = ImapUser(MboxFolder(imap.url, 'user', 'secret'), None)
+
+        def forward():
+            return user.forward_mail('me@example.com', smtp.host, smtp_login='user', smtp_passwd='secret',
+                                     smtp_port=smtp.port, rate=0, stream_size=4096)
+
+        # the session dropped part way is reopened, every unseen message is flagged with one STORE
+        smtp.drop_after = 2
+        imap.reset_counts()
+        count, from_list = forward()
+        assert count == 6 and from_list[-1] == '"Big" <big@example.com>'
+        sent = [('sender%d@example.com' % n, small[n].raw) for n in range(0, 5)] + [('big@example.com', large.raw)]
+        assert sorted(smtp.messages) == sorted((sender, ['me@example.com'], raw) for sender, raw in sent)
+        assert streamed == [str(large.uid)] and smtp.sessions == 3
+        assert imap.commands['UID STORE'] == 1 and all('\\Seen' in m.flags for m in inbox.messages)
+
+        # nothing unseen is nothing sent
+        assert forward() == (0, []) and len(smtp.messages) == 6
+        user.mailbox.disconnect()
+    finally:
+        imap.stop()
+        smtp.stop()
@@ -0,0 +1,145 @@
+#! /usr/bin/python
+# Copyright (c) 2016, Kevin Rodgers
+# Released subject to the New BSD License
+# Please see http://en.wikipedia.org/wiki/BSD_licenses
+
+import time
+import logging
+import threading
+import gevent
+import redis
+from fake_imap_server import FakeImapServer
+from active_mail_filter import get_logger
+from active_mail_filter.cluster import ClusterMembership
+from active_mail_filter.green_engine import GreenEngine, GreenRedisConnection
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+
+logger = get_logger()
+logger.setLevel(logging.DEBUG)
+
+
+def _jobs(server, users, password='secret'):
+    return dict((user, [{'uuid': user + '-0', 'user': user, 'password': password, 'mail_server': server.url,
+                         'email': user + '@example.com', 'source': 'inbox', 'target': 'folder0'}])
+                for user in users)
+
+
+def test_green_engine():
+    server = FakeImapServer().start()
+    engine = GreenEngine(concurrency=10, max_per_server=2)
+    try:
+        accounts = [server.seed(user, 'secret', folders=1, messages=20, senders=2) for user in ['user0', 'user1']]
+        engine.run(_jobs(server, ['user0', 'user1']))
+        assert all(len(account.folder('inbox').messages) == 0 for account in accounts)
+        assert engine.mbox_pool.stats()[server.url] == {'open': 2, 'idle': 2, 'watching': 0}
+
+        # the next cycle reuses the pooled sessions
+        server.reset_counts()
+        engine.run(_jobs(server, ['user0', 'user1']))
+        assert server.commands.get('LOGIN', 0) == 0 and len(engine.failures) == 0
+    finally:
+        engine.close_all()
+        server.stop()
+
+
+def test_green_engine_stop():
+    # a user stuck on a slow server is killed soon after the daemon stops
+    server = FakeImapServer().start()
+    engine = GreenEngine()
+    try:
+        server.seed('user0', 'secret', folders=1, messages=20, senders=2)
+        server.hang_on = set(['FETCH'])
+        server.hang_seconds = 10
+        start = time.time()
+        engine.run(_jobs(server, ['user0']), is_stopped=lambda: time.time() - start > 0.2)
+        assert time.time() - start < 5
+        # the connection was cut off mid command and is not pooled
+        assert engine.mbox_pool.stats()[server.url]['open'] == 0
+
+        # a stopped daemon starts nobody
+        server.reset_counts()
+        engine.run(_jobs(server, ['user0']), is_stopped=lambda: True)
+        assert server.commands.get('LOGIN', 0) == 0
+    finally:
+        server.hang_on = set()
+        engine.close_all()
+        server.stop()
+
+
+def test_green_engine_backoff():
+    server = FakeImapServer().start()
+    engine = GreenEngine(backoff=60)
+    try:
+        server.seed('user0', 'secret', folders=1, messages=20, senders=2)
+        engine.run(_jobs(server, ['user0'], password='wrong'))
+        assert engine.failures['user0'][0] == 1
+
+        # skipped until the backoff runs out, then a success clears it
+        server.reset_counts()
+        engine.run(_jobs(server, ['user0']))
+        assert server.commands.get('LOGIN', 0) == 0
+        engine.failures['user0'] = (1, time.time())
+        engine.run(_jobs(server, ['user0']))
+        assert server.commands['LOGIN'] == 1 and 'user0' not in engine.failures
+    finally:
+        engine.close_all()
+        server.stop()
+
+
+def test_green_engine_lease(fake_redis):
+    server = FakeImapServer().start()
+    nodes = [ClusterMembership('127.0.0.1', 'test', node_id=name) for name in ['a', 'b']]
+    for node in nodes:
+        node.redis = fake_redis
+    engine = GreenEngine(lease=nodes[0])
+    try:
+        account = server.seed('user0', 'secret', folders=1, messages=20, senders=2)
+        assert nodes[1].acquire('user0', 60)
+        engine.run(_jobs(server, ['user0']))
+        assert server.commands.get('LOGIN', 0) == 0 and len(account.folder('inbox').messages) > 0
+
+        # once the other node lets go this node filters the user and gives the lease back
+        nodes[1].release('user0')
+        engine.run(_jobs(server, ['user0']))
+        assert len(account.folder('inbox').messages) == 0 and fake_redis.get(nodes[0]._lease_key('user0')) is None
+    finally:
+        engine.close_all()
+        server.stop()
+
+
+class _SlowPongHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if len(line) == 0:
+                break
+            if line.upper().startswith('PING'):
+                time.sleep(0.3)
+                self.wfile.write('+PONG\r\n')
+                self.wfile.flush()
+
+
+class _SlowRedis(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def test_green_redis_connection():
+    # five greenlets waiting on redis at once take about as long as one
+    server = _SlowRedis(('127.0.0.1', 0), _SlowPongHandler)
+    th = threading.Thread(target=server.serve_forever)
+    th.setDaemon(True)
+    th.start()
+    try:
+        client = redis.Redis(connection_pool=redis.ConnectionPool(host='127.0.0.1', port=server.server_address[1],
+                                                                  connection_class=GreenRedisConnection))
+        start = time.time()
+        greenlets = [gevent.spawn(client.ping) for i in range(0, 5)]
+        gevent.joinall(greenlets, timeout=5)
+        assert all(g.value is True for g in greenlets) and time.time() - start < 1.0
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,160 @@
+#! /usr/bin/python
+# Copyright (c) 2016, Kevin Rodgers
+# Released subject to the New BSD License
+# Please see http://en.wikipedia.org/wiki/BSD_licenses
+
+import time
+import socket
+import logging
+import threading
+from fake_imap_server import FakeImapServer, make_message
+from active_mail_filter import get_logger
+from active_mail_filter import idle_watcher
+from active_mail_filter.mbox_pool import MboxPool
+from active_mail_filter.mboxfolder import MboxFolder, SocketReader, DeadlineExceeded
+from active_mail_filter.stoppable_thread import StoppableThread
+
+logger = get_logger()
+logger.setLevel(logging.DEBUG)
+
+SENDER = '"Sender 0" <sender0.0@example.com>'
+
+
+def _rules(server):
+    return [{'uuid': 'rule-0', 'user': 'user', 'password': 'secret', 'mail_server': server.url,
+             'email': 'user@example.com', 'source': 'inbox', 'target': 'folder0'}]
+
+
+def _track_idle(monkeypatch):
+    # set while the watcher waits in IDLE, mail added before that is not new to it
+    idling = threading.Event()
+    idle = MboxFolder.idle
+
+    def tracked(mailbox, *args, **kwargs):
+        idling.set()
+        try:
+            return idle(mailbox, *args, **kwargs)
+        finally:
+            idling.clear()
+    monkeypatch.setattr(MboxFolder, 'idle', tracked)
+    return idling
+
+
+def _watch(server, pool):
+    assert pool.reserve_watcher(server.url, 'user')
+    th = StoppableThread(name='idle:user:inbox', target=idle_watcher.idle_worker,
+                         args=(_rules(server), None, pool))
+    th.setDaemon(True)
+    th.start()
+    return th
+
+
+def _wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.05)
+    return condition()
+
+
+def _stop_watchers():
+    for th in StoppableThread.enumerate():
+        if th.getName().startswith(idle_watcher.IDLE_PREFIX + ':'):
+            th.stop()
+            th.join(5)
+
+
+def test_watchers_and_sweeps(monkeypatch):
+    # watchers have slots of their own, a sweep still gets a connection while they idle
+    server = FakeImapServer().start()
+    pool = MboxPool(max_per_user=1, max_watchers_per_user=1)
+    try:
+        account = server.seed('user', 'secret', folders=2, messages=20, senders=1)
+        rules = _rules(server) + [dict(_rules(server)[0], uuid='rule-1', source='folder1')]
+        idling = _track_idle(monkeypatch)
+
+        # a folder left without a watcher slot stays on polling
+        assert [r['uuid'] for r in idle_watcher.sync_idle_watchers(rules, mbox_pool=pool)] == ['rule-0']
+        assert idling.wait(5) and pool.stats()[server.url] == {'open': 0, 'idle': 0, 'watching': 1}
+        with pool.connection(server.url, 'user', 'secret', deadline=time.time() + 1) as mailbox:
+            assert 'inbox' in mailbox.list_folders()
+        assert pool.stats()[server.url] == {'open': 1, 'idle': 1, 'watching': 1}
+
+        filed = len(account.folder('folder0').messages)
+        account.folder('folder1').add(make_message(SENDER, subject='idle'))
+        assert _wait_for(lambda: len(account.folder('folder0').messages) == filed + 1)
+
+        # a watcher stopped when its rule is removed gives its slot back to the next folder
+        th = StoppableThread.find_by_name('idle:user:folder1')
+        assert idle_watcher.sync_idle_watchers(rules[:1], mbox_pool=pool) == rules[:1]
+        th.join(5)
+        assert pool.stats()[server.url]['watching'] == 0
+        assert idle_watcher.sync_idle_watchers(rules[:1], mbox_pool=pool) == []
+        assert StoppableThread.find_by_name('idle:user:inbox').is_alive()
+    finally:
+        _stop_watchers()
+        pool.close_all()
+        server.stop()
+
+
+def test_mail_during_pass(monkeypatch):
+    # mail delivered while the watcher filters is not announced by the next IDLE
+    server = FakeImapServer().start()
+    pool = MboxPool()
+    try:
+        account = server.seed('user', 'secret', folders=1, messages=20, senders=1)
+        filter_rules = idle_watcher.filter_user_rules
+        ranges = []
+
+        def deliver_during_pass(mailbox, rule_records, **kwargs):
+            ranges.append(kwargs['uid_range'])
+            if len(ranges) == 1:
+                account.folder('inbox').add(make_message(SENDER, subject='during'))
+            return filter_rules(mailbox, rule_records, **kwargs)
+        monkeypatch.setattr(idle_watcher, 'filter_user_rules', deliver_during_pass)
+
+        idling = _track_idle(monkeypatch)
+        th = _watch(server, pool)
+        assert idling.wait(5)
+        filed = len(account.folder('folder0').messages)
+        uid = account.folder('inbox').uidnext
+        account.folder('inbox').add(make_message(SENDER, subject='before'))
+        assert _wait_for(lambda: len(account.folder('folder0').messages) == filed + 2)
+        assert ranges == ['%d:%d' % (uid, uid), '%d:%d' % (uid + 1, uid + 1)]
+        th.stop()
+        th.join(5)
+    finally:
+        pool.close_all()
+        server.stop()
+
+
+def test_socket_reader():
+    # a response read ahead with the IDLE continuation is pending though the socket is drained
+    client, server = socket.socketpair()
+    try:
+        reader = SocketReader(client, recv_size=16)
+        server.sendall('+ idling\r\n* 3 EXISTS\r\n')
+        assert reader.readline() == '+ idling\r\n' and reader.pending()
+        assert reader.readline() == '* 3 EXISTS\r\n' and not reader.pending()
+
+        server.sendall('x' * 40 + '\r\n')
+        assert reader.readline(4) == 'xxxx' and reader.read(30) == 'x' * 30 and reader.readline() == 'x' * 6 + '\r\n'
+        server.close()
+        assert reader.readline() == '' and reader.read(10) == ''
+    finally:
+        client.close()
+
+
+def test_idle_reports_mail_at_once():
+    # mail that arrived before IDLE is announced with the continuation and returned without waiting
+    server = FakeImapServer().start()
+    try:
+        account = server.seed('user', 'secret', folders=1, messages=20, senders=1)
+        mailbox = MboxFolder(server.url, 'user', 'secret')
+        mailbox.list_email_uids('inbox')
+        account.folder('inbox').add(make_message(SENDER, subject='before'))
+        start = time.time()
+        assert mailbox.idle(timeout=5) == ['%d EXISTS' % len(account.folder('inbox').messages)]
+        assert time.time() - start < 1.0
+        mailbox.disconnect()
+    finally:
+        server.stop()
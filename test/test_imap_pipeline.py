@@ -0,0 +1,107 @@
+#! /usr/bin/python
+# Copyright (c) 2016, Kevin Rodgers
+# Released subject to the New BSD License
+# Please see http://en.wikipedia.org/wiki/BSD_licenses
+
+import logging
+import imaplib
+from fake_imap_server import FakeImapServer
+from active_mail_filter import get_logger
+from active_mail_filter.mboxfolder import MboxFolder
+from active_mail_filter.imap_pipeline import ImapPipeline
+
+logger = get_logger()
+logger.setLevel(logging.DEBUG)
+
+
+class _ScriptedIMAP4(imaplib.IMAP4):
+    # imaplib over an in-memory script, the replies to a command are queued as it is sent
+    REPLIES = {'CAPABILITY': ['* CAPABILITY IMAP4rev1'],
+               'STATUS "inbox" (MESSAGES)': ['* STATUS "INBOX" (MESSAGES 3)'],
+               'STATUS missing (MESSAGES)': None,
+               'SELECT folder0': ['* 2 EXISTS', '* OK [UIDVALIDITY 1] UIDs valid'],
+               'UID SEARCH ALL': ['* SEARCH 1 2']}
+
+    def __init__(self):
+        self.events = []
+        self.incoming = ''
+        imaplib.IMAP4.__init__(self)
+        self.state = 'AUTH'
+
+    def open(self, host='', port=imaplib.IMAP4_PORT):
+        self.incoming = '* OK ready\r\n'
+
+    def shutdown(self):
+        pass
+
+    def send(self, data):
+        tag, command = data.rstrip().split(' ', 1)
+        self.events.append(command)
+        replies = self.REPLIES[command]
+        if replies is None:
+            self.incoming += '%s NO no such mailbox\r\n' % tag
+        else:
+            self.incoming += ''.join(line + '\r\n' for line in replies) + '%s OK done\r\n' % tag
+
+    def readline(self):
+        line, self.incoming = self.incoming.split('\n', 1)
+        if len(self.events) == 0 or self.events[-1] != 'read':
+            self.events.append('read')
+        return line + '\n'
+
+    def read(self, size):
+        data, self.incoming = self.incoming[:size], self.incoming[size:]
+        return data
+
+
+def test_pipeline():
+    imap = _ScriptedIMAP4()
+    del imap.events[:]
+    pipe = ImapPipeline(imap)
+    assert pipe.status('"inbox"', 'MESSAGES') == 0
+    pipe.status('missing', 'MESSAGES')
+    pipe.select('folder0')
+    pipe.uid('SEARCH', 'ALL')
+    assert len(pipe) == 4
+    results = pipe.execute()
+
+    # every command is sent before the first reply is read
+    assert imap.events == ['STATUS "inbox" (MESSAGES)', 'STATUS missing (MESSAGES)', 'SELECT folder0',
+                           'UID SEARCH ALL', 'read'] and len(pipe) == 0
+
+    # replies come back in the order the commands were queued, a failure only affects its own
+    assert results == [('OK', ['"INBOX" (MESSAGES 3)']), ('NO', ['no such mailbox']), ('OK', ['2']),
+                       ('OK', ['1 2'])]
+    assert imap.state == 'SELECTED'
+
+
+def test_pipeline_round_trips():
+    # the latency holds the server on the first command until the others have been sent
+    server = FakeImapServer(latency=0.05).start()
+    try:
+        account = server.seed('user', 'secret', folders=1, messages=20, senders=2)
+        mailbox = MboxFolder(server.url, 'user', 'secret')
+        server.reset_counts()
+
+        pipe = mailbox.pipeline()
+        assert pipe.status('inbox', 'MESSAGES') == 0
+        pipe.status('missing', 'MESSAGES')
+        pipe.select('folder0')
+        pipe.uid('SEARCH', 'ALL')
+        assert len(pipe) == 4
+        results = pipe.execute()
+        assert server.round_trips() == 1 and len(pipe) == 0
+
+        # replies come back in the order the commands were queued, a failure only affects its own
+        assert [result for result, data in results] == ['OK', 'NO', 'OK', 'OK']
+        assert results[0][1] == ['"INBOX" (MESSAGES %d)' % len(account.folder('inbox').messages)]
+        assert results[2][1] == [str(len(account.folder('folder0').messages))]
+        assert results[3][1][0].split() == [str(m.uid) for m in account.folder('folder0').messages]
+        assert mailbox.imap.state == 'SELECTED'
+
+        # a folder that can not be selected leaves nothing selected, as imaplib does
+        pipe.select('missing')
+        assert pipe.execute()[0][0] == 'NO' and mailbox.imap.state == 'AUTH'
+        mailbox.disconnect()
+    finally:
+        server.stop()
@@ -0,0 +1,99 @@
+#! /usr/bin/python
+# Copyright (c) 2016, Kevin Rodgers
+# Released subject to the New BSD License
+# Please see http://en.wikipedia.org/wiki/BSD_licenses
+
+import logging
+from active_mail_filter import get_logger
+from active_mail_filter import metrics
+from active_mail_filter.metrics import Registry, Counter, Gauge, Histogram
+
+logger = get_logger()
+logger.setLevel(logging.DEBUG)
+
+
+def _registry():
+    registry = Registry()
+    moved = registry.register(Counter('test_moved_total', 'Messages moved', labels=('folder',)))
+    queued = registry.register(Gauge('test_queued', 'Jobs waiting'))
+    seconds = registry.register(Histogram('test_seconds', 'Time per pass', buckets=(0.1, 1.0)))
+    return registry, moved, queued, seconds
+
+
+def test_render():
+    registry, moved, queued, seconds = _registry()
+    moved.inc(folder='a "quoted"\nname')
+    moved.inc(2, folder='b')
+    queued.set(1.5)
+    seconds.observe(0.05)
+    seconds.observe(0.5)
+    registry.register_collector('pool', lambda: [Gauge('test_pool_open', 'Open connections')])
+    registry.register_collector('broken', lambda: 1 / 0)
+
+    assert registry.render().split('\n') == [
+        '# HELP amf_test_moved_total Messages moved',
+        '# TYPE amf_test_moved_total counter',
+        'amf_test_moved_total{folder="a \\"quoted\\"\\nname"} 1',
+        'amf_test_moved_total{folder="b"} 2',
+        '# HELP amf_test_queued Jobs waiting',
+        '# TYPE amf_test_queued gauge',
+        'amf_test_queued 1.5',
+        '# HELP amf_test_seconds Time per pass',
+        '# TYPE amf_test_seconds histogram',
+        'amf_test_seconds_bucket{le="0.1"} 1',
+        'amf_test_seconds_bucket{le="1"} 2',
+        'amf_test_seconds_bucket{le="+Inf"} 2',
+        'amf_test_seconds_sum 0.55',
+        'amf_test_seconds_count 2',
+        '# HELP amf_test_pool_open Open connections',
+        '# TYPE amf_test_pool_open gauge',
+        'amf_test_pool_open 0',
+        '']
+
+
+def test_register(monkeypatch):
+    registry, moved, queued, seconds = _registry()
+    # registering a name again returns the metric already there
+    assert registry.register(Counter('test_moved_total', 'Messages moved', labels=('folder',))) is moved
+    try:
+        registry.register(Gauge('test_moved_total', 'Messages moved'))
+        assert False, 'registered a gauge over a counter'
+    except ValueError:
+        pass
+    try:
+        moved.inc(user='user')
+        assert False, 'wrong labels accepted'
+    except ValueError:
+        pass
+
+    # label sets past the limit are dropped rather than grow without bound
+    monkeypatch.setattr(metrics, 'MAX_CHILDREN', 2)
+    for folder in ['a', 'b', 'c']:
+        moved.inc(folder=folder)
+    assert moved.value(folder='b') == 1 and moved.value(folder='c') == 0
+
+
+def test_drain_merge():
+    # a worker process hands over what changed, counts as increments and gauges as values
+    worker, moved, queued, seconds = _registry()
+    supervisor, total, current, timing = _registry()
+    total.inc(5, folder='a')
+    moved.inc(folder='a')
+    moved.inc(2, folder='b')
+    queued.set(3)
+    seconds.observe(0.5)
+
+    supervisor.merge(worker.drain())
+    assert total.value(folder='a') == 6 and total.value(folder='b') == 2
+    assert current.value() == 3 and timing.value() == (1, 0.5)
+    assert moved.value(folder='a') == 0 and queued.value() == 3
+
+    # nothing changed is nothing handed over, a value set again is
+    assert worker.drain() == {}
+    moved.inc(folder='a')
+    queued.set(3)
+    assert worker.drain() == {'amf_test_moved_total': {('a',): 1}, 'amf_test_queued': {(): 3}}
+
+    # a metric only the worker registered is dropped
+    supervisor.merge({'amf_test_unknown': {(): 1}})
+    assert 'amf_test_unknown' not in supervisor.render()
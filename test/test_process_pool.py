@@ -0,0 +1,65 @@
+#! /usr/bin/python
+# Copyright (c) 2016, Kevin Rodgers
+# Released subject to the New BSD License
+# Please see http://en.wikipedia.org/wiki/BSD_licenses
+
+import os
+import time
+import signal
+import logging
+from active_mail_filter import get_logger
+from active_mail_filter.metrics import counter
+from active_mail_filter.process_pool import ProcessPool, partition
+from active_mail_filter.worker_pool import WorkerJob
+
+logger = get_logger()
+logger.setLevel(logging.DEBUG)
+
+TEST_RULES = counter('test_process_rules_total', 'Rules run by the process pool test')
+
+
+def _filter(records):
+    # stands in for worker_thread, the pid shows which process ran the user
+    if records[0]['user'] == 'failing':
+        raise ValueError('bad rules')
+    TEST_RULES.inc(len(records))
+    return os.getpid()
+
+
+def _run(pool, names):
+    done = {}
+    jobs = [WorkerJob(name, 'imap.example.com', [{'user': name}] * 2, on_done=lambda job: done.update({job.name: job}))
+            for name in names]
+    pool.submit(jobs)
+    pool.wait(hung_timeout=30)
+    return done
+
+
+def test_process_pool():
+    names = ['user%d' % i for i in range(0, 20)]
+    pool = ProcessPool(_filter, processes=2, max_workers=4)
+    try:
+        done = _run(pool, names + ['failing'])
+        assert done['failing'].failed and 'bad rules' in done['failing'].error
+        pids = dict((name, done[name].result) for name in names)
+        assert os.getpid() not in pids.values() and len(set(pids.values())) == 2
+
+        # each user stays on its process and the counts come back to this one
+        assert all(pids[name] == pids[other] for name in names for other in names
+                   if partition(name, 2) == partition(other, 2))
+        assert TEST_RULES.value() == 2 * len(names)
+
+        # a process that dies is started again for its users
+        os.kill(pids['user0'], signal.SIGKILL)
+        killed = pool.processes[partition('user0', 2)].process
+        while killed.is_alive():
+            time.sleep(0.01)
+        done = _run(pool, names)
+        assert all(not job.failed for job in done.values())
+        assert pids['user0'] not in [job.result for job in done.values()]
+        stats = pool.stats()
+        assert sum(p['restarts'] for p in stats['processes'].values()) == 1
+        assert TEST_RULES.value() == 4 * len(names)
+    finally:
+        pool.stop()
+    assert not any(p['alive'] for p in pool.stats()['processes'].values())
@@ -0,0 +1,59 @@
+#! /usr/bin/python
+# Copyright (c) 2016, Kevin Rodgers
+# Released subject to the New BSD License
+# Please see http://en.wikipedia.org/wiki/BSD_licenses
+
+import logging
+import fakeredis
+from active_mail_filter import get_logger
+from active_mail_filter import simple_db
+from active_mail_filter.rule_cache import RuleCache
+from active_mail_filter.user_records import UserRecords, UUID, PASSWORD, TARGET
+
+logger = get_logger()
+logger.setLevel(logging.DEBUG)
+
+
+def _userdb(monkeypatch, redis_server):
+    # UserRecords opens its own connection, every one it opens goes to the in-memory server
+    monkeypatch.setattr(simple_db.redis, 'Redis',
+                        lambda connection_pool=None: fakeredis.FakeStrictRedis(server=redis_server))
+    return UserRecords('127.0.0.1', key='test')
+
+
+def _count_reads(userdb):
+    # uuids each refresh read back and decrypted
+    reads = []
+    get_users_by_uuid = userdb.get_users_by_uuid
+
+    def counted(uuids):
+        reads.append(sorted(uuids))
+        return get_users_by_uuid(uuids)
+    userdb.get_users_by_uuid = counted
+    return reads
+
+
+def test_rule_cache(monkeypatch, redis_server):
+    userdb = _userdb(monkeypatch, redis_server)
+    first = userdb.add_user('user', 'user@example.com', 'secret', 'imap.example.com', 'inbox', 'a')
+    second = userdb.add_user('user', 'user@example.com', 'secret', 'imap.example.com', 'inbox', 'b')
+    cache = RuleCache(userdb)
+    reads = _count_reads(userdb)
+
+    assert sorted(r[TARGET] for r in cache.get_all_users()) == ['a', 'b']
+    assert all(r[PASSWORD] == 'secret' for r in cache.get_all_users())
+    assert not cache.refresh() and reads == [sorted([first, second])]
+
+    # only the record whose revision changed is read again, a deleted one is dropped
+    record = cache.get_user_by_uuid(first)
+    record[TARGET] = 'c'
+    userdb.update_user(first, record)
+    assert cache.get_user_by_uuid(first)[TARGET] == 'c' and reads[-1] == [first]
+    userdb.del_record(second)
+    assert [r[UUID] for r in cache.get_all_users()] == [first] and reads[-1] == []
+
+    # callers get copies, changing one does not change the cache
+    cache.get_user_by_uuid(first)[TARGET] = 'd'
+    assert cache.get_user_by_uuid(first)[TARGET] == 'c'
+    cache.invalidate()
+    assert cache.refresh() and reads[-1] == [first]
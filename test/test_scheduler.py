@@ -0,0 +1,83 @@
+#! /usr/bin/python
+# Copyright (c) 2016, Kevin Rodgers
+# Released subject to the New BSD License
+# Please see http://en.wikipedia.org/wiki/BSD_licenses
+
+import time
+import logging
+from active_mail_filter import get_logger
+from active_mail_filter.scheduler import UserScheduler
+from active_mail_filter.worker_pool import WorkerPool, WorkerJob
+
+logger = get_logger()
+logger.setLevel(logging.DEBUG)
+
+
+def _users(count, server='imap.example.com'):
+    return dict(('user%d' % i, [{'user': 'user%d' % i, 'mail_server': server}]) for i in range(0, count))
+
+
+def test_provider_rate():
+    # first starts are spread over the interval, the provider rate spaces them further
+    scheduler = UserScheduler(interval=0.01, min_interval=0.01, provider_rate=20)
+    scheduler.sync(_users(5))
+    started = []
+    deadline = time.time() + 2
+    while len(started) < 5 and time.time() < deadline:
+        started.extend(time.time() for u in scheduler.due())
+        time.sleep(0.005)
+    assert len(started) == 5
+    assert started[-1] - started[0] >= 4 * 0.05 * 0.9
+
+
+def test_adaptive_interval():
+    scheduler = UserScheduler(interval=0.01, min_interval=0.01, max_interval=10, jitter=0, provider_rate=0)
+    scheduler.sync(_users(2))
+    time.sleep(0.02)
+    due = scheduler.due()
+    assert sorted(u.name for u in due) == ['user0', 'user1']
+    assert scheduler.due() == []
+
+    # a run that moved mail keeps the shortest interval, a quiet one lengthens it
+    scheduler.completed('user0', moved=3)
+    scheduler.completed('user1', moved=0)
+    assert scheduler.users['user0'].interval == 0.01
+    assert scheduler.users['user1'].interval > 0.01
+
+    # a removed user is dropped, a failed run waits for its retry time
+    scheduler.sync(_users(1))
+    assert 'user1' not in scheduler.users
+    time.sleep(0.02)
+    retry_at = time.time() + 60
+    for user in scheduler.due():
+        scheduler.completed(user.name, retry_at=retry_at)
+    assert scheduler.users['user0'].next_run == retry_at
+
+
+def test_stop_start():
+    # jobs dropped by a stop are due again, none is left marked running until stale_timeout
+    scheduler = UserScheduler(interval=0.01, min_interval=0.01, max_interval=10, jitter=0, provider_rate=0)
+    scheduler.sync(_users(10))
+    time.sleep(0.02)
+
+    cancelled = []
+
+    def on_done(job):
+        if job.cancelled:
+            cancelled.append(job.name)
+            scheduler.cancelled(job.name)
+        else:
+            scheduler.completed(job.name, moved=job.result)
+
+    pool = WorkerPool(lambda records: time.sleep(0.2) or 1, max_workers=2)
+    due = scheduler.due()
+    assert len(due) == 10
+    pool.submit([WorkerJob(u.name, u.server, u.records, on_done=on_done) for u in due])
+    time.sleep(0.05)
+    pool.stop()
+    for th in pool.workers:
+        th.join(2)
+    assert len(cancelled) == 8
+    assert scheduler.stats()['running'] == 0
+    time.sleep(0.05)
+    assert len(scheduler.due()) == 10
@@ -0,0 +1,45 @@
+#! /usr/bin/python
+# Copyright (c) 2016, Kevin Rodgers
+# Released subject to the New BSD License
+# Please see http://en.wikipedia.org/wiki/BSD_licenses
+
+import logging
+from active_mail_filter import get_logger
+from active_mail_filter.sender_address import LruCache, parse_from, canonical_address, address_cache_stats
+
+logger = get_logger()
+logger.setLevel(logging.DEBUG)
+
+
+def test_canonical_address():
+    assert canonical_address('"Some Name" <Some.Name@Example.COM>') == 'some.name@example.com'
+    assert canonical_address('some.name@example.com (Some Name)') == 'some.name@example.com'
+    assert canonical_address('=?utf-8?q?Caf=C3=A9?= <cafe@example.com>') == 'cafe@example.com'
+    assert canonical_address('=?utf-8?q?cafe=40example=2Ecom?=') == 'cafe@example.com'
+    # no addr-spec, the first word stands in as older releases did
+    assert canonical_address('"postmaster" localhost') == 'postmaster'
+    assert canonical_address('') == ''
+
+
+def test_plus_tags():
+    assert parse_from('"Name" <user+news@Example.com>') == ('user+news@Example.com', 'user@example.com')
+    assert canonical_address('user+a+b@example.com') == 'user@example.com'
+    # a leading plus is part of the local part, not a tag
+    assert canonical_address('+user@example.com') == '+user@example.com'
+    assert canonical_address('<user+tag@example.com>') == canonical_address('User <user@example.com>')
+
+
+def test_parse_cache():
+    before = address_cache_stats()
+    parse_from('"Cached" <cached+once@example.com>')
+    parse_from('"Cached" <cached+once@example.com>')
+    after = address_cache_stats()
+    assert after['hits'] - before['hits'] >= 1 and after['misses'] - before['misses'] >= 1
+
+    cache = LruCache(maxsize=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert cache.get('b') is None and cache.get('a') == 1 and cache.get('c') == 3
+    assert cache.stats() == {'size': 2, 'hits': 3, 'misses': 1}
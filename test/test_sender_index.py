@@ -0,0 +1,80 @@
+#! /usr/bin/python
+# Copyright (c) 2016, Kevin Rodgers
+# Released subject to the New BSD License
+# Please see http://en.wikipedia.org/wiki/BSD_licenses
+
+import re
+import logging
+from active_mail_filter import get_logger
+from active_mail_filter.sender_index import SenderIndex
+
+logger = get_logger()
+logger.setLevel(logging.DEBUG)
+
+SENDERS = ['"Sender %d" <sender%d@example.com>' % (s, s) for s in range(0, 4)]
+
+
+class _Folder(object):
+    # the part of MboxFolder the index uses, over one folder held in memory
+    def __init__(self):
+        self.host = 'imap.example.com'
+        self.username = 'user'
+        self.uidvalidity = 1
+        self.uidnext = 1
+        self.messages = {}
+        self.fetched = []
+
+    def add(self, sender):
+        self.messages[self.uidnext] = sender
+        self.uidnext += 1
+
+    def folder_status(self, folder_name, items):
+        return {'MESSAGES': len(self.messages), 'UIDNEXT': self.uidnext, 'UIDVALIDITY': self.uidvalidity}
+
+    def list_email_uids(self, folder_name, pattern):
+        first, last = re.match(r'\(UID (\d+):(\d+|\*)\)', pattern).groups()
+        uids = [uid for uid in sorted(self.messages.keys()) if int(first) <= uid and (last == '*' or uid <= int(last))]
+        # as on a server n:* also matches the highest uid when it is below n
+        if last == '*' and len(uids) == 0:
+            uids = sorted(self.messages.keys())[-1:]
+        return [str(uid) for uid in uids]
+
+    def fetch_from_addresses(self, uids):
+        self.fetched.append(list(uids))
+        return set(self.messages[int(uid)].lower() for uid in uids)
+
+
+def test_sender_index(fake_redis):
+    index = SenderIndex('127.0.0.1', 'test')
+    index.redis = fake_redis
+    folder = _Folder()
+    for sender in SENDERS * 5:
+        folder.add(sender)
+
+    assert sorted(index.get_from_addresses(folder, 'folder0')) == sorted(s.lower() for s in SENDERS)
+    assert len(folder.fetched) == 1 and len(folder.fetched[0]) == 20
+    assert index.get_state('imap.example.com', 'user', 'folder0') == (1, 20)
+
+    # nothing new is nothing fetched, new mail fetches only its own headers
+    assert index.update(folder, 'folder0') == set() and len(folder.fetched) == 1
+    folder.add('"New" <New@Example.com>')
+    assert index.update(folder, 'folder0') == set(['"new" <new@example.com>'])
+    assert folder.fetched[-1] == ['21']
+    folder.add(SENDERS[0])
+    assert len(index.get_from_addresses(folder, 'folder0')) == 5 and folder.fetched[-1] == ['22']
+
+    # a new UIDVALIDITY means the uids were reassigned, the index is rebuilt
+    folder.messages = {1: SENDERS[1], 2: SENDERS[2]}
+    folder.uidvalidity, folder.uidnext = 2, 3
+    assert sorted(index.get_from_addresses(folder, 'folder0')) == sorted(s.lower() for s in SENDERS[1:3])
+    assert folder.fetched[-1] == ['1', '2'] and index.get_state('imap.example.com', 'user', 'folder0') == (2, 2)
+
+    # mail removed from the folder is noticed by its count, senders no longer filed there are dropped
+    folder.add(SENDERS[3])
+    del folder.messages[1]
+    assert index.update(folder, 'folder0') == set(['"sender 3" <sender3@example.com>'])
+    assert sorted(index.get_senders('imap.example.com', 'user', 'folder0')) == [s.lower() for s in SENDERS[2:4]]
+    assert folder.fetched[-1] == ['2', '3']
+
+    # the same login on another server is another account
+    assert index.get_senders('imap.other.com', 'user', 'folder0') == []
@@ -0,0 +1,68 @@
+#! /usr/bin/python
+# Copyright (c) 2016, Kevin Rodgers
+# Released subject to the New BSD License
+# Please see http://en.wikipedia.org/wiki/BSD_licenses
+
+import json
+import logging
+from active_mail_filter import get_logger
+from active_mail_filter.simple_db import SimpleRedisDb, UUID
+
+logger = get_logger()
+logger.setLevel(logging.DEBUG)
+
+
+def _db(fake_redis):
+    db = SimpleRedisDb('127.0.0.1', 'test', index_fields=['user'], unique_fields=['user', 'source', 'target'])
+    db.redis = fake_redis
+    return db
+
+
+def _rule(user, target):
+    return {'user': user, 'source': 'inbox', 'target': target}
+
+
+def _raises_duplicate(call, *args):
+    try:
+        call(*args)
+    except ValueError:
+        return True
+    return False
+
+
+def test_unique_on_update(fake_redis):
+    db = _db(fake_redis)
+    first = db.add_record(_rule('user', 'a'))
+    second = db.add_record(_rule('user', 'b'))
+    assert _raises_duplicate(db.add_record, _rule('user', 'a'))
+
+    # an update may not turn a rule into a copy of another and leaves both as they were
+    assert _raises_duplicate(db.update_record, second, _rule('user', 'a'))
+    assert db.get_record(second)['target'] == 'b'
+    db.delete_record(second)
+    assert _raises_duplicate(db.add_record, _rule('user', 'a'))
+
+    # a rule keeps its own values across an update and frees the old ones when they change
+    db.update_record(first, _rule('user', 'a'))
+    db.update_record(first, _rule('user', 'c'))
+    assert db.add_record(_rule('user', 'a')) is not None
+    assert _raises_duplicate(db.add_record, _rule('user', 'c'))
+    assert sorted(r['target'] for r in db.get_records_by_index('user', 'user')) == ['a', 'c']
+    assert db.get_record(first)[UUID] == first
+
+
+def test_migrate_records(fake_redis):
+    # records written by older releases as unicode(dict) without their UUID or indexes
+    db = _db(fake_redis)
+    for key, target in [('key-a', 'a'), ('key-b', 'b')]:
+        db.redis.hset('test', key, unicode({u'user': u'user', u'source': u'inbox', u'target': unicode(target)}))
+
+    assert db.migrate_records() == 2
+    assert json.loads(db.redis.hget('test', 'key-a')) == dict(_rule('user', 'a'), uuid='key-a')
+    assert sorted(r[UUID] for r in db.get_records_by_index('user', 'user')) == ['key-a', 'key-b']
+    assert db.get_revisions() == {'key-a': 1, 'key-b': 1}
+    assert _raises_duplicate(db.add_record, _rule('user', 'b'))
+
+    # a converted hash set is left alone
+    version = db.get_version()
+    assert db.migrate_records() == 0 and db.get_version() == version
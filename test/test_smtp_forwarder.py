@@ -0,0 +1,123 @@
+#! /usr/bin/python
+# Copyright (c) 2016, Kevin Rodgers
+# Released subject to the New BSD License
+# Please see http://en.wikipedia.org/wiki/BSD_licenses
+
+import time
+import smtplib
+import logging
+from fake_smtp_server import FakeSmtpServer, no_starttls
+from active_mail_filter import get_logger
+from active_mail_filter.smtp_forwarder import SmtpForwarder, DotStuffer, CRLF
+
+logger = get_logger()
+logger.setLevel(logging.DEBUG)
+
+
+def _message(n):
+    return 'From: sender%d@example.com\r\nSubject: test %d\r\n\r\nhello\r\n.hidden\r\n' % (n, n)
+
+
+def _start(monkeypatch):
+    monkeypatch.setattr(smtplib.SMTP, 'starttls', no_starttls)
+    return FakeSmtpServer().start()
+
+
+def test_send_reconnect(monkeypatch):
+    server = _start(monkeypatch)
+    try:
+        # the server closes its session after every second message, the forwarder opens another
+        server.drop_after = 2
+        with SmtpForwarder(server.host, port=server.port, login='user', password='secret', rate=0) as smtp:
+            for n in range(0, 5):
+                smtp.send('sender%d@example.com' % n, 'to@example.com', _message(n))
+            assert smtp.sent == 5
+        assert server.messages == [('sender%d@example.com' % n, ['to@example.com'], _message(n))
+                                   for n in range(0, 5)]
+        assert server.sessions == 3 and server.commands['AUTH'] == 3 and server.commands['QUIT'] == 1
+
+        try:
+            SmtpForwarder(server.host, port=server.port, login='user', password='wrong', rate=0).open()
+            assert False, 'logged in with the wrong password'
+        except smtplib.SMTPAuthenticationError:
+            pass
+    finally:
+        server.stop()
+
+
+def test_rate_limit(monkeypatch):
+    server = _start(monkeypatch)
+    try:
+        with SmtpForwarder(server.host, port=server.port, login='user', password='secret', rate=20) as smtp:
+            start = time.time()
+            for n in range(0, 5):
+                smtp.send('sender@example.com', 'to@example.com', _message(n))
+            # the first message goes at once, each later one waits its turn
+            assert time.time() - start >= 4 / 20.0
+        assert len(server.messages) == 5 and server.sessions == 1
+    finally:
+        server.stop()
+
+
+def _feed(pieces):
+    stuffer = DotStuffer()
+    return ''.join(stuffer.feed(piece) for piece in pieces) + stuffer.close()
+
+
+def _quoted(message):
+    # what smtplib sends for the whole message, without the terminating dot
+    data = smtplib.quotedata(message)
+    return data if data.endswith(CRLF) else data + CRLF
+
+
+def test_dot_stuffer():
+    assert _feed(['a\r', '\n.b']) == 'a\r\n..b\r\n'
+    assert _feed(['a\r\n', '.b\r\n']) == 'a\r\n..b\r\n'
+    assert _feed(['a\nb', '\n']) == 'a\r\nb\r\n'
+    assert _feed(['a']) == _feed(['a\r']) == _feed(['a\r\n']) == _feed(['a', '\r', '\n']) == 'a\r\n'
+
+    # the same as the whole message however it is cut up
+    for message in ['line\r\n.dot\r\n', '.first\r\nbare\nlf\n.x', 'cr\rend\r', '\r\n.\r\n..\n', _message(0)]:
+        for i in range(0, len(message) + 1):
+            for j in range(i, len(message) + 1):
+                assert _feed([message[:i], message[i:j], message[j:]]) == _quoted(message)
+
+
+def _pieces(message, size, fail_after=None):
+    for n, i in enumerate(range(0, len(message), size)):
+        if n == fail_after:
+            raise LookupError('partial fetch failed')
+        yield message[i:i + size]
+
+
+def test_send_stream(monkeypatch):
+    server = _start(monkeypatch)
+    try:
+        message = _message(0) * 50
+        with SmtpForwarder(server.host, port=server.port, login='user', password='secret', rate=0) as smtp:
+            smtp.send_stream('sender@example.com', 'to@example.com', _pieces(message, 7))
+            assert server.messages == [('sender@example.com', ['to@example.com'], message)]
+
+            # a message cut off part way is never delivered, the session is dropped with it
+            try:
+                smtp.send_stream('sender@example.com', 'to@example.com', _pieces(message, 7, fail_after=3))
+                assert False, 'a failed piece was not raised'
+            except LookupError:
+                pass
+            smtp.send_stream('sender@example.com', 'to@example.com', _pieces(message, 64))
+            assert len(server.messages) == 2 and server.sessions == 2
+
+            server.refuse_data = 554
+            try:
+                smtp.send_stream('sender@example.com', 'to@example.com', _pieces(message, 7))
+                assert False, 'refused DATA was not raised'
+            except smtplib.SMTPDataError:
+                pass
+
+            # the refused envelope was reset, the session takes the next message
+            server.refuse_data = 0
+            smtp.send_stream('sender@example.com', 'to@example.com', _pieces(message, 64))
+            assert server.commands['RSET'] == 1 and server.sessions == 2
+        assert len(server.messages) == 3
+    finally:
+        server.stop()
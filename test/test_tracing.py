@@ -0,0 +1,82 @@
+#! /usr/bin/python
+# Copyright (c) 2016, Kevin Rodgers
+# Released subject to the New BSD License
+# Please see http://en.wikipedia.org/wiki/BSD_licenses
+
+import time
+import logging
+import gevent
+from active_mail_filter import get_logger
+from active_mail_filter.tracing import span, traced, add_time, SlowRuleTable, CycleProfiler, SLOW_RULES, RULE_SPAN
+
+logger = get_logger()
+logger.setLevel(logging.DEBUG)
+
+
+def _rule(user, seconds):
+    with span(RULE_SPAN, user=user, source='inbox'):
+        with span('search'):
+            gevent.sleep(seconds)
+        add_time('fetch', seconds)
+
+
+def test_spans_per_greenlet():
+    # greenlets sharing a thread each credit stages to their own rule
+    SLOW_RULES.clear()
+    gevent.joinall([gevent.spawn(_rule, 'slow', 0.2), gevent.spawn(_rule, 'fast', 0.05)])
+    rules = dict((r['user'], r) for r in SLOW_RULES.top())
+    assert rules['slow']['stages']['fetch'] == 0.2 and rules['fast']['stages']['fetch'] == 0.05
+    assert 0.2 <= rules['slow']['stages']['search'] < 0.3
+    assert 0.05 <= rules['fast']['stages']['search'] < 0.15
+    assert [r['user'] for r in SLOW_RULES.top()] == ['slow', 'fast']
+
+
+def test_slow_rule_table():
+    table = SlowRuleTable(size=2, max_age=0.1)
+    for user, seconds in [('a', 1.0), ('b', 3.0), ('c', 2.0), ('a', 4.0)]:
+        table.record({'user': user}, seconds, {})
+    assert [(r['user'], r['seconds']) for r in table.top()] == [('a', 4.0), ('b', 3.0)]
+
+    # entries handed to another table keep their order there and old ones expire
+    other = SlowRuleTable(size=2)
+    other.merge(table.drain())
+    assert table.top() == [] and [r['user'] for r in other.top(3)] == ['a', 'b', 'c']
+    table.record({'user': 'd'}, 1.0, {})
+    time.sleep(0.15)
+    assert table.top() == []
+
+
+@traced('parse')
+def _parse(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+def test_traced_stages():
+    # outside a span a traced function just runs, inside one its time goes to its stage
+    SLOW_RULES.clear()
+    assert _parse(0.01) == 0.01 and SLOW_RULES.top() == []
+    with span(RULE_SPAN, user='user', source='inbox'):
+        _parse(0.05)
+        _parse(0.05)
+    stages = SLOW_RULES.top()[0]['stages']
+    assert sorted(stages.keys()) == ['parse'] and 0.1 <= stages['parse'] < 0.2
+
+
+def test_cycle_profiler():
+    profiler = CycleProfiler()
+    assert profiler.profile_call(_parse, 0) == 0 and profiler.report() is None
+
+    # only an armed cycle is profiled and its report is ready once the cycle ends
+    profiler.arm()
+    profiler.begin_cycle()
+    assert profiler.active and not profiler.armed
+    assert profiler.profile_call(_parse, 0.01) == 0.01
+    assert profiler.report() is None
+    profiler.end_cycle()
+    assert '_parse' in profiler.report(limit=10)
+    assert profiler.dump() is not None
+
+    # the next cycle is not profiled unless armed again
+    profiler.begin_cycle()
+    assert not profiler.active